@@ -1,33 +1,480 @@
 import os
+import re
 import tempfile
-import shutil
 import uuid
 import base64
+import hashlib
 import io
-from flask import Flask, render_template, request, jsonify, send_file, after_this_request
+import json
+import threading
+import time
+import weakref
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Request, Response, current_app, g, render_template, request, jsonify, send_file, after_this_request
 from werkzeug.utils import secure_filename
 from PIL import Image
 import numpy as np
-from utils.segmentation import segment_image, extract_objects, create_zip
+from utils.segmentation import (
+    segment_image, extract_objects, reextract_objects, composite_objects, encode_pngs, pack_masks,
+    unpack_masks, stream_zip, image_size, is_large_image, PNG_COMPRESS_LEVEL,
+    CircuitOpenError, MASK_THRESHOLD,
+)
+from utils.jobs import JobManager, JobError, sse_stream
+from utils.cache import get_cache
+from utils.metrics import RequestProfiler, get_metrics, timed
+from utils.atlas import build_atlas
+from utils.masks import RLEMask
+from utils.segmentation import get_inference_client
+from utils.session_store import FilesystemSessionStore, MemorySessionStore, SessionJanitor
+from utils.refine import (
+    EditHistory, HistoryConflict, RefineWorkingSet, ERASE_THRESHOLD, clip_rect, decode_binary_mask, erase_region,
+    parse_binary_mask, rasterize_strokes,
+)
 from dotenv import load_dotenv
 
 load_dotenv()
 
+class AppRequest(Request):
+    """Batch uploads carry many images, so they get their own body size limit."""
+
+    @property
+    def max_content_length(self):
+        if self.path == '/upload_batch':
+            return current_app.config['BATCH_MAX_CONTENT_LENGTH']
+        return super().max_content_length
+
 app = Flask(__name__)
-app.config['MAX_CONTENT_LENGTH'] = 10 * 1024 * 1024  # 10MB limit
+app.request_class = AppRequest
+app.config['MAX_CONTENT_LENGTH'] = int(os.getenv('MAX_UPLOAD_BYTES', 10 * 1024 * 1024))  # 10MB by default
+app.config['BATCH_MAX_CONTENT_LENGTH'] = int(os.getenv('BATCH_MAX_CONTENT_LENGTH', 200 * 1024 * 1024))
+app.config['BATCH_MAX_FILES'] = int(os.getenv('BATCH_MAX_FILES', 500))
+app.config['BATCH_CONCURRENCY'] = int(os.getenv('BATCH_CONCURRENCY', 8))
 app.config['UPLOAD_FOLDER'] = tempfile.gettempdir()
+app.config['JOB_WORKERS'] = int(os.getenv('UPLOAD_JOB_WORKERS', 4))
+# 'filesystem' keeps sessions under UPLOAD_FOLDER/instance_seg_app/<session_id>/,
+# 'memory' keeps them in RAM. Either way SESSION_STORE_MAX_BYTES caps the
+# total size (LRU eviction) and sessions expire SESSION_TTL seconds after
+# their last access.
+app.config['SESSION_STORE'] = os.getenv('SESSION_STORE', 'filesystem')
+app.config['SESSION_STORE_MAX_BYTES'] = int(os.getenv('SESSION_STORE_MAX_BYTES', 512 * 1024 * 1024))
+app.config['SESSION_TTL'] = int(os.getenv('SESSION_TTL', 900))
+app.config['SESSION_JANITOR_INTERVAL'] = float(os.getenv('SESSION_JANITOR_INTERVAL', 5))
+# Decoded objects kept in memory between /refine calls (PNGs are re-encoded on download)
+app.config['REFINE_CACHE_MAX_BYTES'] = int(os.getenv('REFINE_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+# Refinements per object that /refine/undo can step back through
+app.config['REFINE_HISTORY_LIMIT'] = int(os.getenv('REFINE_HISTORY_LIMIT', 50))
+# Stroke points accepted per /refine request (each point is rasterized)
+app.config['REFINE_MAX_STROKE_POINTS'] = int(os.getenv('REFINE_MAX_STROKE_POINTS', 2000))
+# Requests slower than PROFILE_THRESHOLD seconds leave a cProfile dump in
+# PROFILE_DIR (profiling is off when unset, as it slows every request down)
+app.config['PROFILE_THRESHOLD'] = float(os.getenv('PROFILE_THRESHOLD', 0)) or None
+app.config['PROFILE_DIR'] = os.getenv('PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'instance_seg_profiles'))
+# Objects are only described at upload time; their PNGs are composited and
+# encoded the first time they are asked for (see materialize_objects)
+app.config['LAZY_OBJECTS'] = os.getenv('LAZY_OBJECTS', '1').lower() not in ('0', 'false', 'no')
+
+ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'tif', 'tiff'}
 
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
+MANIFEST_FILENAME = '_manifest.json'
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+_job_manager = None
+
+def get_job_manager():
+    global _job_manager
+    if _job_manager is None:
+        _job_manager = JobManager(max_workers=app.config['JOB_WORKERS'])
+    return _job_manager
+
+_session_stores = {}
+_session_janitors = {}
+
+def get_session_store():
+    """
+    The configured session store (re-created if UPLOAD_FOLDER changes), with
+    a background janitor expiring its sessions and enforcing the byte quota.
+    """
+    if app.config['SESSION_STORE'] == 'memory':
+        key = ('memory',)
+    else:
+        key = ('filesystem', os.path.join(app.config['UPLOAD_FOLDER'], 'instance_seg_app'))
+    store = _session_stores.get(key)
+    if store is None:
+        if key[0] == 'memory':
+            store = MemorySessionStore(max_bytes=app.config['SESSION_STORE_MAX_BYTES'])
+        else:
+            store = FilesystemSessionStore(key[1])
+        _session_stores[key] = store
+        # Stores that are no longer configured keep their data but lose their janitor
+        for old_key in [k for k in _session_janitors if k != key and k[0] == key[0]]:
+            _session_janitors.pop(old_key).stop()
+        _session_janitors[key] = SessionJanitor(
+            store,
+            ttl=app.config['SESSION_TTL'],
+            max_bytes=app.config['SESSION_STORE_MAX_BYTES'],
+            interval=app.config['SESSION_JANITOR_INTERVAL'],
+        ).start()
+    return store
+
+_refine_working_set = None
+
+def get_refine_working_set():
+    global _refine_working_set
+    if _refine_working_set is None:
+        _refine_working_set = RefineWorkingSet(max_bytes=app.config['REFINE_CACHE_MAX_BYTES'],
+                                               loader=load_object_rgba, history=object_history)
+    return _refine_working_set
+
+def object_history(store, session_id, filename):
+    return EditHistory(store, session_id, filename, limit=app.config['REFINE_HISTORY_LIMIT'])
+
+def zip_filename_for(session_id):
+    return f"objects_{session_id}.zip"
+
+# Name (plus the original extension) the upload of a single-image session is stored under
+SOURCE_FILENAME_BASE = '_source'
+
+def masks_filename_for(image):
+    return f"{image}.masks"
+
+def objects_filename_for(image):
+    return f"{image}.objects"
+
+# Lazy objects: extraction stores one descriptor per object (mask reference,
+# bbox, label, score) next to the image's masks. An object's RGBA crop is
+# composited the first time a download, refine, ZIP or atlas asks for it, and
+# its PNG is then kept in the store.
+
+def read_object_descriptors(store, session_id):
+    """{filename: descriptor} of the session's objects, each with the 'image' it comes from."""
+    manifest = read_manifest(store, session_id)
+    if 'images' in manifest:
+        images = [image['image'] for image in manifest['images']]
+    else:
+        images = [manifest['source']]
+    descriptors = {}
+    for image in images:
+        data = store.get(session_id, objects_filename_for(image)) if image else None
+        if data is not None:
+            for descriptor in json.loads(data):
+                descriptors[descriptor['file']] = dict(descriptor, image=image)
+    return descriptors
+
+def composite_session_objects(store, session_id, filenames, descriptors=None):
+    """
+    {filename: RGBA array} of the described objects among `filenames`, built
+    from their masks; each source image is decoded once.
+    """
+    if descriptors is None:
+        descriptors = read_object_descriptors(store, session_id)
+    by_image = {}
+    for filename in filenames:
+        if filename in descriptors:
+            by_image.setdefault(descriptors[filename]['image'], []).append(descriptors[filename])
+    crops = {}
+    for image, group in by_image.items():
+        image_data = store.get(session_id, image)
+        blob = store.get(session_id, masks_filename_for(image))
+        if image_data is None or blob is None:
+            continue
+        _, masks = unpack_masks(blob)
+        for descriptor, rgba in zip(group, composite_objects(image_data, masks, group)):
+            crops[descriptor['file']] = rgba
+    return crops
+
+def load_object_rgba(store, session_id, filename):
+    """RGBA array of an object that has no PNG yet (or None)."""
+    return composite_session_objects(store, session_id, [filename]).get(filename)
+
+def materialize_objects(store, session_id, filenames):
+    """Encode and store the PNGs of the objects among `filenames` that do not have one yet."""
+    present = set(store.names(session_id))
+    missing = [f for f in filenames if f not in present]
+    if not missing:
+        return
+    crops = composite_session_objects(store, session_id, missing)
+    for filename, data in zip(crops, encode_pngs(list(crops.values()))):
+        store.put(session_id, filename, data)
+    get_metrics().inc('objects_materialized_total', len(crops))
+
+# Atlas: the session's objects packed into one PNG, plus an index with each
+# object's label, score, bbox in the original and rect in the atlas. Built
+# from the descriptors on first request, so object PNGs are still only
+# encoded when something asks for one.
+ATLAS_IMAGE_FILENAME = '_atlas.png'
+ATLAS_INDEX_FILENAME = '_atlas.json'
+# One lock per session, so building one session's atlas does not hold up
+# another's; a lock lives as long as some request is using it
+_atlas_locks = weakref.WeakValueDictionary()
+_atlas_locks_lock = threading.Lock()
+
+def atlas_lock(session_id):
+    with _atlas_locks_lock:
+        lock = _atlas_locks.get(session_id)
+        if lock is None:
+            lock = _atlas_locks[session_id] = threading.Lock()
+        return lock
+
+def write_atlas(store, session_id, objects, atlas, rects, compress_level=PNG_COMPRESS_LEVEL):
+    """Store the `atlas` array of `objects` (descriptors) packed at `rects`; returns the index."""
+    data = encode_pngs([atlas], compress_level=compress_level)[0]
+    index = {
+        'etag': hashlib.sha1(data).hexdigest()[:16],
+        'width': int(atlas.shape[1]),
+        'height': int(atlas.shape[0]),
+        'objects': [{
+            'file': obj['file'],
+            'label': obj['label'],
+            'score': obj['score'],
+            'bbox': obj['bbox'],
+            'rect': rect,
+        } for obj, rect in zip(objects, rects)],
+        # Objects edited since the atlas was encoded
+        'stale': [],
+    }
+    store.put(session_id, ATLAS_IMAGE_FILENAME, data)
+    store.put(session_id, ATLAS_INDEX_FILENAME, json.dumps(index).encode('utf-8'))
+    return index
+
+def build_session_atlas(store, session_id):
+    """Atlas of every described object of the session (None if there are none)."""
+    descriptors = read_object_descriptors(store, session_id)
+    objects = [descriptors[f] for f in session_objects(store, session_id) if f in descriptors]
+    if not objects:
+        return None
+    # Edited objects are packed as they are now
+    get_refine_working_set().flush(store, session_id)
+    present = set(store.names(session_id))
+    crops = composite_session_objects(store, session_id, [obj['file'] for obj in objects if obj['file'] not in present],
+                                      descriptors)
+    for obj in objects:
+        if obj['file'] in present:
+            data = store.get(session_id, obj['file'])
+            if data is not None:
+                crops[obj['file']] = np.array(Image.open(io.BytesIO(data)).convert('RGBA'))
+    objects = [obj for obj in objects if obj['file'] in crops]
+    atlas, rects = build_atlas([crops[obj['file']] for obj in objects])
+    return write_atlas(store, session_id, objects, atlas, rects)
+
+def read_atlas_index(store, session_id):
+    data = store.get(session_id, ATLAS_INDEX_FILENAME)
+    return json.loads(data) if data is not None else None
+
+def read_atlas(store, session_id):
+    data = store.get(session_id, ATLAS_IMAGE_FILENAME)
+    return np.array(Image.open(io.BytesIO(data)).convert('RGBA')) if data is not None else None
+
+def drop_atlas(store, session_id):
+    """Forget the session's atlas; the next request builds a new one."""
+    with atlas_lock(session_id):
+        store.remove(session_id, ATLAS_INDEX_FILENAME)
+        store.remove(session_id, ATLAS_IMAGE_FILENAME)
+
+def mark_atlas_stale(store, session_id, filename):
+    """Note that an object changed, so the next atlas request re-encodes it."""
+    with atlas_lock(session_id):
+        index = read_atlas_index(store, session_id)
+        if index is None or filename in index['stale']:
+            return
+        index['stale'].append(filename)
+        store.put(session_id, ATLAS_INDEX_FILENAME, json.dumps(index).encode('utf-8'))
+
+def refresh_atlas(store, session_id):
+    """The session's atlas index: built if missing, with edited objects copied into it first."""
+    with atlas_lock(session_id):
+        index = read_atlas_index(store, session_id)
+        if index is None:
+            return build_session_atlas(store, session_id)
+        if not index['stale']:
+            return index
+        get_refine_working_set().flush(store, session_id)
+        atlas = read_atlas(store, session_id)
+        rects = {obj['file']: obj['rect'] for obj in index['objects']}
+        for filename in index['stale']:
+            data = store.get(session_id, filename)
+            if data is not None and filename in rects:
+                x, y, w, h = rects[filename]
+                atlas[y:y + h, x:x + w] = np.array(Image.open(io.BytesIO(data)).convert('RGBA'))
+        return write_atlas(store, session_id, index['objects'], atlas, [obj['rect'] for obj in index['objects']])
+
+def extract_session_objects(store, session_id, image, image_data, segmentation_results,
+                            prefix='', on_object=None):
+    """
+    extract_objects into the session store. The raw masks are stored next to
+    the image so /reextract can rebuild the objects without the model, with
+    a descriptor per object. With LAZY_OBJECTS that is all extraction stores:
+    object PNGs are encoded on first use (see materialize_objects). Large
+    images are extracted one PNG each, without masks or descriptors.
+    """
+    masks = []
+    descriptors = []
+    files = extract_objects(
+        image_data, segmentation_results, None, prefix=prefix,
+        save=lambda name, data: store.put(session_id, name, data),
+        on_object=on_object, keep_masks=masks, describe=descriptors, lazy=app.config['LAZY_OBJECTS'],
+    )
+    size = image_size(image_data)
+    if not is_large_image(size):
+        store.put(session_id, masks_filename_for(image), pack_masks(size, masks))
+        store.put(session_id, objects_filename_for(image), json.dumps(descriptors).encode('utf-8'))
+    return files
+
+def write_manifest(store, session_id, source, objects, images=None):
+    """
+    Record which files in a session are the upload and which are extracted objects.
+    Batch sessions also list `images`: [{'image', 'prefix', 'files'}] per source image.
+    """
+    manifest = {'source': source, 'objects': objects}
+    if images is not None:
+        manifest['images'] = images
+    store.put(session_id, MANIFEST_FILENAME, json.dumps(manifest).encode('utf-8'))
+
+def read_manifest(store, session_id):
+    data = store.get(session_id, MANIFEST_FILENAME)
+    if data is not None:
+        return json.loads(data)
+    # Sessions without a manifest: every PNG is an object
+    return {'source': None,
+            'objects': [f for f in store.names(session_id) if f.endswith('.png') and 'mask' not in f]}
+
+def session_objects(store, session_id):
+    """Object filenames of a session, in extraction order."""
+    return read_manifest(store, session_id)['objects']
+
+def session_archive_entries(store, session_id):
+    """
+    (source, arcname) pairs for the session ZIP, where source is a local path
+    or the file's bytes; batch sessions get one folder per image.
+    """
+    manifest = read_manifest(store, session_id)
+    if 'images' in manifest:
+        names = []
+        for image in manifest['images']:
+            folder = os.path.splitext(image['image'])[0]
+            names += [(f, f"{folder}/{f[len(image['prefix']):]}") for f in image.get('files', [])]
+    else:
+        names = [(f, f) for f in manifest['objects']]
+    materialize_objects(store, session_id, [f for f, _ in names])
+    return [(store.path(session_id, f) or store.get(session_id, f), arcname) for f, arcname in names]
+
+@app.before_request
+def start_request_timing():
+    g.request_start = time.perf_counter()
+    get_metrics().begin_trace()
+    g.profiler = g.profile = None
+    if app.config['PROFILE_THRESHOLD'] is not None:
+        g.profiler = RequestProfiler(app.config['PROFILE_THRESHOLD'], app.config['PROFILE_DIR'])
+        g.profile = g.profiler.start()
+
+@app.after_request
+def record_request_timing(response):
+    """Request latency and bytes in /metrics, spans in a Server-Timing header."""
+    if 'request_start' not in g:
+        return response
+    seconds = time.perf_counter() - g.request_start
+    endpoint = request.endpoint or 'unknown'
+    metrics = get_metrics()
+    metrics.observe('request_duration_seconds', seconds, endpoint=endpoint, status=response.status_code)
+    if request.content_length:
+        metrics.inc('request_bytes_total', request.content_length, endpoint=endpoint)
+    # Streamed bodies (the ZIP) count their bytes as they are sent
+    if not response.is_streamed and response.content_length:
+        metrics.inc('response_bytes_total', response.content_length, endpoint=endpoint)
+
+    spans = metrics.end_trace()
+    timings = [f"{s['stage']};dur={s['seconds'] * 1000:.1f}" for s in spans]
+    timings.append(f"total;dur={seconds * 1000:.1f}")
+    response.headers['Server-Timing'] = ', '.join(timings)
+
+    if g.profile is not None:
+        path = g.profiler.stop(g.profile, seconds, f"{request.method}_{endpoint}")
+        g.profile = None
+        if path:
+            print(f"Slow request ({seconds:.2f}s) {request.method} {request.path}: profile saved to {path}")
+    return response
+
 @app.route('/')
 def index():
     return render_template('index.html')
 
+def process_upload(session_id, filename, api_token, use_cache=True, job=None, atlas=False):
+    """
+    Segment -> extract pipeline for an upload saved in the session store as
+    `filename`. Returns the /upload JSON payload (with `atlas`, it links the
+    session's atlas index) or raises JobError. When run as a background job, progress is
+    reported on `job`: a 'stage' event per step and an 'object' event for each
+    object as soon as it is available.
+    """
+    def emit(event_type, **data):
+        if job is not None:
+            job.emit(event_type, **data)
+
+    store = get_session_store()
+    image_data = store.get(session_id, filename)
+
+    # 1. Segment
+    emit('stage', stage='segmenting')
+    try:
+        segmentation_results = segment_image(image_data, api_token, use_cache=use_cache)
+    except CircuitOpenError as e:
+        store.delete(session_id)
+        raise JobError(str(e), 503)
+    except Exception as e:
+        store.delete(session_id)
+        raise JobError(f"Segmentation failed: {str(e)}", 500)
+
+    # 2. Extract Objects
+    emit('stage', stage='extracting', total=len(segmentation_results))
+    try:
+        extracted_files = extract_session_objects(
+            store, session_id, filename, image_data, segmentation_results,
+            on_object=lambda name: emit('object', file=name),
+        )
+    except Exception as e:
+         store.delete(session_id)
+         raise JobError(f"Extraction failed: {str(e)}", 500)
+
+    if not extracted_files:
+         store.delete(session_id)
+         raise JobError("No objects detected.", 200)
+
+    # Prepare response
+    # We need to serve these files. 
+    # Strategy: Return filenames and a session ID. 
+    # The client can request /download/<session_id>/<filename>
+    # The ZIP is not built here: /download streams it on demand.
+    
+    response_files = []
+    for f in extracted_files:
+        response_files.append(os.path.basename(f))
+    write_manifest(store, session_id, filename, response_files)
+
+    response = {
+        'session_id': session_id,
+        'files': response_files,
+        'zip_file': zip_filename_for(session_id)
+    }
+    # Large images have no descriptors to build an atlas from
+    if atlas and store.get(session_id, objects_filename_for(filename)) is not None:
+        response['atlas'] = f"/atlas/{session_id}"
+    return response
+
+def run_upload_job(job, *args, **kwargs):
+    return process_upload(*args, job=job, **kwargs)
+
 @app.route('/upload', methods=['POST'])
+@timed('upload_file')
 def upload_file():
+    """
+    Upload an image and extract its objects.
+    With form field async=1 the pipeline runs on the background worker pool and
+    the response is 202 with a job id; progress is available from
+    /jobs/<job_id> (polling) or /jobs/<job_id>/events (Server-Sent Events).
+    With atlas=1 the response links the objects packed into one atlas image (see /atlas).
+    """
     if 'file' not in request.files:
         return jsonify({'error': 'No file part'}), 400
     
@@ -39,150 +486,527 @@ def upload_file():
     if file and allowed_file(file.filename):
         # Create a unique session ID for this upload
         session_id = str(uuid.uuid4())
-        session_dir = os.path.join(app.config['UPLOAD_FOLDER'], 'instance_seg_app', session_id)
-        os.makedirs(session_dir, exist_ok=True)
+        store = get_session_store()
+        store.create(session_id)
         
         try:
-            filename = secure_filename(file.filename)
-            file_path = os.path.join(session_dir, filename)
-            file.save(file_path)
+            # Under a reserved name: object files are named after their labels
+            # and must not be able to shadow the upload (or the other way round)
+            filename = SOURCE_FILENAME_BASE + os.path.splitext(secure_filename(file.filename))[1].lower()
+            store.put(session_id, filename, file.read())
             
             # API Token (optional, but recommended)
             api_token = os.getenv("HF_API_TOKEN") # User can set this in .env
             
-            # 1. Segment
-            try:
-                segmentation_results = segment_image(file_path, api_token)
-            except Exception as e:
-                shutil.rmtree(session_dir)
-                return jsonify({'error': f"Segmentation failed: {str(e)}"}), 500
-            
-            # 2. Extract Objects
+            # Clients can force a fresh model call (e.g. after a model update)
+            use_cache = request.form.get('no_cache', '').lower() not in ('1', 'true', 'yes')
+            # Link the objects packed into one atlas for the gallery (see /atlas)
+            atlas = request.form.get('atlas', '').lower() in ('1', 'true', 'yes')
+
+            if request.form.get('async', '').lower() in ('1', 'true', 'yes'):
+                job = get_job_manager().submit(
+                    run_upload_job, session_id, filename, api_token, use_cache=use_cache, atlas=atlas
+                )
+                return jsonify({
+                    'job_id': job.id,
+                    'session_id': session_id,
+                    'status_url': f"/jobs/{job.id}",
+                    'events_url': f"/jobs/{job.id}/events",
+                }), 202
+
             try:
-                extracted_files = extract_objects(file_path, segmentation_results, session_dir)
-            except Exception as e:
-                 shutil.rmtree(session_dir)
-                 return jsonify({'error': f"Extraction failed: {str(e)}"}), 500
-
-            if not extracted_files:
-                 shutil.rmtree(session_dir)
-                 return jsonify({'error': "No objects detected."}), 200
-
-            # 3. Create ZIP
-            zip_filename = f"objects_{session_id}.zip"
-            zip_path = os.path.join(session_dir, zip_filename)
-            create_zip(extracted_files, zip_path)
-            
-            # Prepare response
-            # We need to serve these files. 
-            # Strategy: Return filenames and a session ID. 
-            # The client can request /download/<session_id>/<filename>
-            
-            response_files = []
-            for f in extracted_files:
-                response_files.append(os.path.basename(f))
-                
-            return jsonify({
-                'session_id': session_id,
-                'files': response_files,
-                'zip_file': zip_filename
-            })
+                return jsonify(process_upload(session_id, filename, api_token, use_cache=use_cache, atlas=atlas))
+            except JobError as e:
+                return jsonify({'error': str(e)}), e.status
             
         except Exception as e:
-            shutil.rmtree(session_dir)
+            store.delete(session_id)
             return jsonify({'error': str(e)}), 500
             
     return jsonify({'error': 'Invalid file type'}), 400
 
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = get_job_manager().get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job.snapshot())
+
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    job = get_job_manager().get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    # EventSource sends Last-Event-ID when it reconnects
+    last_event_id = request.headers.get('Last-Event-ID', type=int, default=0)
+    return Response(
+        sse_stream(job, last_event_id),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
+def save_batch_images(store, session_id):
+    """
+    Save every image of a batch request into the session store.
+    Accepts repeated 'files' fields and/or ZIP archives of images; anything
+    that is not an allowed image type is skipped. Returns the saved filenames
+    in request order (renamed where needed so each has a unique stem).
+    """
+    max_files = app.config['BATCH_MAX_FILES']
+    max_image_bytes = app.config['MAX_CONTENT_LENGTH']
+    max_total_bytes = app.config['BATCH_MAX_CONTENT_LENGTH']
+    saved = []
+    stems = set()
+    total_bytes = 0
+
+    def save(name, data):
+        base, ext = os.path.splitext(name)
+        # Objects are named '<stem>__<label>_<n>.png', so no image may have '__' in its stem
+        base = re.sub(r'_{2,}', '_', base)
+        candidate, n = base, 1
+        while candidate in stems:
+            n += 1
+            candidate = f"{base}_{n}"
+        if len(saved) >= max_files:
+            raise ValueError(f"Too many images (limit {max_files}).")
+        stems.add(candidate)
+        saved.append(candidate + ext)
+        store.put(session_id, candidate + ext, data)
+
+    for file in request.files.getlist('files') + request.files.getlist('file'):
+        if not file or file.filename == '':
+            continue
+        name = secure_filename(file.filename)
+        if name.lower().endswith('.zip'):
+            with zipfile.ZipFile(file.stream) as archive:
+                for info in archive.infolist():
+                    base = os.path.basename(info.filename)
+                    # Skip folders and macOS resource forks (__MACOSX/, ._name)
+                    if info.is_dir() or base.startswith('.') or '__MACOSX' in info.filename:
+                        continue
+                    inner = secure_filename(base)
+                    if not allowed_file(inner):
+                        continue
+                    # Header sizes can lie, so the read itself is bounded too
+                    with archive.open(info) as src:
+                        data = src.read(max_image_bytes + 1)
+                    total_bytes += len(data)
+                    if len(data) > max_image_bytes or total_bytes > max_total_bytes:
+                        raise ValueError(f"Archive entry too large: {base}")
+                    save(inner, data)
+        elif allowed_file(name):
+            save(name, file.read())
+    return saved
+
+def process_batch(session_id, images, api_token, use_cache=True, job=None):
+    """
+    Segment and extract many images into one session. Up to BATCH_CONCURRENCY
+    images are in flight at once, so total time tracks the slowest backend
+    calls rather than their sum. A failed image is reported in its entry
+    instead of failing the batch.
+    """
+    def emit(event_type, **data):
+        if job is not None:
+            job.emit(event_type, **data)
+
+    store = get_session_store()
+
+    def run_one(image):
+        entry = {'image': image, 'prefix': f"{os.path.splitext(image)[0]}__", 'files': []}
+        image_data = store.get(session_id, image)
+        try:
+            segmentation_results = segment_image(image_data, api_token, use_cache=use_cache)
+            entry['files'] = extract_session_objects(
+                store, session_id, image, image_data, segmentation_results, prefix=entry['prefix'],
+                on_object=lambda name: emit('object', file=name),
+            )
+        except Exception as e:
+            entry['error'] = str(e)
+        emit('image', image=image, files=entry['files'], error=entry.get('error'))
+        return entry
+
+    emit('stage', stage='segmenting', total=len(images))
+    with ThreadPoolExecutor(max_workers=max(1, app.config['BATCH_CONCURRENCY'])) as pool:
+        entries = list(pool.map(run_one, images))
+
+    all_files = [f for entry in entries for f in entry['files']]
+    if not all_files:
+        store.delete(session_id)
+        failed = [entry['error'] for entry in entries if 'error' in entry]
+        if len(failed) == len(entries):
+            raise JobError(f"Segmentation failed: {failed[0]}", 500)
+        raise JobError("No objects detected.", 200)
+
+    write_manifest(store, session_id, None, all_files, images=entries)
+    return {
+        'session_id': session_id,
+        'images': [{k: v for k, v in entry.items() if k != 'prefix'} for entry in entries],
+        'files': all_files,
+        'zip_file': zip_filename_for(session_id)
+    }
+
+def run_batch_job(job, *args, **kwargs):
+    return process_batch(*args, job=job, **kwargs)
+
+@app.route('/upload_batch', methods=['POST'])
+def upload_batch():
+    """
+    Upload many images (repeated 'files' fields and/or ZIP archives of images)
+    and extract objects from all of them into a single session. The session
+    ZIP holds one folder per image. Supports async=1 like /upload.
+    """
+    session_id = str(uuid.uuid4())
+    store = get_session_store()
+    store.create(session_id)
+
+    try:
+        try:
+            images = save_batch_images(store, session_id)
+        except (ValueError, zipfile.BadZipFile) as e:
+            store.delete(session_id)
+            return jsonify({'error': str(e)}), 400
+        if not images:
+            store.delete(session_id)
+            return jsonify({'error': 'No valid images in request'}), 400
+
+        api_token = os.getenv("HF_API_TOKEN")
+        use_cache = request.form.get('no_cache', '').lower() not in ('1', 'true', 'yes')
+
+        if request.form.get('async', '').lower() in ('1', 'true', 'yes'):
+            job = get_job_manager().submit(
+                run_batch_job, session_id, images, api_token, use_cache=use_cache
+            )
+            return jsonify({
+                'job_id': job.id,
+                'session_id': session_id,
+                'status_url': f"/jobs/{job.id}",
+                'events_url': f"/jobs/{job.id}/events",
+            }), 202
+
+        try:
+            return jsonify(process_batch(session_id, images, api_token, use_cache=use_cache))
+        except JobError as e:
+            return jsonify({'error': str(e)}), e.status
+
+    except Exception as e:
+        store.delete(session_id)
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/reextract', methods=['POST'])
+def reextract_session():
+    """
+    Regenerate a session's objects from its stored masks, without calling
+    the segmentation model again. Refinements of the old objects are dropped.
+    Expects JSON: {
+        'session_id': str,
+        'threshold': int (0-255, default 10: mask values below it are cut),
+        'min_score': float (default 0),
+        'labels': [str] (default: all labels),
+        'feather': float (edge blur radius in pixels, default 0)
+    }
+    """
+    data = request.json
+    if not data or not data.get('session_id'):
+        return jsonify({'error': 'Missing parameters'}), 400
+    session_id = data['session_id']
+    try:
+        threshold = int(data.get('threshold', MASK_THRESHOLD))
+        min_score = float(data.get('min_score', 0))
+        feather = float(data.get('feather', 0))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Invalid parameters'}), 400
+    labels = data.get('labels')
+    if not 0 <= threshold <= 255 or not 0 <= feather <= 100 or (labels is not None and not isinstance(labels, list)):
+        return jsonify({'error': 'Invalid parameters'}), 400
+
+    store = get_session_store()
+    try:
+        if not store.exists(session_id):
+            return jsonify({'error': 'Session not found'}), 404
+    except ValueError:
+        return jsonify({'error': 'Session not found'}), 404
+
+    manifest = read_manifest(store, session_id)
+    images = manifest.get('images') or [{'image': manifest['source'], 'prefix': '', 'files': []}]
+    previous = set(manifest['objects'])
+    get_refine_working_set().discard(session_id)
+    lazy = app.config['LAZY_OBJECTS']
+
+    try:
+        for image in images:
+            blob = store.get(session_id, masks_filename_for(image['image'])) if image['image'] else None
+            if blob is None:
+                if 'images' not in manifest:
+                    return jsonify({'error': 'No stored masks for this session'}), 409
+                # Batch image that failed to segment
+                continue
+            _, masks = unpack_masks(blob)
+            descriptors = []
+            image['files'] = reextract_objects(
+                store.get(session_id, image['image']), masks, None,
+                threshold=threshold, min_score=min_score, labels=labels, feather=feather,
+                # Interactive tweaking: PNG encoding dominates, so favour speed over size
+                fast_encode=True,
+                prefix=image['prefix'], save=lambda name, data: store.put(session_id, name, data),
+                describe=descriptors, lazy=lazy,
+            )
+            store.put(session_id, objects_filename_for(image['image']), json.dumps(descriptors).encode('utf-8'))
+    except Exception as e:
+        return jsonify({'error': f"Extraction failed: {str(e)}"}), 500
+
+    all_files = [f for image in images for f in image['files']]
+    for filename in previous | set(all_files):
+        EditHistory(store, session_id, filename).clear()
+    # A stored PNG takes precedence over the object's descriptor
+    for filename in (previous | set(all_files) if lazy else previous - set(all_files)):
+        store.remove(session_id, filename)
+    drop_atlas(store, session_id)
+
+    response = {
+        'session_id': session_id,
+        'files': all_files,
+        'zip_file': zip_filename_for(session_id)
+    }
+    if 'images' in manifest:
+        write_manifest(store, session_id, None, all_files, images=images)
+        response['images'] = [{k: v for k, v in image.items() if k != 'prefix'} for image in images]
+    else:
+        write_manifest(store, session_id, manifest['source'], all_files)
+    return jsonify(response)
+
 @app.route('/download/<session_id>/<filename>')
 def download_file_route(session_id, filename):
-    temp_dir = os.path.join(app.config['UPLOAD_FOLDER'], 'instance_seg_app', session_id)
-    file_path = os.path.join(temp_dir, filename)
-    
-    if not os.path.exists(file_path):
+    store = get_session_store()
+    try:
+        if filename == zip_filename_for(session_id) and store.exists(session_id):
+            get_refine_working_set().flush(store, session_id)
+            # Built on the fly from the current object files, flushed as it goes
+            return Response(
+                get_metrics().timed_iter(
+                    'create_zip', stream_zip(session_archive_entries(store, session_id)),
+                    bytes_metric='response_bytes_total', endpoint=request.endpoint,
+                ),
+                mimetype='application/zip',
+                headers={'Content-Disposition': f'attachment; filename={filename}'},
+            )
+
+        # Refinements are encoded lazily, on first download after the edit
+        get_refine_working_set().flush(store, session_id, filename)
+        # Objects are encoded the first time they are asked for
+        materialize_objects(store, session_id, [filename])
+        file_path = store.path(session_id, filename)
+    except ValueError:
         return "File not found", 404
-        
-    return send_file(file_path, as_attachment=True)
+
+    if file_path is not None:
+        if not os.path.exists(file_path):
+            return "File not found", 404
+        return send_file(file_path, as_attachment=True)
+
+    # In-memory sessions are served straight from their buffers
+    data = store.get(session_id, filename)
+    if data is None:
+        return "File not found", 404
+    return send_file(io.BytesIO(data), as_attachment=True, download_name=filename)
+
+def atlas_response(response, etag, max_age=0):
+    response.set_etag(etag)
+    if max_age:
+        # The URL changes with the content, so it never needs revalidating
+        response.headers['Cache-Control'] = f'private, max-age={max_age}, immutable'
+    else:
+        response.headers['Cache-Control'] = 'private, no-cache'
+    return response.make_conditional(request)
+
+@app.route('/atlas/<session_id>')
+def atlas_index_route(session_id):
+    """
+    Index of a session's atlas, built on first request: {'etag', 'width', 'height', 'image' (URL
+    of the atlas PNG), 'objects': [{'file', 'label', 'score', 'bbox': [x, y, w, h]
+    in the original, 'rect': [x, y, w, h] in the atlas}]}. Served with an ETag,
+    so reloading the gallery costs a 304 until an object changes.
+    """
+    store = get_session_store()
+    try:
+        index = refresh_atlas(store, session_id)
+    except ValueError:
+        index = None
+    if index is None:
+        return jsonify({'error': 'No atlas for this session'}), 404
+    payload = {k: v for k, v in index.items() if k != 'stale'}
+    payload['image'] = f"/atlas/{session_id}/{index['etag']}.png"
+    return atlas_response(jsonify(payload), index['etag'])
+
+@app.route('/atlas/<session_id>/<etag>.png')
+def atlas_image_route(session_id, etag):
+    store = get_session_store()
+    try:
+        index = read_atlas_index(store, session_id)
+        data = store.get(session_id, ATLAS_IMAGE_FILENAME) if index is not None and index['etag'] == etag else None
+    except ValueError:
+        data = None
+    if data is None:
+        return "File not found", 404
+    return atlas_response(Response(data, mimetype='image/png'), etag, max_age=365 * 24 * 3600)
 
 @app.route('/refine', methods=['POST'])
+@timed('refine_segmentation')
 def refine_segmentation():
     """
     Refine an existing segmented image by applying an erasure mask.
     Expects JSON: {
         'session_id': str,
         'filename': str,
-        'mask': str (base64 encoded image of the erasure strokes)
+        and one of:
+        'mask': str (base64 encoded image of the erasure strokes),
+        'rect': [x, y, w, h] (optional: 'mask' only covers this region),
+        'strokes': [{'points': [[x, y], ...], 'size': brush_size}, ...]
     }
+    or an application/octet-stream binary mask (see utils/refine.py) with
+    session_id and filename as query parameters.
+    Only the affected region is updated, on an in-memory copy of the object;
+    the PNG is re-encoded when it is next downloaded.
     """
-    data = request.json
+    binary_mask = None
+    if request.mimetype == 'application/octet-stream':
+        data = request.args
+        try:
+            binary_mask = parse_binary_mask(request.get_data())
+        except ValueError as e:
+            return jsonify({'error': f"Invalid mask: {str(e)}"}), 400
+    else:
+        data = request.json
     if not data:
         return jsonify({'error': 'No data provided'}), 400
         
     session_id = data.get('session_id')
     filename = data.get('filename')
     mask_b64 = data.get('mask')
+    strokes = data.get('strokes')
+    rect = data.get('rect')
     
-    if not all([session_id, filename, mask_b64]):
+    if not all([session_id, filename]) or not (mask_b64 or strokes or binary_mask):
         return jsonify({'error': 'Missing parameters'}), 400
-        
-    session_dir = os.path.join(app.config['UPLOAD_FOLDER'], 'instance_seg_app', session_id)
-    file_path = os.path.join(session_dir, filename)
-    
-    if not os.path.exists(file_path):
-        return jsonify({'error': 'File not found'}), 404
-        
-    try:
+
+    if strokes:
+        try:
+            points = sum(len(stroke.get('points') or []) for stroke in strokes)
+        except (AttributeError, TypeError):
+            return jsonify({'error': 'Invalid strokes'}), 400
+        if points > app.config['REFINE_MAX_STROKE_POINTS']:
+            return jsonify({'error': f"Too many stroke points (at most {app.config['REFINE_MAX_STROKE_POINTS']})"}), 400
+
+    if mask_b64:
         # Decode the mask
         if ',' in mask_b64:
             mask_b64 = mask_b64.split(',')[1]
-        mask_bytes = base64.b64decode(mask_b64)
-        erasure_mask = Image.open(io.BytesIO(mask_bytes)).convert("L")
-        
-        # Load the original image
-        original = Image.open(file_path).convert("RGBA")
-        
-        # Resize erasure mask to match image if needed
-        if erasure_mask.size != original.size:
-            erasure_mask = erasure_mask.resize(original.size, Image.NEAREST)
-            
-        # Apply the erasure
-        # Where the mask is white (drawn), we want to make the image transparent.
-        # We can do this by updating the alpha channel.
-        
-        r, g, b, a = original.split()
-        
-        # Invert the erasure mask (0=keep, 255=erase) -> we want 0=erase, 255=keep for composition?
-        # Actually easier: new_alpha = old_alpha - erasure_value
-        # If erasure is white (255), we want alpha to become 0.
-        # If erasure is black (0), we want alpha to stay same.
-        
-        # Convert images to numpy for easy math
-        import numpy as np
-        a_arr = np.array(a)
-        mask_arr = np.array(erasure_mask)
-        
-        # If mask is > 0, set alpha to 0. 
-        # (Assuming the frontend sends a black canvas with white strokes for erasure)
-        a_arr = np.where(mask_arr > 10, 0, a_arr)
-        
-        new_a = Image.fromarray(a_arr.astype('uint8'))
-        original.putalpha(new_a)
-        
-        # Save back
-        original.save(file_path, format="PNG")
-        
-        # Re-create ZIP to include updated file
-        # Find all png files in the directory
-        all_files = [os.path.join(session_dir, f) for f in os.listdir(session_dir) if f.endswith('.png') and 'mask' not in f]
-        zip_filename = f"objects_{session_id}.zip"
-        zip_path = os.path.join(session_dir, zip_filename)
-        create_zip(all_files, zip_path)
-        
-        return jsonify({'status': 'success', 'filename': filename})
-        
+        try:
+            erasure_mask = Image.open(io.BytesIO(base64.b64decode(mask_b64))).convert("L")
+        except Exception as e:
+            return jsonify({'error': f"Invalid mask: {str(e)}"}), 400
+
+    store = get_session_store()
+    history = object_history(store, session_id, filename)
+
+    def apply(rgba):
+        height, width = rgba.shape[:2]
+        if binary_mask is not None:
+            encoding, (x, y, w, h), payload = binary_mask
+            if x + w > width or y + h > height:
+                raise ValueError("Mask region outside the image")
+            if w == 0 or h == 0:
+                return None
+            box = (x, y, x + w, y + h)
+            erase = decode_binary_mask(encoding, w, h, payload)
+        elif strokes:
+            region = rasterize_strokes(strokes, (width, height))
+            if region is None:
+                return None
+            box, erase = region
+        else:
+            if rect is None:
+                # Full-size mask: resize it to the image if needed
+                mask = erasure_mask
+                if mask.size != (width, height):
+                    mask = mask.resize((width, height), Image.NEAREST)
+                # Only the drawn area is edited and recorded, not the whole frame
+                drawn = RLEMask.encode(np.asarray(mask) > ERASE_THRESHOLD)
+                if not drawn:
+                    return None
+                box = drawn.bbox
+                erase = drawn.decode() > 0
+            else:
+                mask = erasure_mask
+                if mask.size != (int(rect[2]), int(rect[3])):
+                    mask = mask.resize((int(rect[2]), int(rect[3])), Image.NEAREST)
+                box = clip_rect(rect, (width, height))
+                if box is None:
+                    return None
+                # Drop the parts of the rect outside the image
+                x0, y0, x1, y1 = box
+                left, top = x0 - int(rect[0]), y0 - int(rect[1])
+                mask = mask.crop((left, top, left + x1 - x0, top + y1 - y0))
+                # Where the mask is white (drawn), make the image transparent
+                erase = np.asarray(mask) > ERASE_THRESHOLD
+        x0, y0, x1, y1 = box
+        before = rgba[y0:y1, x0:x1, 3].copy()
+        erase_region(rgba, box, erase)
+        history.record(box, before, rgba[y0:y1, x0:x1, 3])
+        return box
+
+    try:
+        box = get_refine_working_set().edit(store, session_id, filename, apply)
+    except KeyError:
+        return jsonify({'error': 'File not found'}), 404
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+    if box is not None:
+        mark_atlas_stale(store, session_id, filename)
+    return jsonify(refine_response(filename, box, history))
+
+def refine_response(filename, box, history):
+    response = {'status': 'success', 'filename': filename}
+    if box is not None:
+        x0, y0, x1, y1 = box
+        response['rect'] = [x0, y0, x1 - x0, y1 - y0]
+    response.update(history.state())
+    return response
+
+@app.route('/refine/undo', methods=['POST'])
+def undo_refinement():
+    """Revert the latest refinement of an object. Expects JSON: {'session_id', 'filename'}"""
+    return step_refinement_history('undo')
+
+@app.route('/refine/redo', methods=['POST'])
+def redo_refinement():
+    """Re-apply the latest undone refinement. Expects JSON: {'session_id', 'filename'}"""
+    return step_refinement_history('redo')
+
+def step_refinement_history(action):
+    data = request.json
+    if not data or not data.get('session_id') or not data.get('filename'):
+        return jsonify({'error': 'Missing parameters'}), 400
+    session_id, filename = data['session_id'], data['filename']
+
+    store = get_session_store()
+    history = object_history(store, session_id, filename)
+    try:
+        box = get_refine_working_set().edit(store, session_id, filename, getattr(history, action))
+    except KeyError:
+        return jsonify({'error': 'File not found'}), 404
+    except HistoryConflict as e:
+        return jsonify({'error': str(e), **history.state()}), 409
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+    if box is None:
+        return jsonify({'error': f'Nothing to {action}', **history.state()}), 409
+    mark_atlas_stale(store, session_id, filename)
+    return jsonify(refine_response(filename, box, history))
+
 @app.route('/cleanup/<session_id>', methods=['POST'])
 def cleanup_session(session_id):
     """
@@ -208,25 +1032,32 @@ def cleanup_session(session_id):
     return jsonify({'status': 'cleaned'})
 
 def cleanup_old_sessions():
-    """Delete sessions older than 15 minutes"""
-    base_dir = os.path.join(app.config['UPLOAD_FOLDER'], 'instance_seg_app')
-    if not os.path.exists(base_dir):
-        return
-        
-    import time
-    current_time = time.time()
-    
-    for session_id in os.listdir(base_dir):
-        session_path = os.path.join(base_dir, session_id)
-        if os.path.isdir(session_path):
-             # check modification time
-             if current_time - os.path.getmtime(session_path) > 900: # 15 mins
-                 try:
-                     shutil.rmtree(session_path)
-                 except:
-                     pass
-
-# Run cleanup on startup
+    """Delete sessions not accessed for SESSION_TTL seconds (15 minutes by default)"""
+    get_session_store().expire(app.config['SESSION_TTL'])
+
+@app.route('/sessions/stats')
+def session_stats():
+    """Live sessions, bytes held, expiries and quota evictions of the session store."""
+    return jsonify(get_session_store().stats())
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus text format: stage/request latency histograms, byte and object counters, cache and store stats."""
+    gauges = {}
+    cache = get_cache()
+    if cache is not None:
+        for key, value in cache.stats().items():
+            # Sizes are unknown while the cache database is unreadable
+            if value is not None:
+                gauges[f'cache_{key}'] = value
+    for key, value in get_session_store().stats().items():
+        gauges[f'session_store_{key}'] = value
+    for key, value in get_refine_working_set().stats().items():
+        gauges[f'refine_cache_{key}'] = value
+    gauges['backend_circuit_open'] = int(get_inference_client().state == 'open')
+    return Response(get_metrics().render(gauges), mimetype='text/plain; version=0.0.4')
+
+# Run cleanup on startup (this also builds the expiry index and starts the janitor)
 cleanup_old_sessions()
 
 if __name__ == '__main__':
@@ -0,0 +1,77 @@
+"""
+Benchmark PNG encoding in extract_objects across worker counts and
+compression settings, on images with many instances. Example:
+
+    python benchmarks/bench_encode.py --size 3000x2000 --objects 60 --workers 1 2 4 8
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from common import synthetic_image, synthetic_results
+
+
+def run(image_path, results, workers, compress_level, fast_encode, repeat):
+    from utils.segmentation import extract_objects
+
+    timings = []
+    total_bytes = 0
+    for _ in range(repeat):
+        out_dir = tempfile.mkdtemp()
+        try:
+            start = time.perf_counter()
+            files = extract_objects(image_path, results, out_dir, workers=workers,
+                                    compress_level=compress_level, fast_encode=fast_encode)
+            timings.append(time.perf_counter() - start)
+            total_bytes = sum(os.path.getsize(f) for f in files)
+        finally:
+            shutil.rmtree(out_dir)
+    return min(timings), total_bytes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--size", default="3000x2000")
+    parser.add_argument("--objects", type=int, default=60)
+    parser.add_argument("--workers", nargs="+", type=int, default=[1, 2, 4])
+    parser.add_argument("--levels", nargs="+", type=int, default=[6])
+    parser.add_argument("--repeat", type=int, default=2)
+    parser.add_argument("--json", action="store_true", help="emit one JSON object per line")
+    args = parser.parse_args()
+
+    w, h = (int(v) for v in args.size.split("x"))
+    work_dir = tempfile.mkdtemp()
+    try:
+        image_path = os.path.join(work_dir, "source.png")
+        synthetic_image(w, h).save(image_path)
+        results = synthetic_results(w, h, args.objects)
+
+        configs = [(workers, level, False) for level in args.levels for workers in args.workers]
+        configs += [(workers, None, True) for workers in args.workers]
+
+        rows = []
+        for workers, level, fast in configs:
+            best, size = run(image_path, results, workers, level, fast, args.repeat)
+            rows.append({'size': args.size, 'objects': args.objects, 'workers': workers,
+                         'compress_level': 1 if fast else level, 'fast_encode': fast,
+                         'best_s': best, 'output_mb': size / 2 ** 20})
+    finally:
+        shutil.rmtree(work_dir)
+
+    if args.json:
+        for row in rows:
+            print(json.dumps(row))
+        return
+
+    baseline = rows[0]['best_s']
+    print(f"{'workers':>7} {'level':>5} {'fast':>5} {'best (s)':>9} {'output MB':>10} {'speedup':>8}")
+    for row in rows:
+        print(f"{row['workers']:>7} {row['compress_level']:>5} {str(row['fast_encode']):>5} "
+              f"{row['best_s']:>9.3f} {row['output_mb']:>10.1f} {baseline / row['best_s']:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
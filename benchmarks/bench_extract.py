@@ -0,0 +1,118 @@
+"""
+Benchmark extract_objects against the pre-vectorization reference.
+
+Each (implementation, case) pair runs in a fresh subprocess so peak RSS is not
+polluted by earlier runs. Example:
+
+    python benchmarks/bench_extract.py --sizes 2000x1500 4000x3000 --objects 30 100
+
+Use --mask-scale below 1 to model masks coming back from a downscaled
+inference copy; those are resized to the image, which is where ROI-only
+upsampling pays off.
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from common import (
+    current_rss, peak_rss, reference_extract_objects, synthetic_image, synthetic_results,
+)
+
+
+def prepare_case(case_dir, width, height, objects, mask_scale=1.0):
+    """Write the source image and results to disk so the measured process only loads them."""
+    os.makedirs(case_dir, exist_ok=True)
+    synthetic_image(width, height).save(os.path.join(case_dir, "source.png"))
+    mask_size = (max(1, round(width * mask_scale)), max(1, round(height * mask_scale)))
+    with open(os.path.join(case_dir, "results.json"), "w") as f:
+        json.dump(synthetic_results(width, height, objects, mask_size=mask_size), f)
+
+
+def run_case(impl, case_dir, repeat, skip_encode=False):
+    from PIL import Image
+    from utils.segmentation import extract_objects
+
+    if skip_encode:
+        # Isolate the extraction engine from PNG deflate, which both share
+        Image.Image.save = lambda self, *args, **kwargs: None
+
+    func = reference_extract_objects if impl == "reference" else extract_objects
+    image_path = os.path.join(case_dir, "source.png")
+    with open(os.path.join(case_dir, "results.json")) as f:
+        results = json.load(f)
+
+    timings = []
+    rss_before = current_rss()
+    for _ in range(repeat):
+        out_dir = tempfile.mkdtemp(dir=case_dir)
+        start = time.perf_counter()
+        func(image_path, results, out_dir)
+        timings.append(time.perf_counter() - start)
+        shutil.rmtree(out_dir)
+    return {
+        'impl': impl,
+        'best_s': min(timings),
+        'mean_s': sum(timings) / len(timings),
+        'peak_rss_delta_mb': max(0, peak_rss() - rss_before) / 2 ** 20,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", nargs="+", default=["1600x1200", "3000x2000"])
+    parser.add_argument("--objects", nargs="+", type=int, default=[30, 100])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--mask-scale", type=float, default=1.0,
+                        help="mask resolution relative to the image (e.g. 0.25 for downscaled inference)")
+    parser.add_argument("--skip-encode", action="store_true", help="measure extraction without PNG encoding")
+    parser.add_argument("--json", action="store_true", help="emit one JSON object per line")
+    parser.add_argument("--worker", nargs=2, metavar=("IMPL", "CASE_DIR"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        impl, case_dir = args.worker
+        print(json.dumps(run_case(impl, case_dir, args.repeat, args.skip_encode)))
+        return
+
+    rows = []
+    work_dir = tempfile.mkdtemp()
+    try:
+        for size in args.sizes:
+            w, h = (int(v) for v in size.split("x"))
+            for n in args.objects:
+                case_dir = os.path.join(work_dir, f"{size}_{n}")
+                prepare_case(case_dir, w, h, n, args.mask_scale)
+                for impl in ("reference", "vectorized"):
+                    cmd = [sys.executable, __file__, "--repeat", str(args.repeat), "--worker", impl, case_dir]
+                    if args.skip_encode:
+                        cmd.append("--skip-encode")
+                    out = subprocess.run(
+                        cmd,
+                        check=True, capture_output=True, text=True,
+                    )
+                    row = json.loads(out.stdout.strip().splitlines()[-1])
+                    row.update(size=size, objects=n)
+                    rows.append(row)
+    finally:
+        shutil.rmtree(work_dir)
+
+    if args.json:
+        for row in rows:
+            print(json.dumps(row))
+        return
+
+    print(f"{'size':>10} {'objs':>5} {'impl':>11} {'best (s)':>9} {'peak RSS +MB':>13} {'speedup':>8}")
+    for ref, new in zip(rows[::2], rows[1::2]):
+        for row in (ref, new):
+            speedup = ref['best_s'] / row['best_s']
+            print(f"{row['size']:>10} {row['objects']:>5} {row['impl']:>11} "
+                  f"{row['best_s']:>9.3f} {row['peak_rss_delta_mb']:>13.1f} {speedup:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+"""
+End-to-end benchmark of the HTTP pipeline against a local stub of the
+inference endpoint (benchmarks/stub_server.py), so the real RemoteBackend and
+InferenceClient are used but no token or network is needed. Example:
+
+    python benchmarks/bench_pipeline.py --sizes 1024x768 3000x2000 --objects 5 30 \\
+        --iterations 20 --latency 0.2 --output pipeline.json
+
+For every (size, objects) case a fresh process uploads a synthetic photo
+`--iterations` times, downloads the objects ZIP, applies a /refine erase and
+downloads the refined object. Reported per stage: p50/p99/mean latency,
+throughput and the peak RSS reached during that stage. The server-side spans
+of each request (segment_image, inference, extract_objects, ... from the
+Server-Timing header) are reported as stages of their own.
+
+`--concurrency N` adds a phase with N client threads uploading at once.
+`--compare OLD.json` prints each stage's p50 against an earlier --output file,
+e.g. one produced on the previous commit.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from common import current_rss, peak_rss, reset_peak_rss, synthetic_image
+from stub_server import start_stub
+
+# Server-side spans that come back in the Server-Timing header
+SERVER_STAGES = ("upload_file", "segment_image", "inference", "extract_objects", "composite_objects",
+                 "refine_segmentation")
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else None
+
+
+def summarize(samples, peaks):
+    """Per-stage statistics from {stage: [seconds]} and {stage: peak bytes}."""
+    rows = []
+    for stage, values in samples.items():
+        rows.append({
+            'stage': stage,
+            'n': len(values),
+            'p50_ms': percentile(values, 50) * 1000,
+            'p99_ms': percentile(values, 99) * 1000,
+            'mean_ms': sum(values) / len(values) * 1000,
+            'throughput_per_s': len(values) / sum(values) if sum(values) else None,
+            'peak_rss_mb': peaks[stage] / 2 ** 20 if stage in peaks else None,
+        })
+    return rows
+
+
+def server_timing(response):
+    """{stage: seconds} parsed from a Server-Timing header."""
+    spans = {}
+    for item in response.headers.get('Server-Timing', '').split(','):
+        name, _, duration = item.strip().partition(';dur=')
+        if name in SERVER_STAGES and duration:
+            spans[name] = spans.get(name, 0.0) + float(duration) / 1000
+    return spans
+
+
+def erase_payload(width, height, seed):
+    """Binary /refine body erasing a disc somewhere inside a width x height object."""
+    from utils.refine import encode_binary_mask
+
+    rng = np.random.default_rng(seed)
+    radius = max(1, min(width, height) // 6)
+    cx, cy = int(rng.integers(0, width)), int(rng.integers(0, height))
+    x0, y0 = max(0, cx - radius), max(0, cy - radius)
+    x1, y1 = min(width, cx + radius), min(height, cy + radius)
+    yy, xx = np.mgrid[y0:y1, x0:x1]
+    erase = (xx - cx) ** 2 + (yy - cy) ** 2 <= radius ** 2
+    return encode_binary_mask(erase, x0, y0)
+
+
+def run_case(image_path, iterations, concurrency):
+    """Runs in the worker process; SEG_API_URL etc. are already set."""
+    from PIL import Image
+    from app import app
+
+    app.config['TESTING'] = True
+    client = app.test_client()
+    with open(image_path, "rb") as f:
+        image_bytes = f.read()
+
+    samples = {}
+    peaks = {}
+
+    def measure(stage, fn):
+        reset_peak_rss()
+        start = time.perf_counter()
+        response = fn()
+        samples.setdefault(stage, []).append(time.perf_counter() - start)
+        peaks[stage] = max(peaks.get(stage, 0), peak_rss())
+        for name, seconds in server_timing(response).items():
+            samples.setdefault(name, []).append(seconds)
+        if response.status_code != 200:
+            raise RuntimeError(f"{stage}: HTTP {response.status_code} {response.get_data(as_text=True)[:200]}")
+        return response
+
+    def upload():
+        return client.post('/upload', data={'file': (io.BytesIO(image_bytes), 'bench.png')},
+                           content_type='multipart/form-data')
+
+    baseline_rss = current_rss()
+    objects = 0
+    for i in range(iterations):
+        result = measure('upload', upload).get_json()
+        session_id, files = result['session_id'], result['files']
+        objects = len(files)
+
+        # Consuming the body runs the streaming ZIP generator
+        measure('download_zip', lambda: client.get(f"/download/{session_id}/{result['zip_file']}"))
+
+        target = files[0]
+        obj = client.get(f"/download/{session_id}/{target}").get_data()
+        width, height = Image.open(io.BytesIO(obj)).size
+        body = erase_payload(width, height, seed=i)
+        measure('refine', lambda: client.post(
+            f"/refine?session_id={session_id}&filename={target}",
+            data=body, content_type='application/octet-stream'))
+        # Refinements are encoded on the next download
+        measure('download_refined', lambda: client.get(f"/download/{session_id}/{target}"))
+        client.post(f"/cleanup/{session_id}")
+
+    rows = summarize(samples, peaks)
+
+    if concurrency > 1:
+        latencies = []
+        errors = []
+        lock = threading.Lock()
+
+        def worker():
+            thread_client = app.test_client()
+            for _ in range(iterations):
+                start = time.perf_counter()
+                response = thread_client.post('/upload', data={'file': (io.BytesIO(image_bytes), 'bench.png')},
+                                              content_type='multipart/form-data')
+                with lock:
+                    latencies.append(time.perf_counter() - start)
+                    if response.status_code != 200:
+                        errors.append(response.status_code)
+
+        reset_peak_rss()
+        start = time.perf_counter()
+        threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+        row = summarize({f'upload_x{concurrency}': latencies}, {f'upload_x{concurrency}': peak_rss()})[0]
+        # Wall-clock throughput, not the sum of per-request latencies
+        row['throughput_per_s'] = len(latencies) / elapsed
+        row['errors'] = len(errors)
+        rows.append(row)
+
+    for row in rows:
+        row['objects_returned'] = objects
+        row['baseline_rss_mb'] = baseline_rss / 2 ** 20
+    return rows
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_table(rows, baseline=None):
+    previous = {}
+    for row in (baseline or {}).get('results', []):
+        previous[(row['size'], row['objects'], row['stage'])] = row
+    header = f"{'size':>10} {'objs':>5} {'stage':>20} {'n':>4} {'p50 ms':>9} {'p99 ms':>9} {'per s':>8} {'peak MB':>8}"
+    if baseline:
+        header += f" {'p50 vs old':>11}"
+    print(header)
+    for row in rows:
+        peak = f"{row['peak_rss_mb']:.1f}" if row['peak_rss_mb'] is not None else '-'
+        line = (f"{row['size']:>10} {row['objects']:>5} {row['stage']:>20} {row['n']:>4} "
+                f"{row['p50_ms']:>9.1f} {row['p99_ms']:>9.1f} {row['throughput_per_s'] or 0:>8.2f} {peak:>8}")
+        if baseline:
+            old = previous.get((row['size'], row['objects'], row['stage']))
+            line += f" {row['p50_ms'] / old['p50_ms']:>10.2f}x" if old and old['p50_ms'] else f" {'-':>11}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", nargs="+", default=["1024x768", "3000x2000"])
+    parser.add_argument("--objects", nargs="+", type=int, default=[5, 30])
+    parser.add_argument("--iterations", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.0, help="stub inference latency (seconds)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="uniform +/- seconds on the stub latency")
+    parser.add_argument("--mask-scale", type=float, default=1.0, help="stub mask resolution relative to the image")
+    parser.add_argument("--concurrency", type=int, default=1, help="client threads for the throughput phase")
+    parser.add_argument("--session-store", choices=["filesystem", "memory"], default="filesystem")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--compare", help="JSON file from an earlier --output run")
+    parser.add_argument("--json", action="store_true", help="emit one JSON object per line")
+    parser.add_argument("--worker", nargs=3, metavar=("IMAGE", "ITERATIONS", "CONCURRENCY"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        image_path, iterations, concurrency = args.worker
+        print(json.dumps(run_case(image_path, int(iterations), int(concurrency))))
+        return
+
+    rows = []
+    work_dir = tempfile.mkdtemp()
+    try:
+        for size in args.sizes:
+            w, h = (int(v) for v in size.split("x"))
+            image_path = os.path.join(work_dir, f"{size}.png")
+            synthetic_image(w, h).save(image_path)
+            for n in args.objects:
+                stub = start_stub(objects=n, latency=args.latency, jitter=args.jitter, mask_scale=args.mask_scale)
+                env = dict(
+                    os.environ,
+                    SEG_BACKEND="remote",
+                    SEG_API_URL=stub.url,
+                    SEG_CACHE_DISABLED="1",
+                    SESSION_STORE=args.session_store,
+                    TMPDIR=work_dir,
+                )
+                try:
+                    out = subprocess.run(
+                        [sys.executable, __file__, "--worker", image_path, str(args.iterations), str(args.concurrency)],
+                        check=True, capture_output=True, text=True, env=env,
+                    )
+                finally:
+                    stub.shutdown()
+                    stub.server_close()
+                for row in json.loads(out.stdout.strip().splitlines()[-1]):
+                    row.update(size=size, objects=n)
+                    rows.append(row)
+    finally:
+        shutil.rmtree(work_dir)
+
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'settings': {k: v for k, v in vars(args).items() if k not in ('output', 'compare', 'json', 'worker')},
+        'results': rows,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.json:
+        for row in rows:
+            print(json.dumps(row))
+        return
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_table(rows, baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+Shared helpers for the benchmark scripts: synthetic inputs, the pre-optimization
+reference implementation and a peak-RSS probe.
+
+Run the scripts from the repository root, e.g. `python benchmarks/bench_extract.py`.
+"""
+import base64
+import io
+import os
+import resource
+import sys
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+LABELS = ["person", "car", "dog", "cat", "chair", "bottle", "cup", "bicycle"]
+
+
+def synthetic_image(width, height, seed=0):
+    """Photo-like RGB image: smooth gradients plus noise (so PNG/JPEG sizes are realistic)."""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    base = np.stack([
+        127 + 100 * np.sin(x / 97.0),
+        127 + 100 * np.cos(y / 61.0),
+        127 + 100 * np.sin((x + y) / 143.0),
+    ], axis=-1)
+    noise = rng.normal(0, 12, size=base.shape)
+    return Image.fromarray(np.clip(base + noise, 0, 255).astype(np.uint8), "RGB")
+
+
+def synthetic_results(width, height, count, seed=0, mask_size=None):
+    """
+    mask2former-style standardized results: `count` ellipses covering 0.5-8%
+    of the frame each, encoded as base64 PNG masks at `mask_size` (defaults to
+    the image size, which is what the HF API returns).
+    """
+    rng = np.random.default_rng(seed)
+    mw, mh = mask_size or (width, height)
+    results = []
+    for i in range(count):
+        area = rng.uniform(0.005, 0.08) * mw * mh
+        aspect = rng.uniform(0.5, 2.0)
+        w = max(2, int(np.sqrt(area * aspect)))
+        h = max(2, int(area / w))
+        x0 = int(rng.integers(0, max(1, mw - w)))
+        y0 = int(rng.integers(0, max(1, mh - h)))
+        mask = Image.new("L", (mw, mh), 0)
+        ImageDraw.Draw(mask).ellipse((x0, y0, x0 + w, y0 + h), fill=255)
+        buf = io.BytesIO()
+        mask.save(buf, format="PNG")
+        results.append({
+            'score': round(float(rng.uniform(0.5, 1.0)), 4),
+            'label': LABELS[i % len(LABELS)],
+            'mask': base64.b64encode(buf.getvalue()).decode("utf-8"),
+        })
+    return results
+
+
+def reference_extract_objects(image_path, segmentation_results, output_dir):
+    """extract_objects as it was before vectorization (full-frame copy per object)."""
+    original_image = Image.open(image_path).convert("RGBA")
+    extracted_files = []
+    for i, obj in enumerate(segmentation_results):
+        label = obj.get('label', 'object')
+        mask_image = Image.open(io.BytesIO(base64.b64decode(obj['mask']))).convert("L")
+        if mask_image.size != original_image.size:
+            mask_image = mask_image.resize(original_image.size, Image.LANCZOS)
+        mask_arr = np.array(mask_image)
+        mask_arr = np.where(mask_arr < 10, 0, mask_arr)
+        mask_image = Image.fromarray(mask_arr)
+        object_img = original_image.copy()
+        object_img.putalpha(mask_image)
+        bbox = object_img.getbbox()
+        if bbox:
+            object_img = object_img.crop(bbox)
+            filepath = os.path.join(output_dir, f"{label}_{i+1}.png")
+            object_img.save(filepath, format="PNG")
+            extracted_files.append(filepath)
+    return extracted_files
+
+
+def current_rss():
+    """Resident set size of this process in bytes (Linux)."""
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+
+def peak_rss():
+    """
+    High-water resident set size of this process in bytes. On Linux this reads
+    VmHWM, because ru_maxrss survives exec and would include the parent's peak.
+    """
+    if os.path.exists("/proc/self/status"):
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def reset_peak_rss():
+    """
+    Reset the VmHWM high-water mark to the current RSS (Linux), so peak_rss()
+    afterwards reports the peak of the next stage only. Returns False where
+    that is not supported, in which case peaks are cumulative.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
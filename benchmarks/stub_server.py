@@ -0,0 +1,118 @@
+"""
+Local stand-in for the Hugging Face inference endpoint. It answers every POST
+with synthetic mask2former-style results for the posted image's size, after a
+configurable delay, so the real RemoteBackend/InferenceClient path (pooling,
+retries, timeouts) can be exercised without a token or network. Example:
+
+    python benchmarks/stub_server.py --port 8765 --objects 20 --latency 0.3
+    SEG_API_URL=http://127.0.0.1:8765 python app.py
+"""
+import argparse
+import io
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image
+
+from common import synthetic_results
+
+
+class StubInferenceServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, objects=10, latency=0.0, jitter=0.0, mask_scale=1.0, error_rate=0.0, seed=0):
+        super().__init__(address, StubHandler)
+        self.objects = objects
+        self.latency = latency
+        self.jitter = jitter
+        self.mask_scale = mask_scale
+        self.error_rate = error_rate
+        self.requests = 0
+        self._random = random.Random(seed)
+        self._responses = {}
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def response_for(self, size):
+        """JSON body for an image of `size`; generated once per size, as masks are the slow part."""
+        with self._lock:
+            body = self._responses.get(size)
+        if body is None:
+            width, height = size
+            mask_size = (max(1, round(width * self.mask_scale)), max(1, round(height * self.mask_scale)))
+            body = json.dumps(synthetic_results(width, height, self.objects, mask_size=mask_size)).encode()
+            with self._lock:
+                self._responses[size] = body
+        return body
+
+    def delay(self):
+        with self._lock:
+            self.requests += 1
+            return max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter)), \
+                self._random.random() < self.error_rate
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        delay, fail = self.server.delay()
+        time.sleep(delay)
+        if fail:
+            self._reply(503, b'{"error": "Model is currently loading"}')
+            return
+        try:
+            size = Image.open(io.BytesIO(data)).size
+        except Exception:
+            self._reply(400, b'{"error": "Cannot identify image"}')
+            return
+        # The API answers for the image it was sent, which may be a downscaled copy
+        self._reply(200, self.server.response_for(size))
+
+    def _reply(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub(port=0, **kwargs):
+    """Run a StubInferenceServer on a background thread; returns the server (see .url, .shutdown())."""
+    server = StubInferenceServer(("127.0.0.1", port), **kwargs)
+    threading.Thread(target=server.serve_forever, name="stub-inference", daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--objects", type=int, default=10, help="instances per response")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds before each response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="uniform +/- seconds added to the latency")
+    parser.add_argument("--mask-scale", type=float, default=1.0, help="mask resolution relative to the posted image")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with 503")
+    args = parser.parse_args()
+
+    server = StubInferenceServer(("127.0.0.1", args.port), objects=args.objects, latency=args.latency,
+                                 jitter=args.jitter, mask_scale=args.mask_scale, error_rate=args.error_rate)
+    print(f"Stub inference endpoint on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
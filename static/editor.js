@@ -10,6 +10,7 @@ class ImageEditor {
         this.maskCanvas = document.createElement('canvas'); // For storing strokes
         this.maskCtx = this.maskCanvas.getContext('2d');
         this.scale = 1;
+        this.dirty = null; // Bounding box of all strokes: {x0, y0, x1, y1}
 
         // Bind events
         this.canvas.addEventListener('mousedown', this.startDrawing.bind(this));
@@ -68,6 +69,7 @@ class ImageEditor {
             // Reset history
             this.history = [];
             this.redoStack = [];
+            this.dirty = null;
 
             this.render();
         };
@@ -108,6 +110,7 @@ class ImageEditor {
         this.maskCtx.moveTo(this.lastX, this.lastY);
         this.maskCtx.lineTo(x, y);
         this.maskCtx.stroke();
+        this.extendDirty(this.lastX, this.lastY, x, y);
 
         [this.lastX, this.lastY] = [x, y];
 
@@ -115,6 +118,22 @@ class ImageEditor {
         this.render();
     }
 
+    extendDirty(ax, ay, bx, by) {
+        // Brush radius plus a pixel of anti-aliasing
+        const pad = this.brushSize / 2 + 1;
+        const box = {
+            x0: Math.min(ax, bx) - pad, y0: Math.min(ay, by) - pad,
+            x1: Math.max(ax, bx) + pad, y1: Math.max(ay, by) + pad
+        };
+        if (this.dirty) {
+            box.x0 = Math.min(box.x0, this.dirty.x0);
+            box.y0 = Math.min(box.y0, this.dirty.y0);
+            box.x1 = Math.max(box.x1, this.dirty.x1);
+            box.y1 = Math.max(box.y1, this.dirty.y1);
+        }
+        this.dirty = box;
+    }
+
     stopDrawing() {
         this.isDrawing = false;
     }
@@ -198,4 +217,67 @@ class ImageEditor {
     getMask() {
         return this.maskCanvas.toDataURL('image/png');
     }
+
+    // Pixel bounds of the area strokes touched, clipped to the canvas, or null
+    getDirtyRect() {
+        if (!this.dirty) return null;
+        const x0 = Math.max(0, Math.floor(this.dirty.x0));
+        const y0 = Math.max(0, Math.floor(this.dirty.y0));
+        const x1 = Math.min(this.maskCanvas.width, Math.ceil(this.dirty.x1));
+        const y1 = Math.min(this.maskCanvas.height, Math.ceil(this.dirty.y1));
+        if (x1 <= x0 || y1 <= y0) return null;
+        return [x0, y0, x1 - x0, y1 - y0];
+    }
+
+    // Binary /refine body for the dirty rect (format in utils/refine.py), or null.
+    // A pixel is erased when PIL's L conversion of it is above 10, exactly as
+    // when the server decodes a PNG of the mask.
+    getMaskPayload() {
+        const rect = this.getDirtyRect();
+        if (!rect) return null;
+        const [x, y, w, h] = rect;
+        const pixels = this.maskCtx.getImageData(x, y, w, h).data;
+
+        const bits = new Uint8Array(Math.ceil(w * h / 8));
+        const runs = [];
+        let current = 0;
+        let run = 0;
+        for (let i = 0, p = 0; i < w * h; i++, p += 4) {
+            const l = (pixels[p] * 19595 + pixels[p + 1] * 38470 + pixels[p + 2] * 7471 + 0x8000) >>> 16;
+            const bit = l > 10 ? 1 : 0;
+            if (bit) bits[i >> 3] |= 0x80 >> (i & 7);
+            if (bit === current) {
+                run++;
+            } else {
+                runs.push(run);
+                current = bit;
+                run = 1;
+            }
+        }
+        runs.push(run);
+
+        const rle = [];
+        for (let value of runs) {
+            while (value >= 0x80) {
+                rle.push((value & 0x7f) | 0x80);
+                value = Math.floor(value / 128);
+            }
+            rle.push(value);
+        }
+
+        // Whichever encoding is smaller: RLE for strokes, bits for dense masks
+        const useRle = rle.length < bits.length;
+        const payload = useRle ? Uint8Array.from(rle) : bits;
+        const body = new Uint8Array(19 + payload.length);
+        const view = new DataView(body.buffer);
+        body[0] = 0x52; // 'R'
+        body[1] = 0x4d; // 'M'
+        body[2] = useRle ? 1 : 0;
+        view.setUint32(3, x, true);
+        view.setUint32(7, y, true);
+        view.setUint32(11, w, true);
+        view.setUint32(15, h, true);
+        body.set(payload, 19);
+        return body;
+    }
 }
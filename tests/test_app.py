@@ -4,14 +4,19 @@ import shutil
 import tempfile
 import io
 import base64
+import json
+import zipfile
+import threading
+import time
 from PIL import Image, ImageDraw
+import numpy as np
 import sys
 import unittest.mock
 
 # Add parent directory to path to import app
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from app import app
+from app import app, get_session_store
 from utils import segmentation
 
 class TestInstanceSegmentationApp(unittest.TestCase):
@@ -77,5 +82,320 @@ class TestInstanceSegmentationApp(unittest.TestCase):
             self.assertTrue(len(json_data['files']) > 0)
             self.assertIn('zip_file', json_data)
 
+    def upload_with_mock(self, mock_response):
+        with unittest.mock.patch('app.segment_image', return_value=mock_response):
+            data = {'file': (self.create_test_image(), 'test.png')}
+            response = self.client.post('/upload', data=data, content_type='multipart/form-data')
+        self.assertEqual(response.status_code, 200)
+        return response.get_json()
+
+    def make_mask_b64(self, box):
+        mask_img = Image.new('L', (200, 200), 0)
+        ImageDraw.Draw(mask_img).rectangle(box, fill=255)
+        buf = io.BytesIO()
+        mask_img.save(buf, format='PNG')
+        return base64.b64encode(buf.getvalue()).decode('utf-8')
+
+    def test_zip_is_streamed_on_demand(self):
+        json_data = self.upload_with_mock([
+            {'label': 'circle', 'score': 0.9, 'mask': self.make_mask_b64((50, 50, 150, 150))},
+            {'label': 'square', 'score': 0.8, 'mask': self.make_mask_b64((10, 10, 40, 40))},
+        ])
+        session_dir = os.path.join(app.config['UPLOAD_FOLDER'], 'instance_seg_app', json_data['session_id'])
+        # Nothing is archived during upload
+        self.assertFalse(os.path.exists(os.path.join(session_dir, json_data['zip_file'])))
+
+        response = self.client.get(f"/download/{json_data['session_id']}/{json_data['zip_file']}")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/zip')
+        self.assertTrue(response.is_streamed)
+
+        with zipfile.ZipFile(io.BytesIO(response.get_data())) as zipf:
+            self.assertEqual(zipf.namelist(), json_data['files'])
+            self.assertTrue(all(i.compress_type == zipfile.ZIP_STORED for i in zipf.infolist()))
+            self.assertIsNone(zipf.testzip())
+            with open(os.path.join(session_dir, 'circle_1.png'), 'rb') as f:
+                self.assertEqual(zipf.read('circle_1.png'), f.read())
+
+    def test_async_upload_reports_progress(self):
+        mock_response = [
+            {'label': 'circle', 'score': 0.9, 'mask': self.make_mask_b64((50, 50, 150, 150))},
+            {'label': 'square', 'score': 0.8, 'mask': self.make_mask_b64((10, 10, 40, 40))},
+        ]
+        with unittest.mock.patch('app.segment_image', return_value=mock_response):
+            data = {'file': (self.create_test_image(), 'test.png'), 'async': '1'}
+            response = self.client.post('/upload', data=data, content_type='multipart/form-data')
+            self.assertEqual(response.status_code, 202)
+            accepted = response.get_json()
+
+            # The SSE stream ends after the final event, so reading it waits for the job
+            events = self.client.get(accepted['events_url'])
+            self.assertEqual(events.mimetype, 'text/event-stream')
+            body = events.get_data(as_text=True)
+
+        event_types = [line.split(': ', 1)[1] for line in body.splitlines() if line.startswith('event: ')]
+        self.assertEqual(event_types[0], 'stage')
+        self.assertEqual(event_types.count('object'), 2)
+        self.assertEqual(event_types[-1], 'done')
+
+        status = self.client.get(accepted['status_url']).get_json()
+        self.assertEqual(status['status'], 'done')
+        self.assertEqual(status['result']['session_id'], accepted['session_id'])
+        self.assertEqual(sorted(status['files']), sorted(status['result']['files']))
+
+        download = self.client.get(f"/download/{accepted['session_id']}/circle_1.png")
+        self.assertEqual(download.status_code, 200)
+
+    def test_async_upload_failure(self):
+        with unittest.mock.patch('app.segment_image', side_effect=Exception('boom')):
+            data = {'file': (self.create_test_image(), 'test.png'), 'async': '1'}
+            accepted = self.client.post('/upload', data=data, content_type='multipart/form-data').get_json()
+            body = self.client.get(accepted['events_url']).get_data(as_text=True)
+
+        self.assertIn('event: error', body)
+        status = self.client.get(accepted['status_url']).get_json()
+        self.assertEqual(status['status'], 'error')
+        self.assertIn('boom', status['error'])
+
+    def test_batch_upload_files_and_zip(self):
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, 'w') as zipf:
+            zipf.writestr('shots/b.png', self.create_test_image().getvalue())
+            zipf.writestr('__MACOSX/shots/._b.png', b'junk')
+            zipf.writestr('notes.txt', b'ignored')
+        archive.seek(0)
+
+        mock_response = [{'label': 'circle', 'score': 0.9, 'mask': self.make_mask_b64((50, 50, 150, 150))}]
+        with unittest.mock.patch('app.segment_image', return_value=mock_response):
+            data = {'files': [(self.create_test_image(), 'a.png'),
+                              (self.create_test_image(), 'b.png'),
+                              (archive, 'more.zip')]}
+            response = self.client.post('/upload_batch', data=data, content_type='multipart/form-data')
+
+        self.assertEqual(response.status_code, 200)
+        json_data = response.get_json()
+        self.assertEqual([i['image'] for i in json_data['images']], ['a.png', 'b.png', 'b_2.png'])
+        self.assertEqual(json_data['images'][0]['files'], ['a__circle_1.png'])
+        self.assertEqual(len(json_data['files']), 3)
+
+        zip_response = self.client.get(f"/download/{json_data['session_id']}/{json_data['zip_file']}")
+        with zipfile.ZipFile(io.BytesIO(zip_response.get_data())) as zipf:
+            self.assertEqual(zipf.namelist(), ['a/circle_1.png', 'b/circle_1.png', 'b_2/circle_1.png'])
+
+    def test_batch_upload_is_concurrent(self):
+        mask = self.make_mask_b64((50, 50, 150, 150))
+        lock = threading.Lock()
+        state = {'active': 0, 'peak': 0}
+
+        def slow_segment(*args, **kwargs):
+            with lock:
+                state['active'] += 1
+                state['peak'] = max(state['peak'], state['active'])
+            time.sleep(0.1)
+            with lock:
+                state['active'] -= 1
+            return [{'label': 'circle', 'score': 0.9, 'mask': mask}]
+
+        app.config['BATCH_CONCURRENCY'] = 3
+        try:
+            with unittest.mock.patch('app.segment_image', side_effect=slow_segment):
+                data = {'files': [(self.create_test_image(), f'img{i}.png') for i in range(6)]}
+                response = self.client.post('/upload_batch', data=data, content_type='multipart/form-data')
+        finally:
+            app.config['BATCH_CONCURRENCY'] = 8
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(state['peak'], 3)
+        self.assertEqual(len(response.get_json()['files']), 6)
+
+    def test_batch_upload_partial_failure(self):
+        mask = self.make_mask_b64((50, 50, 150, 150))
+
+        bad_image = io.BytesIO()
+        Image.new('RGB', (200, 200), color='black').save(bad_image, format='PNG')
+
+        def segment(data, *args, **kwargs):
+            if data == bad_image.getvalue():
+                raise Exception('backend error')
+            return [{'label': 'circle', 'score': 0.9, 'mask': mask}]
+
+        with unittest.mock.patch('app.segment_image', side_effect=segment):
+            data = {'files': [(self.create_test_image(), 'good.png'), (io.BytesIO(bad_image.getvalue()), 'bad.png')]}
+            json_data = self.client.post('/upload_batch', data=data, content_type='multipart/form-data').get_json()
+
+        self.assertEqual(json_data['images'][1]['error'], 'backend error')
+        self.assertEqual(json_data['files'], ['good__circle_1.png'])
+
+    def test_batch_upload_requires_images(self):
+        data = {'files': [(io.BytesIO(b'fake'), 'test.txt')]}
+        response = self.client.post('/upload_batch', data=data, content_type='multipart/form-data')
+        self.assertEqual(response.status_code, 400)
+
+    def test_memory_session_store(self):
+        app.config['SESSION_STORE'] = 'memory'
+        try:
+            json_data = self.upload_with_mock([
+                {'label': 'circle', 'score': 0.9, 'mask': self.make_mask_b64((50, 50, 150, 150))},
+            ])
+            session_id = json_data['session_id']
+            # Nothing touches the upload folder
+            self.assertFalse(os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], 'instance_seg_app')))
+
+            response = self.client.get(f"/download/{session_id}/circle_1.png")
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(Image.open(io.BytesIO(response.data)).size, (101, 101))
+
+            mask = Image.new('L', (101, 101), 255)
+            buf = io.BytesIO()
+            mask.save(buf, format='PNG')
+            response = self.client.post('/refine', json={
+                'session_id': session_id,
+                'filename': 'circle_1.png',
+                'mask': base64.b64encode(buf.getvalue()).decode('utf-8'),
+            })
+            self.assertEqual(response.status_code, 200)
+
+            response = self.client.get(f"/download/{session_id}/{json_data['zip_file']}")
+            with zipfile.ZipFile(io.BytesIO(response.data)) as archive:
+                self.assertEqual(archive.namelist(), ['circle_1.png'])
+                refined = Image.open(io.BytesIO(archive.read('circle_1.png')))
+                self.assertEqual(refined.getchannel('A').getextrema(), (0, 0))
+
+            self.assertEqual(self.client.get(f"/download/{session_id}/missing.png").status_code, 404)
+        finally:
+            app.config['SESSION_STORE'] = 'filesystem'
+
+    def test_session_stats(self):
+        json_data = self.upload_with_mock([
+            {'label': 'circle', 'score': 0.9, 'mask': self.make_mask_b64((50, 50, 150, 150))},
+        ])
+        stats = self.client.get('/sessions/stats').get_json()
+        self.assertEqual(stats['sessions'], 1)
+        session_dir = os.path.join(app.config['UPLOAD_FOLDER'], 'instance_seg_app', json_data['session_id'])
+        self.assertEqual(stats['bytes'], sum(os.path.getsize(os.path.join(session_dir, f)) for f in os.listdir(session_dir)))
+
+    def test_reextract_without_model(self):
+        results = [
+            {'label': 'circle', 'score': 0.9, 'mask': self.make_mask_b64((50, 50, 150, 150))},
+            {'label': 'square', 'score': 0.3, 'mask': self.make_mask_b64((10, 10, 40, 40))},
+        ]
+        with unittest.mock.patch('app.segment_image', return_value=results) as segment:
+            data = {'file': (self.create_test_image(), 'test.png')}
+            session_id = self.client.post('/upload', data=data, content_type='multipart/form-data').get_json()['session_id']
+
+            response = self.client.post('/reextract', json={'session_id': session_id, 'min_score': 0.5})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.get_json()['files'], ['circle_1.png'])
+
+            response = self.client.post('/reextract', json={'session_id': session_id, 'labels': ['square'], 'feather': 2})
+            self.assertEqual(response.get_json()['files'], ['square_2.png'])
+            self.assertEqual(segment.call_count, 1)
+
+        # The ZIP follows the new object list
+        response = self.client.get(f"/download/{session_id}/objects_{session_id}.zip")
+        with zipfile.ZipFile(io.BytesIO(response.data)) as archive:
+            self.assertEqual(archive.namelist(), ['square_2.png'])
+            feathered = Image.open(io.BytesIO(archive.read('square_2.png')))
+            self.assertGreater(feathered.size[0], 31)
+
+        self.assertEqual(self.client.post('/reextract', json={'session_id': session_id, 'threshold': 300}).status_code, 400)
+        self.assertEqual(self.client.post('/reextract', json={'session_id': 'missing'}).status_code, 404)
+
+    def test_reextract_drops_refinements(self):
+        json_data = self.upload_with_mock([
+            {'label': 'circle', 'score': 0.9, 'mask': self.make_mask_b64((50, 50, 150, 150))},
+        ])
+        session_id = json_data['session_id']
+        original = self.client.get(f"/download/{session_id}/circle_1.png").data
+        self.client.post('/refine', json={
+            'session_id': session_id, 'filename': 'circle_1.png',
+            'strokes': [{'points': [[50, 50]], 'size': 20}],
+        })
+        self.client.post('/reextract', json={'session_id': session_id})
+
+        response = self.client.get(f"/download/{session_id}/circle_1.png")
+        self.assertEqual(np.array(Image.open(io.BytesIO(response.data))).tolist(),
+                         np.array(Image.open(io.BytesIO(original))).tolist())
+        response = self.client.post('/refine/undo', json={'session_id': session_id, 'filename': 'circle_1.png'})
+        self.assertEqual(response.status_code, 409)
+
+    def test_reextract_batch(self):
+        mask = self.make_mask_b64((50, 50, 150, 150))
+        with unittest.mock.patch('app.segment_image', return_value=[{'label': 'circle', 'score': 0.9, 'mask': mask}]):
+            data = {'files': [(self.create_test_image(), 'a.png'), (self.create_test_image(), 'b.png')]}
+            session_id = self.client.post('/upload_batch', data=data, content_type='multipart/form-data').get_json()['session_id']
+        json_data = self.client.post('/reextract', json={'session_id': session_id, 'threshold': 200}).get_json()
+        self.assertEqual(json_data['files'], ['a__circle_1.png', 'b__circle_1.png'])
+        self.assertEqual([image['image'] for image in json_data['images']], ['a.png', 'b.png'])
+
+    def test_upload_named_like_an_object(self):
+        with unittest.mock.patch('app.segment_image', return_value=[
+            {'label': 'person', 'score': 0.9, 'mask': self.make_mask_b64((50, 50, 150, 150))},
+        ]):
+            data = {'file': (self.create_test_image(), 'person_1.png')}
+            json_data = self.client.post('/upload', data=data, content_type='multipart/form-data').get_json()
+        self.assertEqual(json_data['files'], ['person_1.png'])
+        image = Image.open(io.BytesIO(self.client.get(f"/download/{json_data['session_id']}/person_1.png").data))
+        self.assertEqual(image.mode, 'RGBA')
+        self.assertEqual(image.size, (101, 101))
+
+        mask = self.make_mask_b64((50, 50, 150, 150))
+        with unittest.mock.patch('app.segment_image', return_value=[{'label': 'circle', 'score': 0.9, 'mask': mask}]):
+            data = {'files': [(self.create_test_image(), 'a.png'), (self.create_test_image(), 'a__circle_1.png')]}
+            json_data = self.client.post('/upload_batch', data=data, content_type='multipart/form-data').get_json()
+        self.assertEqual([image['image'] for image in json_data['images']], ['a.png', 'a_circle_1.png'])
+        self.assertEqual(json_data['files'], ['a__circle_1.png', 'a_circle_1__circle_1.png'])
+
+    def test_objects_are_encoded_on_first_use(self):
+        results = [
+            {'label': 'circle', 'score': 0.9, 'mask': self.make_mask_b64((50, 50, 150, 150))},
+            {'label': 'square', 'score': 0.3, 'mask': self.make_mask_b64((10, 10, 40, 40))},
+        ]
+        app.config['LAZY_OBJECTS'] = False
+        try:
+            eager = self.upload_with_mock(results)
+        finally:
+            app.config['LAZY_OBJECTS'] = True
+        lazy = self.upload_with_mock(results)
+        self.assertEqual(lazy['files'], eager['files'])
+
+        store = get_session_store()
+        self.assertEqual([f for f in store.names(eager['session_id']) if f in eager['files']], eager['files'])
+        self.assertEqual([f for f in store.names(lazy['session_id']) if f in lazy['files']], [])
+        descriptors = json.loads(store.get(lazy['session_id'], '_source.png.objects'))
+        self.assertEqual([(d['file'], d['label'], d['bbox']) for d in descriptors],
+                         [('circle_1.png', 'circle', [50, 50, 101, 101]), ('square_2.png', 'square', [10, 10, 31, 31])])
+
+        for filename in eager['files']:
+            expected = self.client.get(f"/download/{eager['session_id']}/{filename}").data
+            actual = self.client.get(f"/download/{lazy['session_id']}/{filename}").data
+            np.testing.assert_array_equal(np.array(Image.open(io.BytesIO(expected))),
+                                          np.array(Image.open(io.BytesIO(actual))))
+        # Kept once encoded
+        self.assertEqual(sorted(f for f in store.names(lazy['session_id']) if f in lazy['files']), lazy['files'])
+
+        # Refining an object that was never encoded
+        other = self.upload_with_mock(results)
+        response = self.client.post('/refine', json={'session_id': other['session_id'], 'filename': 'circle_1.png',
+                                                     'strokes': [{'points': [[50, 50]], 'size': 10}]})
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get(f"/download/{other['session_id']}/objects_{other['session_id']}.zip")
+        with zipfile.ZipFile(io.BytesIO(response.data)) as archive:
+            self.assertEqual(archive.namelist(), other['files'])
+            self.assertEqual(np.array(Image.open(io.BytesIO(archive.read('circle_1.png'))))[50, 50, 3], 0)
+
+    def test_reextract_replaces_encoded_objects(self):
+        session_id = self.upload_with_mock([
+            {'label': 'circle', 'score': 0.9, 'mask': self.make_mask_b64((50, 50, 150, 150))},
+        ])['session_id']
+        before = Image.open(io.BytesIO(self.client.get(f"/download/{session_id}/circle_1.png").data))
+        self.client.post('/reextract', json={'session_id': session_id, 'feather': 3})
+        self.assertNotIn('circle_1.png', get_session_store().names(session_id))
+        after = Image.open(io.BytesIO(self.client.get(f"/download/{session_id}/circle_1.png").data))
+        self.assertGreater(after.size[0], before.size[0])
+
+    def test_unknown_job(self):
+        self.assertEqual(self.client.get('/jobs/nope').status_code, 404)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,172 @@
+import unittest
+import os
+import io
+import base64
+import shutil
+import tempfile
+import zipfile
+import unittest.mock
+import numpy as np
+from PIL import Image, ImageDraw
+
+from app import app, atlas_lock, get_session_store
+from utils.atlas import build_atlas, pack_shelves
+
+
+class TestAtlasPacking(unittest.TestCase):
+    def test_rects_do_not_overlap(self):
+        rng = np.random.default_rng(0)
+        sizes = [(int(w), int(h)) for w, h in rng.integers(1, 80, (40, 2))]
+        width, height, positions = pack_shelves(sizes, padding=1)
+        covered = np.zeros((height, width), dtype=np.uint8)
+        for (w, h), (x, y) in zip(sizes, positions):
+            self.assertLessEqual(x + w, width)
+            self.assertLessEqual(y + h, height)
+            covered[y:y + h + 1, x:x + w + 1] += 1
+        self.assertLessEqual(covered.max(), 1)
+        # Roughly square, not one long row
+        self.assertLess(width, sum(w for w, _ in sizes) / 2)
+
+    def test_wide_crop_and_max_width(self):
+        width, height, positions = pack_shelves([(500, 2), (10, 10), (10, 10)], padding=0, max_width=64)
+        self.assertEqual(width, 500)
+        width, height, positions = pack_shelves([(40, 10)] * 4, padding=0, max_width=64)
+        self.assertEqual((width, height), (40, 40))
+
+    def test_build_atlas_keeps_pixels(self):
+        rng = np.random.default_rng(1)
+        crops = [rng.integers(0, 256, (h, w, 4), dtype=np.uint8) for w, h in [(5, 9), (12, 3), (7, 7)]]
+        atlas, rects = build_atlas(crops)
+        for crop, (x, y, w, h) in zip(crops, rects):
+            np.testing.assert_array_equal(atlas[y:y + h, x:x + w], crop)
+
+    def test_empty(self):
+        atlas, rects = build_atlas([])
+        self.assertEqual(rects, [])
+
+
+class TestAtlasMode(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['UPLOAD_FOLDER'] = tempfile.mkdtemp()
+        self.client = app.test_client()
+
+        rng = np.random.default_rng(2)
+        buf = io.BytesIO()
+        Image.fromarray(rng.integers(0, 256, (120, 160, 3), dtype=np.uint8)).save(buf, format='PNG')
+        self.image = buf.getvalue()
+        self.results = []
+        for label, score, box in (('cat', 0.9, (10, 10, 70, 60)), ('dog', 0.6, (80, 40, 150, 110)),
+                                  ('cup', 0.3, (20, 80, 40, 100))):
+            mask = Image.new('L', (160, 120), 0)
+            ImageDraw.Draw(mask).ellipse(box, fill=255)
+            out = io.BytesIO()
+            mask.save(out, format='PNG')
+            self.results.append({'label': label, 'score': score, 'mask': base64.b64encode(out.getvalue()).decode()})
+
+    def tearDown(self):
+        shutil.rmtree(app.config['UPLOAD_FOLDER'])
+
+    def upload(self, atlas):
+        data = {'file': (io.BytesIO(self.image), 'photo.png')}
+        if atlas:
+            data['atlas'] = '1'
+        with unittest.mock.patch('app.segment_image', return_value=self.results):
+            response = self.client.post('/upload', data=data, content_type='multipart/form-data')
+        self.assertEqual(response.status_code, 200)
+        return response.get_json()
+
+    def download(self, session_id, filename):
+        response = self.client.get(f"/download/{session_id}/{filename}")
+        self.assertEqual(response.status_code, 200)
+        return response.get_data()
+
+    def test_index_and_conditional_requests(self):
+        result = self.upload(atlas=True)
+        session_id = result['session_id']
+        self.assertEqual(result['atlas'], f"/atlas/{session_id}")
+        # Nothing was encoded at upload time
+        self.assertEqual([f for f in get_session_store().names(session_id) if f in result['files']], [])
+
+        response = self.client.get(result['atlas'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Cache-Control'], 'private, no-cache')
+        index = response.get_json()
+        self.assertEqual([o['file'] for o in index['objects']], result['files'])
+        self.assertEqual([o['label'] for o in index['objects']], ['cat', 'dog', 'cup'])
+        self.assertEqual(index['objects'][1]['score'], 0.6)
+        self.assertEqual(index['objects'][0]['bbox'][:2], [10, 10])
+
+        again = self.client.get(result['atlas'], headers={'If-None-Match': response.headers['ETag']})
+        self.assertEqual(again.status_code, 304)
+
+        image = self.client.get(index['image'])
+        self.assertEqual(image.status_code, 200)
+        self.assertIn('immutable', image.headers['Cache-Control'])
+        self.assertEqual(Image.open(io.BytesIO(image.get_data())).size, (index['width'], index['height']))
+        self.assertEqual(self.client.get(f"/atlas/{session_id}/0000.png").status_code, 404)
+
+    def test_objects_match_regular_mode(self):
+        regular = self.upload(atlas=False)
+        packed = self.upload(atlas=True)
+        self.assertEqual(regular['files'], packed['files'])
+        for filename in regular['files']:
+            expected = np.array(Image.open(io.BytesIO(self.download(regular['session_id'], filename))))
+            actual = np.array(Image.open(io.BytesIO(self.download(packed['session_id'], filename))))
+            np.testing.assert_array_equal(expected, actual)
+
+        # Encoded on demand, then kept
+        store = get_session_store()
+        self.assertIn(packed['files'][0], store.names(packed['session_id']))
+
+        archive = self.client.get(f"/download/{packed['session_id']}/{packed['zip_file']}").get_data()
+        with zipfile.ZipFile(io.BytesIO(archive)) as zf:
+            self.assertEqual(sorted(zf.namelist()), sorted(packed['files']))
+
+    def test_refine_updates_atlas(self):
+        result = self.upload(atlas=True)
+        session_id, filename = result['session_id'], result['files'][0]
+        before = self.client.get(result['atlas'])
+
+        refine = self.client.post('/refine', json={'session_id': session_id, 'filename': filename,
+                                                   'strokes': [{'points': [[30, 25]], 'size': 8}]})
+        self.assertEqual(refine.status_code, 200)
+
+        response = self.client.get(result['atlas'], headers={'If-None-Match': before.headers['ETag']})
+        self.assertEqual(response.status_code, 200)
+        index = response.get_json()
+        self.assertNotEqual(index['etag'], before.get_json()['etag'])
+        atlas = np.array(Image.open(io.BytesIO(self.client.get(index['image']).get_data())))
+        x, y, w, h = index['objects'][0]['rect']
+        refined = np.array(Image.open(io.BytesIO(self.download(session_id, filename))))
+        np.testing.assert_array_equal(atlas[y:y + h, x:x + w], refined)
+        self.assertEqual(atlas[y + 25, x + 30, 3], 0)
+
+    def test_reextract_replaces_atlas(self):
+        result = self.upload(atlas=True)
+        session_id = result['session_id']
+        # An object whose PNG was already encoded gets a new one too
+        self.download(session_id, result['files'][0])
+        response = self.client.post('/reextract', json={'session_id': session_id, 'labels': ['cat'], 'feather': 2})
+        self.assertEqual(response.status_code, 200)
+
+        index = self.client.get(result['atlas']).get_json()
+        self.assertEqual([o['file'] for o in index['objects']], ['cat_1.png'])
+        atlas = np.array(Image.open(io.BytesIO(self.client.get(index['image']).get_data())))
+        x, y, w, h = index['objects'][0]['rect']
+        png = np.array(Image.open(io.BytesIO(self.download(session_id, 'cat_1.png'))))
+        np.testing.assert_array_equal(atlas[y:y + h, x:x + w], png)
+
+
+    def test_sessions_do_not_share_the_atlas_lock(self):
+        busy, other = self.upload(atlas=True), self.upload(atlas=True)
+        self.assertIs(atlas_lock(busy['session_id']), atlas_lock(busy['session_id']))
+        # While one session's atlas is being built, another's is still served
+        with atlas_lock(busy['session_id']):
+            response = self.client.get(other['atlas'])
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(atlas_lock(other['session_id']).locked())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+import unittest
+import io
+import base64
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest.mock
+import numpy as np
+from PIL import Image, ImageDraw
+
+from utils.backends import (
+    ClassicalBackend, FakeBackend, LocalModelBackend, RemoteBackend, _label_components,
+)
+from utils.segmentation import extract_objects
+
+
+def image_bytes(img, fmt='PNG'):
+    buf = io.BytesIO()
+    img.save(buf, format=fmt)
+    return buf.getvalue()
+
+
+def decode_mask(mask_b64):
+    return np.array(Image.open(io.BytesIO(base64.b64decode(mask_b64))))
+
+
+class TestBackends(unittest.TestCase):
+    def setUp(self):
+        img = Image.new('RGB', (200, 200), color='white')
+        draw = ImageDraw.Draw(img)
+        draw.ellipse((50, 50, 150, 150), fill='red')
+        draw.rectangle((10, 10, 40, 40), fill='blue')
+        self.img = img
+        self.data = image_bytes(img)
+
+    def test_label_components(self):
+        fg = np.zeros((6, 8), dtype=bool)
+        fg[0:2, 0:2] = True
+        fg[3:6, 5:8] = True
+        fg[5, 0:6] = True  # joins the bottom-left run to the right block
+        labels, count = _label_components(fg)
+        self.assertEqual(count, 2)
+        self.assertEqual(len(np.unique(labels[fg])), 2)
+        self.assertEqual(labels[5, 0], labels[3, 7])
+        self.assertEqual(labels[~fg].max(), 0)
+
+    def test_label_components_diagonal_is_not_connected(self):
+        fg = np.eye(3, dtype=bool)
+        _, count = _label_components(fg)
+        self.assertEqual(count, 3)
+
+    def test_classical_backend_finds_objects(self):
+        results = ClassicalBackend().segment(self.data, 'image/png')
+        self.assertEqual(len(results), 2)
+        areas = sorted(int((decode_mask(r['mask']) > 0).sum()) for r in results)
+        self.assertAlmostEqual(areas[0], 31 * 31, delta=40)
+        self.assertAlmostEqual(areas[1], np.pi * 50 ** 2, delta=400)
+        for r in results:
+            self.assertEqual(r['label'], 'object')
+            self.assertTrue(0 <= r['score'] <= 1)
+
+    def test_classical_backend_blank_image(self):
+        data = image_bytes(Image.new('RGB', (64, 64), 'white'))
+        self.assertEqual(ClassicalBackend().segment(data, 'image/png'), [])
+
+    def test_fake_backend_is_deterministic(self):
+        backend = FakeBackend(num_objects=4)
+        first = backend.segment(self.data, 'image/png')
+        second = backend.segment(self.data, 'image/png')
+        self.assertEqual(first, second)
+        self.assertEqual(len(first), 4)
+        self.assertEqual(decode_mask(first[0]['mask']).shape, (200, 200))
+
+        other = image_bytes(Image.new('RGB', (200, 200), 'black'))
+        self.assertNotEqual(backend.segment(other, 'image/png'), first)
+
+    def test_results_feed_extract_objects(self):
+        test_dir = tempfile.mkdtemp()
+        try:
+            path = f"{test_dir}/img.png"
+            self.img.save(path)
+            results = FakeBackend(num_objects=3).segment(self.data, 'image/png')
+            self.assertEqual(len(extract_objects(path, results, test_dir)), 3)
+        finally:
+            shutil.rmtree(test_dir)
+
+    def test_remote_backend_sends_headers(self):
+        response = unittest.mock.Mock(status_code=200)
+        response.json.return_value = [{'score': 0.9, 'label': 'cat', 'mask': 'AAAA'}]
+        client = unittest.mock.Mock()
+        client.post.return_value = response
+
+        results = RemoteBackend(client, 'model').segment(b'img', 'image/png', api_token='tok')
+
+        self.assertEqual(results, [{'score': 0.9, 'label': 'cat', 'mask': 'AAAA'}])
+        headers = client.post.call_args.kwargs['headers']
+        self.assertEqual(headers['Authorization'], 'Bearer tok')
+        self.assertEqual(headers['Content-Type'], 'image/png')
+
+    def test_remote_backend_errors(self):
+        response = unittest.mock.Mock(status_code=200)
+        response.json.return_value = {'error': 'Model is loading'}
+        client = unittest.mock.Mock()
+        client.post.return_value = response
+        with self.assertRaises(Exception):
+            RemoteBackend(client, 'model').segment(b'img', 'image/png')
+
+        response.status_code = 401
+        with self.assertRaisesRegex(Exception, 'Authentication failed'):
+            RemoteBackend(client, 'model').segment(b'img', 'image/png')
+
+    def test_local_model_is_loaded_once_under_concurrency(self):
+        def load(task, model):
+            time.sleep(0.05)
+            return lambda image, subtask: []
+
+        transformers = unittest.mock.Mock()
+        transformers.pipeline.side_effect = load
+        backend = LocalModelBackend('/models/seg')
+        with unittest.mock.patch.dict(sys.modules, {'transformers': transformers}):
+            threads = [threading.Thread(target=backend.segment, args=(self.data, 'image/png')) for _ in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        self.assertEqual(transformers.pipeline.call_count, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,223 @@
+import unittest
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest.mock
+from PIL import Image
+
+from utils import cache as cache_module
+from utils import segmentation
+from utils.cache import SegmentationCache, SingleFlight, cache_key
+from utils.backends import SegmentationBackend
+
+
+class TestSegmentationCache(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.test_dir, 'cache.sqlite3')
+
+    def tearDown(self):
+        cache_module.set_cache(None)
+        shutil.rmtree(self.test_dir)
+
+    def test_key_depends_on_bytes_and_model(self):
+        self.assertEqual(cache_key(b'abc', 'm1'), cache_key(b'abc', 'm1'))
+        self.assertNotEqual(cache_key(b'abc', 'm1'), cache_key(b'abd', 'm1'))
+        self.assertNotEqual(cache_key(b'abc', 'm1'), cache_key(b'abc', 'm2'))
+
+    def test_hit_miss_counters(self):
+        cache = SegmentationCache(self.db_path)
+        results = [{'score': 0.9, 'label': 'cat', 'mask': 'AAAA'}]
+
+        self.assertIsNone(cache.get('k'))
+        cache.set('k', results)
+        self.assertEqual(cache.get('k'), results)
+
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['entries'], 1)
+
+    def test_persists_across_instances(self):
+        SegmentationCache(self.db_path).set('k', [{'score': 1, 'label': 'a', 'mask': None}])
+        self.assertIsNotNone(SegmentationCache(self.db_path).get('k'))
+
+    def test_lru_eviction_by_size(self):
+        payload = [{'score': 1, 'label': 'x' * 100, 'mask': None}]
+        cache = SegmentationCache(self.db_path, max_bytes=350, ttl=None)
+        cache.set('a', payload)
+        cache.set('b', payload)
+        # Touch 'a' so 'b' becomes least recently used
+        with unittest.mock.patch('time.time', return_value=1e10):
+            cache.get('a')
+        with unittest.mock.patch('time.time', return_value=1e10 + 1):
+            cache.set('c', payload)
+
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNotNone(cache.get('c'))
+        self.assertGreaterEqual(cache.stats()['evictions'], 1)
+
+    def test_ttl_expiry(self):
+        cache = SegmentationCache(self.db_path, ttl=60)
+        with unittest.mock.patch('time.time', return_value=1000):
+            cache.set('k', [])
+        with unittest.mock.patch('time.time', return_value=1100):
+            self.assertIsNone(cache.get('k'))
+        self.assertEqual(cache.stats()['entries'], 0)
+
+    def test_database_errors_do_not_fail_segmentation(self):
+        cache = SegmentationCache(self.db_path)
+        cache_module.set_cache(cache)
+        image_path = os.path.join(self.test_dir, 'img.png')
+        Image.new('RGB', (10, 10), 'red').save(image_path)
+        backend = unittest.mock.Mock(model_id='m')
+        backend.segment.return_value = [{'score': 0.5, 'label': 'thing', 'mask': 'AAAA'}]
+
+        locked = unittest.mock.Mock()
+        locked.execute.side_effect = sqlite3.OperationalError('database is locked')
+        with unittest.mock.patch.object(cache, '_conn', locked):
+            with unittest.mock.patch.object(segmentation, 'get_backend', return_value=backend):
+                self.assertEqual(segmentation.segment_image(image_path), backend.segment.return_value)
+            stats = cache.stats()
+        self.assertEqual((stats['errors'], stats['misses'], stats['entries']), (2, 1, None))
+
+    def test_duplicate_upload_skips_network(self):
+        cache_module.set_cache(SegmentationCache(self.db_path))
+        image_path = os.path.join(self.test_dir, 'img.png')
+        Image.new('RGB', (10, 10), 'red').save(image_path)
+
+        response = unittest.mock.Mock(status_code=200)
+        response.json.return_value = [{'score': 0.5, 'label': 'thing', 'mask': 'AAAA'}]
+
+        client = unittest.mock.Mock()
+        client.post.return_value = response
+        post = client.post
+
+        backend = segmentation.RemoteBackend(client, segmentation.MODEL_ID)
+
+        with unittest.mock.patch.object(segmentation, 'get_backend', return_value=backend):
+            first = segmentation.segment_image(image_path)
+            second = segmentation.segment_image(image_path)
+            self.assertEqual(post.call_count, 1)
+            self.assertEqual(first, second)
+
+            segmentation.segment_image(image_path, use_cache=False)
+            self.assertEqual(post.call_count, 2)
+
+
+class BlockingBackend(SegmentationBackend):
+    """Backend whose calls block until `release` is set, counting how many were made."""
+    model_id = 'blocking'
+
+    def __init__(self, error=None):
+        self.calls = 0
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.error = error
+        self._lock = threading.Lock()
+
+    def segment(self, data, mime_type, api_token=None):
+        with self._lock:
+            self.calls += 1
+        self.started.set()
+        self.release.wait(5)
+        if self.error is not None:
+            raise self.error
+        return [{'score': 0.9, 'label': f'len{len(data)}', 'mask': 'AAAA'}]
+
+
+class TestSingleFlight(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        cache_module.set_cache(None)
+        self.env = unittest.mock.patch.dict(os.environ, {'SEG_CACHE_DISABLED': '1'})
+        self.env.start()
+
+    def tearDown(self):
+        self.env.stop()
+        shutil.rmtree(self.test_dir)
+
+    def image(self, name, size):
+        path = os.path.join(self.test_dir, name)
+        Image.new('RGB', size, 'red').save(path)
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def run_concurrently(self, calls, backend):
+        """Start segment_image for every image in `calls`; returns (results, errors) in order."""
+        results = [None] * len(calls)
+        errors = [None] * len(calls)
+
+        def run(i, data):
+            try:
+                results[i] = segmentation.segment_image(data, backend=backend)
+            except Exception as e:
+                errors[i] = e
+
+        threads = [threading.Thread(target=run, args=(i, data)) for i, data in enumerate(calls)]
+        for t in threads:
+            t.start()
+        self.assertTrue(backend.started.wait(5))
+        # Give the other callers time to reach the in-flight call
+        deadline = time.time() + 5
+        while segmentation._inflight.coalesced < self.expected_followers and time.time() < deadline:
+            time.sleep(0.01)
+        backend.release.set()
+        for t in threads:
+            t.join(5)
+        return results, errors
+
+    def test_concurrent_identical_calls_share_one_request(self):
+        backend = BlockingBackend()
+        data = self.image('a.png', (20, 20))
+        before = segmentation._inflight.coalesced
+        self.expected_followers = before + 7
+        results, errors = self.run_concurrently([data] * 8, backend)
+
+        self.assertEqual(backend.calls, 1)
+        self.assertEqual(errors, [None] * 8)
+        self.assertEqual(segmentation._inflight.coalesced - before, 7)
+        self.assertTrue(all(r == results[0] for r in results))
+        # Callers do not share the result objects
+        self.assertEqual(len({id(r[0]) for r in results}), 8)
+        self.assertEqual(segmentation._inflight.in_flight(), 0)
+
+        # Nothing is remembered afterwards (the cache is off)
+        backend.release.set()
+        segmentation.segment_image(data, backend=backend)
+        self.assertEqual(backend.calls, 2)
+
+    def test_different_images_are_not_coalesced(self):
+        backend = BlockingBackend()
+        first, second = self.image('a.png', (20, 20)), self.image('b.png', (30, 20))
+        self.expected_followers = segmentation._inflight.coalesced + 2
+        results, errors = self.run_concurrently([first, second, first, second], backend)
+        self.assertEqual(backend.calls, 2)
+        self.assertEqual(errors, [None] * 4)
+        self.assertEqual(results[0], results[2])
+        self.assertNotEqual(results[0], results[1])
+
+    def test_error_is_shared_by_every_waiter(self):
+        backend = BlockingBackend(error=Exception("API Error: 500"))
+        data = self.image('a.png', (20, 20))
+        self.expected_followers = segmentation._inflight.coalesced + 3
+        results, errors = self.run_concurrently([data] * 4, backend)
+        self.assertEqual(backend.calls, 1)
+        self.assertEqual([str(e) for e in errors], ["API Error: 500"] * 4)
+        self.assertEqual(segmentation._inflight.in_flight(), 0)
+
+    def test_sequential_calls_are_independent(self):
+        flight = SingleFlight()
+        self.assertEqual(flight.do('k', lambda: 1), (1, False))
+        self.assertEqual(flight.do('k', lambda: 2), (2, False))
+        with self.assertRaises(ValueError):
+            flight.do('k', unittest.mock.Mock(side_effect=ValueError))
+        self.assertEqual(flight.coalesced, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+import unittest
+import threading
+import time
+import unittest.mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from utils.segmentation import InferenceClient, CircuitOpenError
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Replays the server's scripted (status, delay) responses in order."""
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            status, delay = server.script.pop(0) if server.script else (200, 0)
+        if delay:
+            time.sleep(delay)
+        body = b'[]' if status == 200 else b'{"error": "busy"}'
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestInferenceClient(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        self.server.lock = threading.Lock()
+        self.server.script = []
+        self.server.requests = 0
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/model"
+        self.sleeps = []
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def make_client(self, **kwargs):
+        kwargs.setdefault('sleep', self.sleeps.append)
+        return InferenceClient(url=self.url, **kwargs)
+
+    def test_success_reuses_connection(self):
+        client = self.make_client()
+        for _ in range(3):
+            self.assertEqual(client.post(b'img').status_code, 200)
+        self.assertEqual(self.server.requests, 3)
+        self.assertEqual(self.sleeps, [])
+
+    def test_retries_503_and_429_with_backoff(self):
+        self.server.script = [(503, 0), (429, 0), (200, 0)]
+        client = self.make_client(max_retries=3, backoff_base=0.1, backoff_max=1)
+        response = client.post(b'img')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.server.requests, 3)
+        self.assertEqual(len(self.sleeps), 2)
+        self.assertTrue(all(0 <= s <= 1 for s in self.sleeps))
+
+    def test_retries_are_bounded(self):
+        self.server.script = [(503, 0)] * 10
+        client = self.make_client(max_retries=2)
+        response = client.post(b'img')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(self.server.requests, 3)
+
+    def test_client_errors_are_not_retried(self):
+        self.server.script = [(401, 0)]
+        client = self.make_client()
+        self.assertEqual(client.post(b'img').status_code, 401)
+        self.assertEqual(self.server.requests, 1)
+        self.assertEqual(client.state, 'closed')
+
+    def test_read_timeout_is_not_retried(self):
+        self.server.script = [(200, 0.5)]
+        client = self.make_client(read_timeout=0.1, max_retries=3)
+        with self.assertRaises(requests.ReadTimeout):
+            client.post(b'img')
+        self.assertEqual(self.server.requests, 1)
+        self.assertEqual(self.sleeps, [])
+
+    def test_connection_errors_are_retried(self):
+        client = self.make_client(max_retries=2)
+        with unittest.mock.patch.object(client.session, 'post', side_effect=requests.ConnectTimeout('slow')) as post:
+            with self.assertRaises(requests.ConnectTimeout):
+                client.post(b'img')
+        self.assertEqual(post.call_count, 3)
+        self.assertEqual(len(self.sleeps), 2)
+
+    def test_circuit_breaker_fails_fast_and_recovers(self):
+        self.server.script = [(503, 0)] * 2
+        client = self.make_client(max_retries=0, failure_threshold=2, reset_timeout=0.2)
+        client.post(b'img')
+        client.post(b'img')
+        self.assertEqual(client.state, 'open')
+
+        with self.assertRaises(CircuitOpenError):
+            client.post(b'img')
+        self.assertEqual(self.server.requests, 2)
+
+        time.sleep(0.25)
+        self.assertEqual(client.state, 'half-open')
+        self.assertEqual(client.post(b'img').status_code, 200)
+        self.assertEqual(client.state, 'closed')
+
+    def test_unexpected_error_during_trial_reopens_circuit(self):
+        self.server.script = [(503, 0)]
+        client = self.make_client(max_retries=0, failure_threshold=1, reset_timeout=0.1)
+        client.post(b'img')
+        time.sleep(0.15)
+        with unittest.mock.patch.object(client.session, 'post', side_effect=requests.exceptions.ChunkedEncodingError()):
+            with self.assertRaises(requests.exceptions.ChunkedEncodingError):
+                client.post(b'img')
+        self.assertEqual(client.state, 'open')
+
+        # The next trial is let through again and closes the circuit
+        time.sleep(0.15)
+        self.assertEqual(client.post(b'img').status_code, 200)
+        self.assertEqual(client.state, 'closed')
+
+
+if __name__ == '__main__':
+    unittest.main()
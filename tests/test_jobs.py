@@ -0,0 +1,57 @@
+import unittest
+import threading
+
+from utils.jobs import JobManager, sse_stream
+
+
+class TestJobManager(unittest.TestCase):
+    def setUp(self):
+        self.manager = JobManager(max_workers=2)
+
+    def tearDown(self):
+        self.manager.shutdown()
+
+    def test_result_and_events(self):
+        def work(job, n):
+            job.emit('stage', stage='working')
+            for i in range(n):
+                job.emit('object', file=f'obj_{i}.png')
+            return {'count': n}
+
+        job = self.manager.submit(work, 3)
+        events = list(sse_stream(job))
+        self.assertEqual(events[-1].split('\n')[1], 'event: done')
+        self.assertEqual(job.snapshot()['status'], 'done')
+        self.assertEqual(job.result, {'count': 3})
+        self.assertEqual(job.files, ['obj_0.png', 'obj_1.png', 'obj_2.png'])
+        self.assertIs(self.manager.get(job.id), job)
+
+    def test_resume_after_last_event_id(self):
+        job = self.manager.submit(lambda job: job.emit('stage', stage='only'))
+        list(sse_stream(job))
+        # Events 1 (stage) and 2 (done) exist; resuming after 1 yields only 'done'
+        resumed = list(sse_stream(job, last_event_id=1))
+        self.assertEqual(len(resumed), 1)
+        self.assertTrue(resumed[0].startswith('id: 2\nevent: done'))
+
+    def test_failure(self):
+        def work(job):
+            raise ValueError('bad image')
+
+        job = self.manager.submit(work)
+        events = list(sse_stream(job))
+        self.assertIn('event: error', events[-1])
+        self.assertEqual(job.status, 'error')
+        self.assertEqual(job.error, 'bad image')
+
+    def test_keepalive_while_waiting(self):
+        release = threading.Event()
+        job = self.manager.submit(lambda job: release.wait(5))
+        stream = sse_stream(job, keepalive=0.05)
+        self.assertEqual(next(stream), ': keep-alive\n\n')
+        release.set()
+        self.assertIn('event: done', list(stream)[-1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+import base64
+import io
+import os
+import shutil
+import unittest
+import unittest.mock
+import numpy as np
+from PIL import Image, ImageDraw
+from utils import segmentation
+from utils.large_image import PNGStreamWriter, band_rows, decode_to_memmap, thumbnail_from_memmap
+from utils.segmentation import extract_objects
+
+
+def mask_result(label, arr):
+    buf = io.BytesIO()
+    Image.fromarray(arr).save(buf, format='PNG')
+    return {'label': label, 'score': 0.9, 'mask': base64.b64encode(buf.getvalue()).decode('utf-8')}
+
+
+class TestLargeImage(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = "tests/temp_large"
+        os.makedirs(self.test_dir, exist_ok=True)
+        rng = np.random.default_rng(0)
+        self.source = rng.integers(0, 256, (230, 310, 3), dtype=np.uint8)
+        self.image_path = os.path.join(self.test_dir, "scan.png")
+        Image.fromarray(self.source).save(self.image_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+
+    def test_band_rows(self):
+        self.assertEqual(band_rows(100, 4, 4000), 10)
+        self.assertEqual(band_rows(100, 4, 10), 1)
+
+    def test_png_stream_writer_round_trip(self):
+        rgba = np.random.default_rng(1).integers(0, 256, (37, 23, 4), dtype=np.uint8)
+        out = io.BytesIO()
+        writer = PNGStreamWriter(out, 23, 37, compress_level=1)
+        for y in range(0, 37, 5):
+            writer.write(rgba[y:y + 5])
+        writer.close()
+        decoded = Image.open(io.BytesIO(out.getvalue()))
+        self.assertEqual(decoded.mode, "RGBA")
+        np.testing.assert_array_equal(np.array(decoded), rgba)
+
+    def test_png_stream_writer_rejects_short_image(self):
+        writer = PNGStreamWriter(io.BytesIO(), 4, 4)
+        writer.write(np.zeros((2, 4, 4), dtype=np.uint8))
+        with self.assertRaises(ValueError):
+            writer.close()
+
+    def test_decode_to_memmap(self):
+        with open(self.image_path, "rb") as f:
+            data = f.read()
+        for image in (self.image_path, data):
+            mapped = decode_to_memmap(image, budget=310 * 16 * 7)
+            try:
+                np.testing.assert_array_equal(mapped.array, self.source)
+            finally:
+                mapped.close()
+
+    def test_thumbnail_from_memmap(self):
+        smooth = np.dstack([*np.meshgrid(np.arange(310) % 256, np.arange(230) % 256), np.full((230, 310), 90)])
+        for shape in ((230, 310), (310, 230), (230, 230), (23, 310)):
+            source = np.ascontiguousarray(np.resize(smooth, shape + (3,)).astype(np.uint8))
+            expected = Image.fromarray(source)
+            expected.thumbnail((64, 64), Image.LANCZOS)
+            path = os.path.join(self.test_dir, "shape.png")
+            Image.fromarray(source).save(path)
+            mapped = decode_to_memmap(path, budget=10000)
+            try:
+                # A budget this small forces bands of a few rows
+                actual = thumbnail_from_memmap(mapped, 64, budget=10000)
+            finally:
+                mapped.close()
+            self.assertEqual(actual.size, expected.size)
+            self.assertLess(np.abs(np.asarray(actual, dtype=int) - np.asarray(expected)).mean(), 8)
+
+    def test_large_images_are_downscaled_from_the_mapped_copy(self):
+        with open(self.image_path, "rb") as f:
+            data = f.read()
+        with unittest.mock.patch.object(segmentation, 'LARGE_IMAGE_PIXELS', 1000), \
+                unittest.mock.patch.object(segmentation, 'decode_to_memmap',
+                                           wraps=segmentation.decode_to_memmap) as decode:
+            out, mime_type = segmentation.downscale_for_inference(data, "image/png", 100)
+        decode.assert_called_once()
+        self.assertEqual(mime_type, "image/jpeg")
+        self.assertEqual(Image.open(io.BytesIO(out)).size, (100, 74))
+
+    def results(self, mask_size):
+        full = Image.new("L", (310, 230), 0)
+        draw = ImageDraw.Draw(full)
+        draw.ellipse((20, 30, 140, 180), fill=255)
+        draw.rectangle((200, 10, 290, 60), fill=120)
+        draw.rectangle((200, 8, 290, 9), fill=5)
+        other = Image.new("L", (310, 230), 0)
+        ImageDraw.Draw(other).polygon([(150, 220), (300, 100), (305, 225)], fill=255)
+        return [mask_result(label, np.array(mask.resize(mask_size, Image.LANCZOS) if mask_size != mask.size else mask))
+                for label, mask in (('cat', full), ('dog', other))]
+
+    def extract_both(self, results, budget):
+        regular = extract_objects(self.image_path, results, self.test_dir, large_image=False, prefix="r_")
+        tiled = extract_objects(self.image_path, results, self.test_dir, large_image=True,
+                                memory_budget=budget, prefix="t_")
+        self.assertEqual([os.path.basename(f)[2:] for f in regular], [os.path.basename(f)[2:] for f in tiled])
+        return [(np.array(Image.open(a)), np.array(Image.open(b))) for a, b in zip(regular, tiled)]
+
+    def test_tiled_matches_regular_full_size_masks(self):
+        # A budget this small forces bands of a few rows
+        for expected, actual in self.extract_both(self.results((310, 230)), budget=4000):
+            np.testing.assert_array_equal(expected, actual)
+
+    def test_tiled_matches_regular_low_res_masks(self):
+        for expected, actual in self.extract_both(self.results((155, 115)), budget=4000):
+            self.assertEqual(expected.shape, actual.shape)
+            np.testing.assert_array_equal(expected[..., :3], actual[..., :3])
+            # Band-wise resampling only differs in float rounding
+            self.assertLessEqual(np.abs(expected[..., 3].astype(int) - actual[..., 3]).max(), 1)
+
+    def test_large_images_dispatch_to_tiled_mode(self):
+        results = self.results((310, 230))
+        with unittest.mock.patch.object(segmentation, 'LARGE_IMAGE_PIXELS', 1000), \
+                unittest.mock.patch.object(segmentation, '_extract_objects_tiled',
+                                           wraps=segmentation._extract_objects_tiled) as tiled:
+            masks = []
+            files = extract_objects(self.image_path, results, self.test_dir, keep_masks=masks)
+        tiled.assert_called_once()
+        self.assertEqual(len(files), 2)
+        self.assertEqual(masks, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
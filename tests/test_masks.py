@@ -0,0 +1,65 @@
+import unittest
+import numpy as np
+
+from utils.masks import RLEMask
+
+
+def dense(mask, shape):
+    """The mask pasted into a zero frame of `shape`."""
+    frame = np.zeros(shape, dtype=np.uint8)
+    if mask:
+        frame[mask.upper:mask.upper + mask.height, mask.left:mask.left + mask.width] = mask.decode()
+    return frame
+
+
+class TestRLEMask(unittest.TestCase):
+    def random_mask(self, rng, shape):
+        mask = np.zeros(shape, dtype=np.uint8)
+        for _ in range(rng.integers(0, 4)):
+            y0, x0 = rng.integers(0, shape[0]), rng.integers(0, shape[1])
+            y1, x1 = rng.integers(y0, shape[0] + 1), rng.integers(x0, shape[1] + 1)
+            mask[y0:y1, x0:x1] = rng.choice([1, 5, 128, 255])
+        return mask
+
+    def test_operations_match_dense_arrays(self):
+        rng = np.random.default_rng(0)
+        for _ in range(200):
+            shape = tuple(int(v) for v in rng.integers(1, 40, 2))
+            a, b = self.random_mask(rng, shape), self.random_mask(rng, shape)
+            ma, mb = RLEMask.encode(a), RLEMask.encode(b)
+            np.testing.assert_array_equal(dense(ma, shape), a)
+            np.testing.assert_array_equal(dense(ma.union(mb), shape), np.maximum(a, b))
+            np.testing.assert_array_equal(dense(ma.intersection(mb), shape), np.minimum(a, b))
+            self.assertEqual(ma.area(), int((a > 0).sum()))
+            self.assertEqual(ma.area(100), int((a >= 100).sum()))
+            np.testing.assert_array_equal(dense(ma.threshold(100), shape), np.where(a >= 100, a, 0))
+
+    def test_bbox_is_trimmed(self):
+        mask = np.zeros((50, 60), dtype=np.uint8)
+        mask[10:20, 30:45] = 3
+        mask[12, 31] = 200
+        encoded = RLEMask.encode(mask, left=100, upper=5)
+        self.assertEqual(encoded.bbox, (130, 15, 145, 25))
+        self.assertEqual(encoded.threshold(10).bbox, (131, 17, 132, 18))
+        self.assertFalse(encoded.threshold(201))
+
+    def test_iou_and_offsets(self):
+        a = RLEMask.encode(np.ones((10, 10), dtype=bool), left=0, upper=0)
+        b = RLEMask.encode(np.ones((10, 10), dtype=bool), left=5, upper=0)
+        self.assertEqual(a.intersection(b).bbox, (5, 0, 10, 10))
+        self.assertEqual(a.union(b).area(), 150)
+        self.assertAlmostEqual(a.iou(b), 50 / 150)
+        self.assertEqual(a.iou(RLEMask.empty()), 0.0)
+        self.assertFalse(a.intersection(RLEMask.encode(np.ones((2, 2)), left=50, upper=50)))
+
+    def test_size_scales_with_perimeter(self):
+        yy, xx = np.mgrid[:1000, :1000]
+        disc = (((yy - 500) ** 2 + (xx - 500) ** 2) < 400 ** 2).astype(np.uint8) * 255
+        encoded = RLEMask.encode(disc)
+        # Two runs per row of the disc instead of a byte per pixel
+        self.assertLess(encoded.nbytes, 5 * 2 * 800 + 10)
+        self.assertEqual(encoded.area(), int((disc > 0).sum()))
+
+
+if __name__ == '__main__':
+    unittest.main()
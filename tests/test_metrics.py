@@ -0,0 +1,135 @@
+import unittest
+import os
+import io
+import shutil
+import tempfile
+import time
+import unittest.mock
+from PIL import Image
+
+from app import app
+from utils import segmentation
+from utils.backends import FakeBackend
+from utils.metrics import MetricsRegistry, RequestProfiler, get_metrics
+
+
+class TestMetricsRegistry(unittest.TestCase):
+    def test_counters_and_histograms_render(self):
+        metrics = MetricsRegistry()
+        metrics.describe('things_total', 'Things seen.')
+        metrics.inc('things_total', 2, kind='a')
+        metrics.inc('things_total', kind='a')
+        metrics.inc('things_total', kind='b"c')
+        for seconds in (0.001, 0.2, 0.3, 100):
+            metrics.observe('stage_duration_seconds', seconds, stage='x')
+
+        text = metrics.render({'store_bytes': 42, 'codes': [({'code': 200}, 3)]})
+        self.assertIn('# HELP seg_things_total Things seen.', text)
+        self.assertIn('# TYPE seg_things_total counter', text)
+        self.assertIn('seg_things_total{kind="a"} 3', text)
+        self.assertIn('seg_things_total{kind="b\\"c"} 1', text)
+        # Buckets are cumulative and end with +Inf
+        self.assertIn('seg_stage_duration_seconds_bucket{stage="x",le="0.005"} 1', text)
+        self.assertIn('seg_stage_duration_seconds_bucket{stage="x",le="0.25"} 2', text)
+        self.assertIn('seg_stage_duration_seconds_bucket{stage="x",le="60"} 3', text)
+        self.assertIn('seg_stage_duration_seconds_bucket{stage="x",le="+Inf"} 4', text)
+        self.assertIn('seg_stage_duration_seconds_count{stage="x"} 4', text)
+        self.assertIn('# TYPE seg_store_bytes gauge', text)
+        self.assertIn('seg_store_bytes 42', text)
+        self.assertIn('seg_codes{code="200"} 3', text)
+
+    def test_span_records_errors_and_trace(self):
+        metrics = MetricsRegistry()
+        with metrics.trace() as spans:
+            with metrics.span('ok'):
+                pass
+            with self.assertRaises(RuntimeError):
+                with metrics.span('boom'):
+                    raise RuntimeError()
+        self.assertEqual([(s['stage'], s['error']) for s in spans], [('ok', False), ('boom', True)])
+        self.assertEqual(metrics.counter_value('stage_errors_total', stage='boom'), 1)
+        self.assertEqual(metrics.histogram_count('stage_duration_seconds', stage='ok'), 1)
+
+    def test_timed_iter_excludes_consumer_time(self):
+        metrics = MetricsRegistry()
+        with metrics.trace() as spans:
+            for _ in metrics.timed_iter('zip', [b'ab', b'cde'], bytes_metric='out_total'):
+                time.sleep(0.05)
+        self.assertLess(spans[0]['seconds'], 0.05)
+        self.assertEqual(metrics.counter_value('out_total'), 5)
+
+    def test_profiler_keeps_slow_requests_only(self):
+        directory = tempfile.mkdtemp()
+        try:
+            profiler = RequestProfiler(threshold=0.5, directory=directory)
+            self.assertIsNone(profiler.stop(profiler.start(), 0.1, 'fast'))
+            path = profiler.stop(profiler.start(), 0.7, 'POST_upload/file')
+            self.assertTrue(os.path.exists(path))
+            self.assertEqual(os.path.dirname(path), directory)
+            self.assertEqual(profiler.saved, 1)
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestMetricsEndpoint(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['UPLOAD_FOLDER'] = tempfile.mkdtemp()
+        self.client = app.test_client()
+        self.profile_dir = app.config['PROFILE_DIR']
+        segmentation.set_backend(FakeBackend(num_objects=3))
+        get_metrics().reset()
+
+    def tearDown(self):
+        segmentation.set_backend(None)
+        app.config['PROFILE_THRESHOLD'] = None
+        app.config['PROFILE_DIR'] = self.profile_dir
+        shutil.rmtree(app.config['UPLOAD_FOLDER'])
+
+    def upload(self):
+        buf = io.BytesIO()
+        Image.new('RGB', (120, 90), 'white').save(buf, format='PNG')
+        buf.seek(0)
+        return self.client.post('/upload', data={'file': (buf, 'photo.png'), 'no_cache': '1'},
+                                content_type='multipart/form-data')
+
+    def test_upload_stages_are_timed(self):
+        response = self.upload()
+        self.assertEqual(response.status_code, 200)
+        stages = [t.split(';')[0] for t in response.headers['Server-Timing'].split(', ')]
+        self.assertEqual(stages, ['inference', 'segment_image', 'extract_objects', 'upload_file', 'total'])
+
+        session_id = response.get_json()['session_id']
+        zip_response = self.client.get(f"/download/{session_id}/objects_{session_id}.zip")
+        zip_bytes = len(zip_response.get_data())
+
+        text = self.client.get('/metrics').get_data(as_text=True)
+        for stage in ('upload_file', 'segment_image', 'inference', 'extract_objects', 'create_zip'):
+            self.assertIn(f'seg_stage_duration_seconds_count{{stage="{stage}"}} 1', text)
+        self.assertIn('seg_objects_extracted_total 3', text)
+        self.assertIn('seg_request_duration_seconds_count{endpoint="upload_file",status="200"} 1', text)
+        self.assertIn(f'seg_response_bytes_total{{endpoint="download_file_route"}} {zip_bytes}', text)
+        self.assertIn('seg_request_bytes_total{endpoint="upload_file"}', text)
+        self.assertIn('seg_session_store_sessions', text)
+        self.assertIn('seg_backend_circuit_open 0', text)
+
+    def test_backend_status_codes_are_counted(self):
+        client = segmentation.InferenceClient(url='http://stub', max_retries=1, sleep=lambda s: None)
+        responses = [unittest.mock.Mock(status_code=503, headers={}), unittest.mock.Mock(status_code=200)]
+        with unittest.mock.patch.object(client.session, 'post', side_effect=responses):
+            self.assertEqual(client.post(b'x').status_code, 200)
+        metrics = get_metrics()
+        self.assertEqual(metrics.counter_value('backend_responses_total', status=503), 1)
+        self.assertEqual(metrics.counter_value('backend_responses_total', status=200), 1)
+
+    def test_slow_requests_are_profiled(self):
+        directory = os.path.join(app.config['UPLOAD_FOLDER'], 'profiles')
+        app.config['PROFILE_DIR'] = directory
+        app.config['PROFILE_THRESHOLD'] = 1e-6
+        self.assertEqual(self.upload().status_code, 200)
+        self.assertTrue(any(name.startswith(time.strftime('%Y')) and 'POST_upload_file' in name
+                            for name in os.listdir(directory)))
+
+
+if __name__ == '__main__':
+    unittest.main()
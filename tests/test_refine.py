@@ -0,0 +1,387 @@
+import base64
+import io
+import unittest
+import unittest.mock
+import uuid
+
+import numpy as np
+from PIL import Image
+
+import app as app_module
+from app import app, get_refine_working_set, get_session_store
+from utils.refine import (
+    ENCODING_BITS, ENCODING_RLE, EditHistory, HistoryConflict, RefineWorkingSet, decode_binary_mask, encode_binary_mask,
+    luminance, parse_binary_mask, rasterize_strokes,
+)
+from utils.session_store import MemorySessionStore
+
+
+def png_bytes(image):
+    buf = io.BytesIO()
+    image.save(buf, format='PNG')
+    return buf.getvalue()
+
+
+def decode(data):
+    return np.array(Image.open(io.BytesIO(data)).convert('RGBA'))
+
+
+class TestRasterizeStrokes(unittest.TestCase):
+    def test_round_brush_segment(self):
+        box, mask = rasterize_strokes([{'points': [[20, 20], [40, 20]], 'size': 10}], (100, 100))
+        x0, y0, x1, y1 = box
+        self.assertLessEqual(x0, 15)
+        self.assertGreaterEqual(x1, 45)
+        full = np.zeros((100, 100), dtype=bool)
+        full[y0:y1, x0:x1] = mask
+        self.assertTrue(full[20, 30])
+        self.assertTrue(full[20, 16])   # round cap
+        self.assertFalse(full[20, 10])
+        self.assertFalse(full[26, 30])
+
+    def test_single_point_is_a_dot(self):
+        box, mask = rasterize_strokes([{'points': [[50, 50]], 'size': 4}], (100, 100))
+        self.assertEqual(mask.sum(), 12)
+
+    def test_clipped_to_image(self):
+        box, mask = rasterize_strokes([{'points': [[-5, -5], [3, 3]], 'size': 6}], (100, 100))
+        self.assertEqual(box[:2], (0, 0))
+        self.assertIsNone(rasterize_strokes([{'points': [[-50, -50]], 'size': 6}], (100, 100)))
+
+
+class TestBinaryMask(unittest.TestCase):
+    def test_round_trip(self):
+        rng = np.random.default_rng(0)
+        for encoding in (ENCODING_BITS, ENCODING_RLE):
+            for shape, density in (((1, 1), 1.0), ((7, 5), 0.0), ((33, 40), 0.3), ((33, 40), 1.0)):
+                erase = rng.random(shape) < density
+                parsed = parse_binary_mask(encode_binary_mask(erase, 3, 4, encoding))
+                self.assertEqual(parsed[:2], (encoding, (3, 4, shape[1], shape[0])))
+                np.testing.assert_array_equal(decode_binary_mask(parsed[0], shape[1], shape[0], parsed[2]), erase)
+
+    def test_luminance_matches_pil(self):
+        rgba = np.random.default_rng(1).integers(0, 256, (64, 64, 4), dtype=np.uint8)
+        expected = np.asarray(Image.fromarray(rgba, 'RGBA').convert('L'))
+        np.testing.assert_array_equal(luminance(rgba[..., :3]), expected)
+
+    def test_rle_is_compact_for_strokes(self):
+        erase = np.zeros((1000, 1000), dtype=bool)
+        erase[400:420, 100:900] = True
+        self.assertLess(len(encode_binary_mask(erase, 0, 0)), 200)
+
+    def test_rejects_inconsistent_runs(self):
+        body = encode_binary_mask(np.ones((4, 4), dtype=bool), 0, 0)
+        encoding, (x, y, w, h), payload = parse_binary_mask(body)
+        with self.assertRaises(ValueError):
+            decode_binary_mask(encoding, w + 1, h, payload)
+        with self.assertRaises(ValueError):
+            parse_binary_mask(b'XX' + body[2:])
+
+
+class TestRefineWorkingSet(unittest.TestCase):
+    def setUp(self):
+        self.store = MemorySessionStore()
+        self.store.create('s')
+        self.original = png_bytes(Image.new('RGBA', (20, 20), (255, 0, 0, 255)))
+        self.store.put('s', 'a.png', self.original)
+
+    def erase_corner(self, rgba):
+        rgba[:5, :5, 3] = 0
+        return (0, 0, 5, 5)
+
+    def test_encode_deferred_until_flush(self):
+        working_set = RefineWorkingSet()
+        working_set.edit(self.store, 's', 'a.png', self.erase_corner)
+        self.assertEqual(self.store.get('s', 'a.png'), self.original)
+        self.assertEqual(working_set.stats()['dirty'], 1)
+
+        working_set.flush(self.store, 's')
+        alpha = decode(self.store.get('s', 'a.png'))[..., 3]
+        self.assertEqual(alpha[0, 0], 0)
+        self.assertEqual(alpha[10, 10], 255)
+        self.assertEqual(working_set.stats()['dirty'], 0)
+
+    def test_no_op_is_not_written(self):
+        working_set = RefineWorkingSet()
+        working_set.edit(self.store, 's', 'a.png', lambda rgba: None)
+        working_set.flush(self.store, 's')
+        self.assertEqual(working_set.stats()['dirty'], 0)
+        self.assertEqual(self.store.get('s', 'a.png'), self.original)
+
+    def test_processes_share_edits_through_the_history(self):
+        def history(store, session_id, filename):
+            return EditHistory(store, session_id, filename)
+
+        def erase(box):
+            def apply(rgba):
+                x0, y0, x1, y1 = box
+                before = rgba[y0:y1, x0:x1, 3].copy()
+                rgba[y0:y1, x0:x1, 3] = 0
+                history(self.store, 's', 'a.png').record(box, before, rgba[y0:y1, x0:x1, 3])
+                return box
+            return apply
+
+        this, other = RefineWorkingSet(history=history), RefineWorkingSet(history=history)
+        this.edit(self.store, 's', 'a.png', erase((0, 0, 5, 5)))
+        # The other process rebuilds the object from the stored PNG and the delta
+        other.edit(self.store, 's', 'a.png', erase((10, 10, 12, 12)))
+        self.assertEqual(self.store.get('s', 'a.png'), self.original)
+        this.edit(self.store, 's', 'a.png', history(self.store, 's', 'a.png').undo)
+
+        fresh = RefineWorkingSet(history=history)
+        fresh.flush(self.store, 's')
+        alpha = decode(self.store.get('s', 'a.png'))[..., 3]
+        self.assertEqual((alpha[0, 0], alpha[10, 10], alpha[15, 15]), (0, 255, 255))
+        self.assertTrue(history(self.store, 's', 'a.png').is_saved())
+        # Up to date again in the first process too
+        this.flush(self.store, 's')
+        np.testing.assert_array_equal(decode(self.store.get('s', 'a.png'))[..., 3], alpha)
+
+    def test_edit_after_undoing_a_saved_edit_is_written(self):
+        def history(store, session_id, filename):
+            return EditHistory(store, session_id, filename)
+
+        def erase(x):
+            def apply(rgba):
+                before = rgba[0:2, x:x + 2, 3].copy()
+                rgba[0:2, x:x + 2, 3] = 0
+                history(self.store, 's', 'a.png').record((x, 0, x + 2, 2), before, rgba[0:2, x:x + 2, 3])
+                return x
+            return apply
+
+        working_set = RefineWorkingSet(history=history)
+        working_set.edit(self.store, 's', 'a.png', erase(0))
+        working_set.flush(self.store, 's')
+        working_set.edit(self.store, 's', 'a.png', history(self.store, 's', 'a.png').undo)
+        # Replaces the delta the stored PNG would be undone with
+        working_set.edit(self.store, 's', 'a.png', erase(10))
+        alpha = decode(self.store.get('s', 'a.png'))[..., 3]
+        self.assertEqual((alpha[0, 0], alpha[0, 10]), (255, 0))
+        self.assertTrue(history(self.store, 's', 'a.png').is_saved())
+
+    def test_eviction_writes_pending_edits(self):
+        self.store.put('s', 'b.png', self.original)
+        working_set = RefineWorkingSet(max_bytes=20 * 20 * 4)
+        working_set.edit(self.store, 's', 'a.png', self.erase_corner)
+        working_set.edit(self.store, 's', 'b.png', self.erase_corner)
+        self.assertEqual(working_set.stats()['entries'], 1)
+        self.assertEqual(decode(self.store.get('s', 'a.png'))[0, 0, 3], 0)
+
+    def test_missing_object(self):
+        with self.assertRaises(KeyError):
+            RefineWorkingSet().edit(self.store, 's', 'nope.png', self.erase_corner)
+
+
+class TestEditHistory(unittest.TestCase):
+    def setUp(self):
+        self.store = MemorySessionStore()
+        self.store.create('s')
+        self.rgba = np.full((20, 20, 4), 255, dtype=np.uint8)
+
+    def edit(self, history, box):
+        x0, y0, x1, y1 = box
+        before = self.rgba[y0:y1, x0:x1, 3].copy()
+        self.rgba[y0:y1, x0:x1, 3] //= 2
+        history.record(box, before, self.rgba[y0:y1, x0:x1, 3])
+
+    def test_undo_redo(self):
+        history = EditHistory(self.store, 's', 'a.png')
+        original = self.rgba.copy()
+        self.edit(history, (0, 0, 10, 10))
+        after_first = self.rgba.copy()
+        self.edit(history, (5, 5, 15, 15))
+        after_second = self.rgba.copy()
+
+        self.assertEqual(history.undo(self.rgba), (5, 5, 15, 15))
+        np.testing.assert_array_equal(self.rgba, after_first)
+        history.undo(self.rgba)
+        np.testing.assert_array_equal(self.rgba, original)
+        self.assertIsNone(history.undo(self.rgba))
+        self.assertEqual(history.state(), {'can_undo': False, 'can_redo': True})
+
+        history.redo(self.rgba)
+        history.redo(self.rgba)
+        np.testing.assert_array_equal(self.rgba, after_second)
+        self.assertIsNone(history.redo(self.rgba))
+
+    def test_new_edit_drops_redo(self):
+        history = EditHistory(self.store, 's', 'a.png')
+        self.edit(history, (0, 0, 10, 10))
+        history.undo(self.rgba)
+        self.edit(history, (10, 10, 20, 20))
+        self.assertEqual(history.state(), {'can_undo': True, 'can_redo': False})
+
+    def test_limit(self):
+        history = EditHistory(self.store, 's', 'a.png', limit=3)
+        for i in range(5):
+            self.edit(history, (i, 0, i + 1, 1))
+        undone = 0
+        while history.undo(self.rgba):
+            undone += 1
+        self.assertEqual(undone, 3)
+        self.assertEqual(len([n for n in self.store.names('s') if '.delta' in n]), 3)
+
+    def test_refuses_mismatched_pixels(self):
+        history = EditHistory(self.store, 's', 'a.png')
+        original = self.rgba.copy()
+        self.edit(history, (0, 0, 10, 10))
+        # The edit is lost but its delta was kept
+        self.rgba = original.copy()
+        with self.assertRaises(HistoryConflict):
+            history.undo(self.rgba)
+        np.testing.assert_array_equal(self.rgba, original)
+        self.assertEqual(history.state(), {'can_undo': False, 'can_redo': False})
+
+    def test_delta_is_compact(self):
+        history = EditHistory(self.store, 's', 'a.png')
+        self.rgba = np.full((1000, 1000, 4), 255, dtype=np.uint8)
+        self.edit(history, (0, 0, 400, 400))
+        self.assertLess(len(self.store.get('s', 'a.png.delta1')), 2000)
+
+
+class TestRegionRefine(unittest.TestCase):
+    def setUp(self):
+        app.config['SESSION_STORE'] = 'memory'
+        self.client = app.test_client()
+        self.store = get_session_store()
+        self.session_id = str(uuid.uuid4())
+        self.store.create(self.session_id)
+        rng = np.random.default_rng(0)
+        alpha = (rng.random((60, 80)) > 0.2).astype(np.uint8) * 255
+        rgba = np.dstack([np.full((60, 80, 3), 200, np.uint8), alpha])
+        for name in ('full.png', 'rect.png'):
+            self.store.put(self.session_id, name, png_bytes(Image.fromarray(rgba, 'RGBA')))
+
+    def tearDown(self):
+        self.store.delete(self.session_id)
+        app.config['SESSION_STORE'] = 'filesystem'
+
+    def refine(self, **payload):
+        response = self.client.post('/refine', json={'session_id': self.session_id, **payload})
+        self.assertEqual(response.status_code, 200)
+        return response.get_json()
+
+    def download(self, filename):
+        return decode(self.client.get(f'/download/{self.session_id}/{filename}').data)
+
+    def test_rect_matches_full_mask(self):
+        mask = np.zeros((60, 80), dtype=np.uint8)
+        mask[10:30, 20:50] = np.linspace(0, 255, 30, dtype=np.uint8)
+        self.refine(filename='full.png', mask=base64.b64encode(png_bytes(Image.fromarray(mask))).decode())
+        crop = Image.fromarray(mask[5:35, 15:55])
+        json_data = self.refine(filename='rect.png', rect=[15, 5, 40, 30],
+                                mask=base64.b64encode(png_bytes(crop)).decode())
+        self.assertEqual(json_data['rect'], [15, 5, 40, 30])
+        np.testing.assert_array_equal(self.download('full.png'), self.download('rect.png'))
+
+    def test_binary_mask_matches_png_mask(self):
+        # Anti-aliased white-on-transparent strokes, as the editor canvas holds them
+        canvas = np.zeros((60, 80, 4), dtype=np.uint8)
+        canvas[10:30, 20:50] = 255
+        canvas[30:32, 20:50] = np.random.default_rng(2).integers(0, 256, (2, 30, 4))
+        self.refine(filename='full.png', mask=base64.b64encode(png_bytes(Image.fromarray(canvas, 'RGBA'))).decode())
+
+        erase = luminance(canvas[8:34, 18:52, :3]) > 10
+        response = self.client.post(
+            f'/refine?session_id={self.session_id}&filename=rect.png',
+            data=encode_binary_mask(erase, 18, 8),
+            content_type='application/octet-stream',
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['rect'], [18, 8, 34, 26])
+        np.testing.assert_array_equal(self.download('full.png'), self.download('rect.png'))
+
+    def test_binary_mask_outside_image(self):
+        body = encode_binary_mask(np.ones((10, 10), dtype=bool), 75, 0)
+        response = self.client.post(
+            f'/refine?session_id={self.session_id}&filename=rect.png',
+            data=body, content_type='application/octet-stream',
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_strokes(self):
+        json_data = self.refine(filename='rect.png', strokes=[{'points': [[10, 10], [30, 10]], 'size': 6}])
+        x, y, w, h = json_data['rect']
+        alpha = self.download('rect.png')[..., 3]
+        self.assertEqual(alpha[10, 20], 0)
+        self.assertEqual(alpha[y:y + h, x:x + w].shape[1], w)
+        self.assertGreater(alpha[40:, :].astype(int).sum(), 0)
+
+    def test_stroke_points_are_capped(self):
+        points = [[i % 80, i % 60] for i in range(app.config['REFINE_MAX_STROKE_POINTS'] + 1)]
+        response = self.client.post('/refine', json={'session_id': self.session_id, 'filename': 'rect.png',
+                                                     'strokes': [{'points': points, 'size': 4}]})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post('/refine', json={'session_id': self.session_id, 'filename': 'rect.png',
+                                                     'strokes': 'oops'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_undo_redo_only_touch_the_delta(self):
+        stored = self.store.get(self.session_id, 'rect.png')
+        self.refine(filename='rect.png', strokes=[{'points': [[20, 20]], 'size': 10}])
+        payload = {'session_id': self.session_id, 'filename': 'rect.png'}
+        # Neither decodes nor encodes the object
+        with unittest.mock.patch('utils.refine.Image.open', side_effect=AssertionError), \
+                unittest.mock.patch('utils.refine.Image.fromarray', side_effect=AssertionError):
+            self.assertEqual(self.client.post('/refine/undo', json=payload).status_code, 200)
+            self.assertEqual(self.client.post('/refine/redo', json=payload).status_code, 200)
+        self.assertEqual(self.store.get(self.session_id, 'rect.png'), stored)
+        self.assertEqual(self.download('rect.png')[20, 20, 3], 0)
+
+    def test_undo_redo_endpoints(self):
+        original = self.download('rect.png')
+        self.refine(filename='rect.png', strokes=[{'points': [[10, 10]], 'size': 8}])
+        edited = self.download('rect.png')
+        json_data = self.refine(filename='rect.png', strokes=[{'points': [[40, 40]], 'size': 8}])
+        self.assertEqual(json_data['can_undo'], True)
+
+        payload = {'session_id': self.session_id, 'filename': 'rect.png'}
+        json_data = self.client.post('/refine/undo', json=payload).get_json()
+        self.assertEqual(json_data['can_redo'], True)
+        np.testing.assert_array_equal(self.download('rect.png'), edited)
+        self.client.post('/refine/undo', json=payload)
+        np.testing.assert_array_equal(self.download('rect.png'), original)
+        self.assertEqual(self.client.post('/refine/undo', json=payload).status_code, 409)
+
+        self.assertEqual(self.client.post('/refine/redo', json=payload).status_code, 200)
+        np.testing.assert_array_equal(self.download('rect.png'), edited)
+
+        payload['filename'] = 'missing.png'
+        self.assertEqual(self.client.post('/refine/undo', json=payload).status_code, 404)
+
+    def test_undo_after_restart(self):
+        original = self.download('rect.png')
+        self.refine(filename='rect.png', strokes=[{'points': [[20, 20]], 'size': 10}])
+        app_module._refine_working_set = None
+        payload = {'session_id': self.session_id, 'filename': 'rect.png'}
+        self.assertEqual(self.client.post('/refine/undo', json=payload).status_code, 200)
+        np.testing.assert_array_equal(self.download('rect.png'), original)
+
+    def test_undo_of_a_lost_edit_is_refused(self):
+        self.refine(filename='rect.png', strokes=[{'points': [[20, 20]], 'size': 10}])
+        # The stored object no longer matches what the delta was recorded on
+        lost = decode(self.store.get(self.session_id, 'rect.png'))
+        lost[15:25, 15:25, 3] = 77
+        self.store.put(self.session_id, 'rect.png', png_bytes(Image.fromarray(lost, 'RGBA')))
+        app_module._refine_working_set = None
+        payload = {'session_id': self.session_id, 'filename': 'rect.png'}
+        response = self.client.post('/refine/undo', json=payload)
+        self.assertEqual(response.status_code, 409)
+        self.assertFalse(response.get_json()['can_undo'])
+        np.testing.assert_array_equal(self.download('rect.png'), lost)
+
+    def test_edits_accumulate_in_memory(self):
+        self.refine(filename='rect.png', strokes=[{'points': [[5, 5]], 'size': 4}])
+        self.refine(filename='rect.png', strokes=[{'points': [[50, 50]], 'size': 4}])
+        self.assertGreaterEqual(get_refine_working_set().stats()['dirty'], 1)
+        alpha = self.download('rect.png')[..., 3]
+        self.assertEqual(alpha[5, 5], 0)
+        self.assertEqual(alpha[50, 50], 0)
+
+    def test_other_workers_see_pending_edits(self):
+        self.refine(filename='rect.png', strokes=[{'points': [[20, 20]], 'size': 10}])
+        app_module._refine_working_set = None
+        self.assertEqual(self.download('rect.png')[20, 20, 3], 0)
+
+if __name__ == '__main__':
+    unittest.main()
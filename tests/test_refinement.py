@@ -47,6 +47,10 @@ class TestRefinement(unittest.TestCase):
         
         self.assertEqual(response.status_code, 200)
         
+        # The PNG is re-encoded when it is downloaded
+        response = self.app.get(f'/download/{self.session_id}/{self.filename}')
+        self.assertEqual(response.status_code, 200)
+        
         # Verify the image was modified
         modified_img = Image.open(self.file_path).convert("RGBA")
         r, g, b, a = modified_img.split()
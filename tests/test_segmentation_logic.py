@@ -4,8 +4,13 @@ import shutil
 import base64
 import io
 import numpy as np
-from PIL import Image
-from utils.segmentation import extract_objects
+from PIL import Image, ImageDraw
+import unittest.mock
+from utils import segmentation
+from utils.segmentation import (
+    MASK_THRESHOLD, extract_objects, mask_bboxes, downscale_for_inference, upsample_mask_roi,
+    pack_masks, reextract_objects, unpack_masks, composite_objects,
+)
 
 class TestSegmentationLogic(unittest.TestCase):
     def setUp(self):
@@ -55,5 +60,244 @@ class TestSegmentationLogic(unittest.TestCase):
         # Scaled up to 100x100, the white box should be roughly 60x60.
         print(f"Output image size: {out_img.size}")
 
+    def test_matches_full_frame_composite(self):
+        # Several instances on a textured image, masks at full size and at half size
+        rng = np.random.default_rng(0)
+        source = Image.fromarray(rng.integers(0, 255, (100, 120, 3), dtype=np.uint8))
+        source.save(self.image_path)
+
+        results = []
+        for i, (size, box) in enumerate([((120, 100), (5, 5, 40, 30)),
+                                          ((60, 50), (30, 20, 55, 45)),
+                                          ((120, 100), (70, 60, 119, 99))]):
+            mask_arr = np.zeros((size[1], size[0]), dtype=np.uint8)
+            mask_arr[box[1]:box[3], box[0]:box[2]] = 255
+            buf = io.BytesIO()
+            Image.fromarray(mask_arr).save(buf, format='PNG')
+            results.append({'label': f'obj{i}', 'score': 0.9,
+                            'mask': base64.b64encode(buf.getvalue()).decode('utf-8')})
+
+        extracted = extract_objects(self.image_path, results, self.test_dir)
+        self.assertEqual([os.path.basename(f) for f in extracted],
+                         ['obj0_1.png', 'obj1_2.png', 'obj2_3.png'])
+
+        # Reference: full-frame copy + putalpha + getbbox + crop
+        original = source.convert("RGBA")
+        for path, obj in zip(extracted, results):
+            mask = Image.open(io.BytesIO(base64.b64decode(obj['mask']))).convert("L")
+            if mask.size != original.size:
+                mask = mask.resize(original.size, Image.LANCZOS)
+            mask_arr = np.array(mask)
+            mask_arr[mask_arr < 10] = 0
+            expected = original.copy()
+            expected.putalpha(Image.fromarray(mask_arr))
+            expected = expected.crop(expected.getbbox())
+            np.testing.assert_array_equal(np.array(Image.open(path)), np.array(expected))
+
+    def test_parallel_encoding_is_deterministic(self):
+        results = [{'label': f'obj{i}', 'score': 0.9, 'mask': self.mask_b64} for i in range(6)]
+        serial_dir = os.path.join(self.test_dir, 'serial')
+        parallel_dir = os.path.join(self.test_dir, 'parallel')
+        os.makedirs(serial_dir)
+        os.makedirs(parallel_dir)
+
+        serial = extract_objects(self.image_path, results, serial_dir, workers=1)
+        parallel = extract_objects(self.image_path, results, parallel_dir, workers=3)
+
+        self.assertEqual([os.path.basename(f) for f in parallel],
+                         [f'obj{i}_{i+1}.png' for i in range(6)])
+        self.assertEqual([os.path.basename(f) for f in serial],
+                         [os.path.basename(f) for f in parallel])
+        for a, b in zip(serial, parallel):
+            np.testing.assert_array_equal(np.array(Image.open(a)), np.array(Image.open(b)))
+
+    def test_fast_encode_is_lossless(self):
+        results = [{'label': 'obj', 'score': 0.9, 'mask': self.mask_b64}]
+        fast_dir = os.path.join(self.test_dir, 'fast')
+        os.makedirs(fast_dir)
+        default = extract_objects(self.image_path, results, self.test_dir)
+        fast = extract_objects(self.image_path, results, fast_dir, fast_encode=True)
+        np.testing.assert_array_equal(np.array(Image.open(default[0])), np.array(Image.open(fast[0])))
+
+    def test_downscale_for_inference(self):
+        buf = io.BytesIO()
+        Image.new("RGB", (400, 200), "red").save(buf, format="PNG")
+        data, mime = downscale_for_inference(buf.getvalue(), "image/png", 100)
+        self.assertEqual(mime, "image/jpeg")
+        self.assertEqual(Image.open(io.BytesIO(data)).size, (100, 50))
+
+        # Already small enough: sent as-is
+        same, mime = downscale_for_inference(buf.getvalue(), "image/png", 400)
+        self.assertEqual((same, mime), (buf.getvalue(), "image/png"))
+
+    def test_segment_image_sends_downscaled_copy(self):
+        Image.new("RGB", (400, 300), "red").save(self.image_path)
+        backend = unittest.mock.Mock(model_id="m")
+        backend.segment.return_value = []
+        with unittest.mock.patch.object(segmentation, "get_cache", return_value=None):
+            segmentation.segment_image(self.image_path, backend=backend, max_side=200)
+        data, mime, _ = backend.segment.call_args.args
+        self.assertEqual(mime, "image/jpeg")
+        self.assertEqual(Image.open(io.BytesIO(data)).size, (200, 150))
+
+    def test_low_res_masks_upsampled_per_object(self):
+        # Mask at 1/4 of the image resolution, object in one corner
+        Image.new("RGB", (400, 300), "red").save(self.image_path)
+        mask_arr = np.zeros((75, 100), dtype=np.uint8)
+        mask_arr[5:20, 10:30] = 255
+        buf = io.BytesIO()
+        Image.fromarray(mask_arr).save(buf, format="PNG")
+        results = [{'label': 'obj', 'score': 0.9, 'mask': base64.b64encode(buf.getvalue()).decode('utf-8')}]
+
+        with unittest.mock.patch.object(segmentation.Image.Image, 'resize', autospec=True,
+                                        side_effect=Image.Image.resize) as resize:
+            extracted = extract_objects(self.image_path, results, self.test_dir)
+        # The resize output covers the object neighbourhood, not the 400x300 frame
+        out_w, out_h = resize.call_args.args[1]
+        self.assertLess(out_w * out_h, 400 * 300 / 4)
+
+        out = np.array(Image.open(extracted[0]))
+        self.assertAlmostEqual(out.shape[1], 80, delta=4)
+        self.assertAlmostEqual(out.shape[0], 60, delta=4)
+
+    def test_roi_resize_matches_full_frame(self):
+        rng = np.random.default_rng(1)
+        size = (301, 223)
+        for mask_size in [(75, 56), (150, 111), (301, 223), (450, 340)]:
+            mask = Image.new("L", mask_size, 0)
+            draw = ImageDraw.Draw(mask)
+            for _ in range(3):
+                x0, y0 = rng.integers(0, mask_size[0] - 10), rng.integers(0, mask_size[1] - 10)
+                draw.ellipse((x0, y0, x0 + rng.integers(3, 40), y0 + rng.integers(3, 40)), fill=255)
+
+            expected = np.array(mask.resize(size, Image.LANCZOS) if mask_size != size else mask)
+            expected[expected < 10] = 0
+
+            alpha, left, upper = upsample_mask_roi(mask, size)
+            actual = np.zeros_like(expected)
+            actual[upper:upper + alpha.shape[0], left:left + alpha.shape[1]] = alpha
+            # Same pixels up to float rounding in the resampling weights
+            self.assertLessEqual(np.abs(actual.astype(int) - expected).max(), 2, mask_size)
+            # Only the threshold boundary may flip: nothing substantial outside the ROI
+            outside = expected.copy()
+            outside[upper:upper + alpha.shape[0], left:left + alpha.shape[1]] = 0
+            self.assertLessEqual(outside.max(), MASK_THRESHOLD + 1, mask_size)
+
+    def test_upsample_mask_roi_empty(self):
+        self.assertIsNone(upsample_mask_roi(Image.new("L", (10, 10), 0), (40, 40)))
+
+    def test_mask_bboxes(self):
+        stack = np.zeros((3, 10, 20), dtype=np.uint8)
+        stack[0, 2:5, 3:7] = 200
+        stack[2, 9, 19] = 1
+        bboxes, valid = mask_bboxes(stack)
+        self.assertEqual(valid.tolist(), [True, False, True])
+        self.assertEqual(bboxes[0].tolist(), [3, 2, 7, 5])
+        self.assertEqual(bboxes[2].tolist(), [19, 9, 20, 10])
+
+    def soft_mask_results(self):
+        # Full-size soft masks (values below the threshold included) plus a low-res one
+        full = np.zeros((100, 100), dtype=np.uint8)
+        full[20:60, 30:80] = 200
+        full[15:20, 30:80] = 5
+        results = []
+        for label, score, arr in (('cat', 0.9, full), ('dog', 0.4, full[::-1].copy())):
+            buf = io.BytesIO()
+            Image.fromarray(arr).save(buf, format='PNG')
+            results.append({'label': label, 'score': score, 'mask': base64.b64encode(buf.getvalue()).decode()})
+        results.append({'label': 'cat', 'score': 0.7, 'mask': self.mask_b64})
+        return results
+
+    def load(self, files):
+        return [np.array(Image.open(os.path.join(self.test_dir, f))) for f in files]
+
+    def test_keep_masks_does_not_change_output(self):
+        results = self.soft_mask_results()
+        plain = [np.array(Image.open(f)) for f in extract_objects(self.image_path, results, self.test_dir)]
+        masks = []
+        kept = extract_objects(self.image_path, results, self.test_dir, keep_masks=masks)
+        for a, b in zip(plain, [np.array(Image.open(f)) for f in kept]):
+            np.testing.assert_array_equal(a, b)
+        self.assertEqual([m['index'] for m in masks], [0, 1, 2])
+        # Raw values below the threshold are kept
+        self.assertEqual(masks[0]['mask'].upper, 15)
+        self.assertEqual(masks[0]['mask'].decode()[0].max(), 5)
+
+    def test_pack_masks_round_trip(self):
+        masks = []
+        extract_objects(self.image_path, self.soft_mask_results(), self.test_dir, keep_masks=masks)
+        size, unpacked = unpack_masks(pack_masks((100, 100), masks))
+        self.assertEqual(size, (100, 100))
+        for a, b in zip(masks, unpacked):
+            self.assertEqual((a['label'], a['score'], a['mask'].bbox), (b['label'], b['score'], b['mask'].bbox))
+            np.testing.assert_array_equal(a['mask'].decode(), b['mask'].decode())
+
+    def test_reextract_matches_extract(self):
+        results = self.soft_mask_results()
+        masks = []
+        original = extract_objects(self.image_path, results, self.test_dir, keep_masks=masks)
+        expected = [np.array(Image.open(f)) for f in original]
+        _, masks = unpack_masks(pack_masks((100, 100), masks))
+        files = reextract_objects(self.image_path, masks, None, save=lambda name, data: None)
+        self.assertEqual(files, [os.path.basename(f) for f in original])
+
+        redone = reextract_objects(self.image_path, masks, self.test_dir)
+        for a, b in zip(expected, [np.array(Image.open(f)) for f in redone]):
+            np.testing.assert_array_equal(a, b)
+
+    def test_reextract_parameters(self):
+        masks = []
+        extract_objects(self.image_path, self.soft_mask_results(), self.test_dir, keep_masks=masks)
+        save = lambda name, data: None
+
+        self.assertEqual(reextract_objects(self.image_path, masks, None, min_score=0.5, save=save),
+                         ['cat_1.png', 'cat_3.png'])
+        self.assertEqual(reextract_objects(self.image_path, masks, None, labels=['dog'], save=save),
+                         ['dog_2.png'])
+
+        # A threshold below the faint band keeps it
+        low = reextract_objects(self.image_path, masks, self.test_dir, threshold=1, labels=['cat'])
+        self.assertEqual(Image.open(low[0]).size, (50, 45))
+        feathered = reextract_objects(self.image_path, masks, self.test_dir, feather=3, labels=['cat'])
+        alpha = np.array(Image.open(feathered[0]))[..., 3]
+        self.assertGreater(Image.open(feathered[0]).size[0], 50)
+        # Edges become gradual
+        self.assertGreater(len(np.unique(alpha)), 10)
+
+    def test_lazy_extract_composites_on_demand(self):
+        results = self.soft_mask_results()
+        expected = [np.array(Image.open(f)) for f in extract_objects(self.image_path, results, self.test_dir)]
+        shutil.rmtree(self.test_dir)
+        os.makedirs(self.test_dir)
+        Image.new("RGB", (100, 100), "red").save(self.image_path)
+
+        masks, descriptors = [], []
+        # Neither the source image is decoded nor anything written
+        with unittest.mock.patch('utils.segmentation._load_rgb', side_effect=AssertionError):
+            files = extract_objects(self.image_path, results, self.test_dir, keep_masks=masks,
+                                    describe=descriptors, lazy=True)
+        self.assertEqual(os.listdir(self.test_dir), ['test_image.png'])
+        self.assertEqual(files, [d['file'] for d in descriptors])
+        self.assertEqual(descriptors[0]['bbox'], [30, 20, 50, 40])
+        self.assertEqual((descriptors[1]['label'], descriptors[1]['score']), ('dog', 0.4))
+
+        _, masks = unpack_masks(pack_masks((100, 100), masks))
+        for a, b in zip(expected, composite_objects(self.image_path, masks, descriptors)):
+            np.testing.assert_array_equal(a, b)
+
+        with self.assertRaises(Exception):
+            extract_objects(self.image_path, results, self.test_dir, lazy=True)
+
+    def test_lazy_reextract_keeps_parameters(self):
+        masks = []
+        extract_objects(self.image_path, self.soft_mask_results(), self.test_dir, keep_masks=masks)
+        feathered = reextract_objects(self.image_path, masks, self.test_dir, threshold=1, feather=3, labels=['cat'])
+        descriptors = []
+        files = reextract_objects(self.image_path, masks, None, threshold=1, feather=3, labels=['cat'],
+                                  describe=descriptors, lazy=True)
+        self.assertEqual(files, [os.path.basename(f) for f in feathered])
+        for path, rgba in zip(feathered, composite_objects(self.image_path, masks, descriptors)):
+            np.testing.assert_array_equal(np.array(Image.open(path)), rgba)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,225 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import unittest.mock
+
+from utils.session_store import FilesystemSessionStore, MemorySessionStore, SessionJanitor
+
+
+class StoreContract:
+    """Behaviour both session stores share."""
+
+    def make_store(self):
+        raise NotImplementedError
+
+    def setUp(self):
+        self.store = self.make_store()
+
+    def test_put_get_names(self):
+        self.store.create('s1')
+        self.store.put('s1', 'b.png', b'bbb')
+        self.store.put('s1', 'a.png', b'aa')
+        self.assertTrue(self.store.exists('s1'))
+        self.assertEqual(self.store.get('s1', 'a.png'), b'aa')
+        self.assertEqual(self.store.names('s1'), ['a.png', 'b.png'])
+
+    def test_overwrite(self):
+        self.store.create('s1')
+        self.store.put('s1', 'a.png', b'old')
+        self.store.put('s1', 'a.png', b'new!')
+        self.assertEqual(self.store.get('s1', 'a.png'), b'new!')
+
+    def test_missing_returns_none(self):
+        self.assertIsNone(self.store.get('nope', 'a.png'))
+        self.store.create('s1')
+        self.assertIsNone(self.store.get('s1', 'a.png'))
+        self.assertEqual(self.store.names('nope'), [])
+
+    def test_delete(self):
+        self.store.create('s1')
+        self.store.put('s1', 'a.png', b'aa')
+        self.store.delete('s1')
+        self.assertFalse(self.store.exists('s1'))
+        self.assertIsNone(self.store.get('s1', 'a.png'))
+
+    def test_remove(self):
+        self.store.create('s1')
+        self.store.put('s1', 'a.png', b'aa')
+        self.store.put('s1', 'b.png', b'bbb')
+        self.store.remove('s1', 'a.png')
+        self.store.remove('s1', 'missing.png')
+        self.assertEqual(self.store.names('s1'), ['b.png'])
+        self.assertEqual(self.store.stats()['bytes'], 3)
+
+    def test_access_refreshes_expiry(self):
+        with unittest.mock.patch('time.time', return_value=1000):
+            self.store.create('s1')
+            self.store.put('s1', 'a.png', b'aa')
+        with unittest.mock.patch('time.time', return_value=1800):
+            self.store.get('s1', 'a.png')
+        with unittest.mock.patch('time.time', return_value=2000):
+            self.assertEqual(self.store.expire(900), 0)
+        with unittest.mock.patch('time.time', return_value=2800):
+            self.assertEqual(self.store.expire(900), 1)
+        self.assertFalse(self.store.exists('s1'))
+        self.assertEqual(self.store.stats()['expired'], 1)
+
+    def test_expire_in_batches(self):
+        with unittest.mock.patch('time.time', return_value=1000):
+            for i in range(5):
+                self.store.create(f's{i}')
+        with unittest.mock.patch('time.time', return_value=5000):
+            self.assertEqual(self.store.expire(900, limit=2), 2)
+            self.assertEqual(self.store.expire(900, limit=2), 2)
+            self.assertEqual(self.store.expire(900, limit=2), 1)
+        self.assertEqual(self.store.stats()['sessions'], 0)
+
+    def test_evict_to_quota(self):
+        for sid in ('a', 'b', 'c'):
+            self.store.create(sid)
+            self.store.put(sid, 'f', b'x' * 30)
+        self.assertEqual(self.store.evict(40), 2)
+        self.assertFalse(self.store.exists('a'))
+        self.assertFalse(self.store.exists('b'))
+        self.assertTrue(self.store.exists('c'))
+        stats = self.store.stats()
+        self.assertEqual(stats['bytes'], 30)
+        self.assertEqual(stats['evictions'], 2)
+
+    def test_janitor(self):
+        with unittest.mock.patch('time.time', return_value=1000):
+            self.store.create('old')
+        self.store.create('new')
+        self.store.put('new', 'f', b'x' * 30)
+        janitor = SessionJanitor(self.store, ttl=900, max_bytes=10, interval=0.01, batch_size=10)
+        janitor.start()
+        try:
+            deadline = time.time() + 5
+            while self.store.stats()['sessions'] and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            janitor.stop()
+        stats = self.store.stats()
+        self.assertEqual(stats['sessions'], 0)
+        self.assertEqual(stats['bytes'], 0)
+        self.assertEqual(stats['expired'], 1)
+        self.assertEqual(stats['evictions'], 1)
+
+    def test_rejects_path_traversal(self):
+        self.store.create('s1')
+        with self.assertRaises(ValueError):
+            self.store.put('s1', '../escape.png', b'x')
+        with self.assertRaises(ValueError):
+            self.store.get('..', 'a.png')
+
+
+class TestFilesystemSessionStore(StoreContract, unittest.TestCase):
+    def make_store(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, True)
+        return FilesystemSessionStore(self.root)
+
+    def test_files_live_on_disk(self):
+        self.store.create('s1')
+        self.store.put('s1', 'a.png', b'aa')
+        path = self.store.path('s1', 'a.png')
+        self.assertEqual(path, os.path.join(self.root, 's1', 'a.png'))
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'aa')
+
+    def test_index_loaded_from_disk(self):
+        os.makedirs(os.path.join(self.root, 'old'))
+        os.makedirs(os.path.join(self.root, 'new'))
+        with open(os.path.join(self.root, 'old', 'a.png'), 'wb') as f:
+            f.write(b'x' * 10)
+        past = time.time() - 1000
+        os.utime(os.path.join(self.root, 'old'), (past, past))
+
+        store = FilesystemSessionStore(self.root)
+        self.assertEqual(store.stats()['sessions'], 2)
+        self.assertEqual(store.stats()['bytes'], 10)
+        self.assertEqual(store.expire(900), 1)
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'old')))
+        self.assertTrue(store.exists('new'))
+
+    def test_expire_uses_index_not_directory_scan(self):
+        with unittest.mock.patch('time.time', return_value=1000):
+            self.store.create('old')
+        with unittest.mock.patch('time.time', return_value=1950):
+            self.store.create('new')
+            with unittest.mock.patch('os.listdir') as listdir:
+                self.assertEqual(self.store.expire(900), 1)
+                listdir.assert_not_called()
+        self.assertFalse(self.store.exists('old'))
+        self.assertTrue(self.store.exists('new'))
+
+
+    def test_sessions_used_by_another_process_are_kept(self):
+        with unittest.mock.patch('time.time', return_value=1000):
+            self.store.create('s1')
+            self.store.put('s1', 'a.png', b'aa')
+            self.store.create('s2')
+            other = FilesystemSessionStore(self.root)
+        with unittest.mock.patch('time.time', return_value=1800):
+            other.get('s1', 'a.png')
+        with unittest.mock.patch('time.time', return_value=2000):
+            self.assertEqual(self.store.expire(900), 1)
+            self.assertTrue(self.store.exists('s1'))
+            self.assertFalse(self.store.exists('s2'))
+        with unittest.mock.patch('time.time', return_value=2100):
+            other.path('s1', 'a.png')
+            self.assertEqual(self.store.evict(0), 0)
+            self.assertTrue(self.store.exists('s1'))
+        with unittest.mock.patch('time.time', return_value=3100):
+            self.assertEqual(self.store.expire(900), 1)
+        self.assertFalse(self.store.exists('s1'))
+        self.assertEqual(self.store.stats()['expired'], 2)
+
+class TestMemorySessionStore(StoreContract, unittest.TestCase):
+    def make_store(self):
+        return MemorySessionStore(max_bytes=100)
+
+
+    def test_no_filesystem_path(self):
+        self.store.create('s1')
+        self.store.put('s1', 'a.png', b'aa')
+        self.assertIsNone(self.store.path('s1', 'a.png'))
+
+    def test_lru_eviction_within_budget(self):
+        for sid in ('a', 'b', 'c'):
+            self.store.create(sid)
+            self.store.put(sid, 'f', b'x' * 40)
+        # 'a' was evicted to make room for 'c'
+        self.assertFalse(self.store.exists('a'))
+
+        # Reading 'b' makes 'c' the least recently used
+        self.store.get('b', 'f')
+        self.store.create('d')
+        self.store.put('d', 'f', b'x' * 40)
+        self.assertTrue(self.store.exists('b'))
+        self.assertFalse(self.store.exists('c'))
+
+        stats = self.store.stats()
+        self.assertEqual(stats['evictions'], 2)
+        self.assertEqual(stats['bytes'], 80)
+        self.assertLessEqual(stats['bytes'], stats['max_bytes'])
+
+    def test_session_being_written_is_kept(self):
+        self.store.create('big')
+        self.store.put('big', 'f', b'x' * 150)
+        self.assertEqual(self.store.get('big', 'f'), b'x' * 150)
+
+    def test_expire_untouched(self):
+        with unittest.mock.patch('time.time', return_value=1000):
+            self.store.create('old')
+        with unittest.mock.patch('time.time', return_value=1950):
+            self.store.create('new')
+            self.assertEqual(self.store.expire(900), 1)
+        self.assertFalse(self.store.exists('old'))
+        self.assertTrue(self.store.exists('new'))
+
+
+if __name__ == '__main__':
+    unittest.main()
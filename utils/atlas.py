@@ -0,0 +1,52 @@
+import math
+
+import numpy as np
+
+# Transparent gap around every crop, so scaled drawing never samples a neighbour
+ATLAS_PADDING = 1
+# Browsers handle images up to a few thousand pixels per side well
+ATLAS_MAX_WIDTH = 4096
+
+
+def pack_shelves(sizes, padding=ATLAS_PADDING, max_width=ATLAS_MAX_WIDTH):
+    """
+    Shelf packing of (width, height) rectangles: tallest first, left to right,
+    starting a new shelf when the row is full. The atlas is roughly square
+    (at most `max_width` wide, or the widest rectangle if that is wider).
+    Returns (atlas_width, atlas_height, [(x, y), ...] in input order).
+    """
+    if not sizes:
+        return 0, 0, []
+    area = sum((w + padding) * (h + padding) for w, h in sizes)
+    widest = max(w for w, _ in sizes) + padding
+    width = max(widest, min(max_width, int(math.ceil(math.sqrt(area)))))
+
+    positions = [None] * len(sizes)
+    x = y = shelf_height = 0
+    used_width = 0
+    for i in sorted(range(len(sizes)), key=lambda i: (-sizes[i][1], -sizes[i][0])):
+        w, h = sizes[i]
+        if x and x + w + padding > width:
+            y += shelf_height
+            x = shelf_height = 0
+        positions[i] = (x, y)
+        x += w + padding
+        used_width = max(used_width, x)
+        shelf_height = max(shelf_height, h + padding)
+    return used_width, y + shelf_height, positions
+
+
+def build_atlas(crops, padding=ATLAS_PADDING, max_width=ATLAS_MAX_WIDTH):
+    """
+    Pack (h, w, 4) uint8 RGBA crops into one transparent RGBA array.
+    Returns (atlas, rects) with rects as [x, y, w, h] in input order.
+    """
+    sizes = [(crop.shape[1], crop.shape[0]) for crop in crops]
+    width, height, positions = pack_shelves(sizes, padding, max_width)
+    atlas = np.zeros((max(1, height), max(1, width), 4), dtype=np.uint8)
+    rects = []
+    for crop, (x, y) in zip(crops, positions):
+        h, w = crop.shape[:2]
+        atlas[y:y + h, x:x + w] = crop
+        rects.append([x, y, w, h])
+    return atlas, rects
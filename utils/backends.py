@@ -0,0 +1,272 @@
+import base64
+import hashlib
+import io
+import os
+import threading
+import time
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter
+
+# Labels used by the fake engine; a slice of the COCO classes mask2former knows
+FAKE_LABELS = ["person", "car", "dog", "cat", "chair", "bottle", "cup", "bicycle"]
+
+
+def encode_mask(mask_arr):
+    """Encode a 2-D uint8 array as the base64 PNG string the API returns."""
+    buf = io.BytesIO()
+    Image.fromarray(mask_arr.astype(np.uint8), mode="L").save(buf, format="PNG")
+    return base64.b64encode(buf.getvalue()).decode("utf-8")
+
+
+def standardize_results(results):
+    """
+    Normalize a backend response to [{'score': float, 'label': str, 'mask': base64str}].
+    """
+    standardized_results = []
+    if isinstance(results, list):
+        for item in results:
+            standardized_results.append({
+                'score': item.get('score', 0),
+                'label': item.get('label', 'object'),
+                'mask': item.get('mask') # Pass raw base64 to next step
+            })
+    else:
+         # Some errors return a dict
+         if 'error' in results:
+             raise Exception(f"API Error: {results['error']}")
+         raise Exception(f"Unexpected API response type: {type(results)}")
+    return standardized_results
+
+
+class SegmentationBackend:
+    """
+    Interface for segmentation engines. `segment` takes the raw image bytes and
+    returns the standardized result list, so extract_objects never needs to
+    know which engine produced it.
+    """
+
+    # Identifies the engine/model in cache keys
+    model_id = None
+
+    def segment(self, data, mime_type, api_token=None):
+        raise NotImplementedError
+
+
+class RemoteBackend(SegmentationBackend):
+    """Hugging Face Inference API (router) through a shared InferenceClient."""
+
+    def __init__(self, client, model_id):
+        self.client = client
+        self.model_id = model_id
+
+    def segment(self, data, mime_type, api_token=None):
+        headers = {
+            "x-wait-for-model": "true",
+            "Content-Type": mime_type,
+        }
+        if api_token:
+            headers["Authorization"] = f"Bearer {api_token}"
+
+        response = self.client.post(data, headers=headers)
+
+        if response.status_code != 200:
+            error_msg = f"API Error: {response.status_code} - {response.text}"
+            if response.status_code == 401:
+                 raise Exception("Authentication failed. Please check your HF_API_TOKEN in .env.")
+            raise Exception(error_msg)
+
+        # API request using requests returns list of dicts: [{'score': float, 'label': str, 'mask': 'base64string'}]
+        # NOTE: mask2former usually returns mask as base64 string when using raw API
+        return standardize_results(response.json())
+
+
+def _label_components(fg):
+    """
+    4-connected component labelling of a boolean array.
+
+    Works on horizontal runs rather than pixels: runs on adjacent rows that
+    overlap are unioned, so the Python loop is O(number of runs).
+    Returns an int32 label image (0 = background) and the label count.
+    """
+    h, w = fg.shape
+    padded = np.zeros((h, w + 2), dtype=np.int8)
+    padded[:, 1:-1] = fg
+    edges = np.diff(padded, axis=1)
+    run_rows, run_starts = np.nonzero(edges == 1)
+    _, run_ends = np.nonzero(edges == -1)
+
+    parent = list(range(len(run_rows)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    # Runs are ordered by row, then column; walk adjacent rows with two pointers
+    row_offsets = np.searchsorted(run_rows, np.arange(h + 1))
+    for y in range(1, h):
+        a, a_end = row_offsets[y - 1], row_offsets[y]
+        b, b_end = row_offsets[y], row_offsets[y + 1]
+        while a < a_end and b < b_end:
+            if run_starts[a] < run_ends[b] and run_starts[b] < run_ends[a]:
+                ra, rb = find(a), find(b)
+                if ra != rb:
+                    parent[max(ra, rb)] = min(ra, rb)
+            if run_ends[a] < run_ends[b]:
+                a += 1
+            else:
+                b += 1
+
+    roots = np.array([find(i) for i in range(len(parent))], dtype=np.int64)
+    _, run_labels = np.unique(roots, return_inverse=True)
+    labels = np.zeros((h, w), dtype=np.int32)
+    for row, start, end, label in zip(run_rows, run_starts, run_ends, run_labels):
+        labels[row, start:end] = label + 1
+    return labels, int(run_labels.max()) + 1 if len(run_labels) else 0
+
+
+def _otsu_threshold(values):
+    hist = np.bincount(values.ravel(), minlength=256).astype(np.float64)
+    total = hist.sum()
+    if total == 0:
+        return 0
+    bins = np.arange(256)
+    weight_bg = np.cumsum(hist)
+    weight_fg = total - weight_bg
+    mean_bg = np.cumsum(hist * bins) / np.maximum(weight_bg, 1)
+    mean_fg = ((hist * bins).sum() - np.cumsum(hist * bins)) / np.maximum(weight_fg, 1)
+    between = weight_bg * weight_fg * (mean_bg - mean_fg) ** 2
+    return int(np.argmax(between))
+
+
+class ClassicalBackend(SegmentationBackend):
+    """
+    Local CPU engine with no model weights: background subtraction against the
+    border colour, Otsu threshold, a small morphological clean-up and connected
+    components. Good for product shots on plain backgrounds; it has no notion of
+    classes, so every instance is labelled "object".
+
+    Masks are produced at a working resolution of at most `max_side` pixels;
+    extract_objects scales them back up to the original.
+    """
+
+    model_id = "local/classical"
+
+    def __init__(self, max_side=512, min_area=0.002, max_objects=20):
+        self.max_side = max_side
+        self.min_area = min_area
+        self.max_objects = max_objects
+
+    def segment(self, data, mime_type, api_token=None):
+        image = Image.open(io.BytesIO(data)).convert("RGB")
+        image.thumbnail((self.max_side, self.max_side))
+        arr = np.asarray(image).astype(np.int16)
+
+        border = np.concatenate([arr[0], arr[-1], arr[:, 0], arr[:, -1]])
+        background = np.median(border, axis=0)
+        distance = np.abs(arr - background).sum(axis=2)
+        distance = np.clip(distance * 255 // max(int(distance.max()), 1), 0, 255).astype(np.uint8)
+
+        threshold = max(_otsu_threshold(distance), 16)
+        fg = Image.fromarray(((distance > threshold) * 255).astype(np.uint8))
+        # Opening removes speckle, closing fills pinholes
+        fg = fg.filter(ImageFilter.MinFilter(3)).filter(ImageFilter.MaxFilter(3))
+        fg = fg.filter(ImageFilter.MaxFilter(3)).filter(ImageFilter.MinFilter(3))
+        fg = np.asarray(fg) > 0
+
+        labels, count = _label_components(fg)
+        if count == 0:
+            return []
+        areas = np.bincount(labels.ravel(), minlength=count + 1)[1:]
+        min_pixels = self.min_area * labels.size
+        order = [i for i in np.argsort(-areas) if areas[i] >= min_pixels][:self.max_objects]
+
+        results = []
+        for i in order:
+            component = labels == (i + 1)
+            # Score: how strongly the component stands out from the background
+            score = float(np.clip(distance[component].mean() / 255.0, 0, 1))
+            results.append({
+                'score': round(score, 4),
+                'label': 'object',
+                'mask': encode_mask(component * 255),
+            })
+        return results
+
+
+class LocalModelBackend(SegmentationBackend):
+    """
+    Runs a locally stored segmentation model through transformers' pipeline.
+    Needs `transformers` and `torch` (not in requirements.txt) plus the weights
+    on disk; they are imported on first use.
+    """
+
+    def __init__(self, model_path):
+        self.model_path = model_path
+        self.model_id = f"local/{os.path.basename(os.path.normpath(model_path))}"
+        self._pipe = None
+        self._pipe_lock = threading.Lock()
+
+    def _get_pipe(self):
+        # Batch uploads call in from several threads; load the model only once
+        with self._pipe_lock:
+            if self._pipe is None:
+                try:
+                    from transformers import pipeline
+                except ImportError:
+                    raise Exception("Local model backend requires 'transformers' and 'torch' to be installed.")
+                self._pipe = pipeline("image-segmentation", model=self.model_path)
+            return self._pipe
+
+    def segment(self, data, mime_type, api_token=None):
+        pipe = self._get_pipe()
+        image = Image.open(io.BytesIO(data)).convert("RGB")
+        outputs = pipe(image, subtask="instance")
+        return [{
+            'score': float(item.get('score') or 0),
+            'label': item.get('label', 'object'),
+            'mask': encode_mask(np.asarray(item['mask'].convert("L"))),
+        } for item in outputs]
+
+
+class FakeBackend(SegmentationBackend):
+    """
+    Deterministic offline engine for load tests and development. The same image
+    bytes always yield the same ellipse/rectangle instances, sized to the image.
+    `latency` (seconds) simulates the network/model wait.
+    """
+
+    model_id = "fake/deterministic"
+
+    def __init__(self, num_objects=5, latency=0.0):
+        self.num_objects = num_objects
+        self.latency = latency
+
+    def segment(self, data, mime_type, api_token=None):
+        width, height = Image.open(io.BytesIO(data)).size
+        seed = int.from_bytes(hashlib.sha256(data).digest()[:8], "big")
+        rng = np.random.default_rng(seed)
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        results = []
+        for i in range(self.num_objects):
+            w = max(1, int(width * rng.uniform(0.1, 0.4)))
+            h = max(1, int(height * rng.uniform(0.1, 0.4)))
+            x0 = int(rng.integers(0, max(1, width - w)))
+            y0 = int(rng.integers(0, max(1, height - h)))
+
+            mask = Image.new("L", (width, height), 0)
+            draw = ImageDraw.Draw(mask)
+            shape = draw.ellipse if i % 2 == 0 else draw.rectangle
+            shape((x0, y0, x0 + w, y0 + h), fill=255)
+
+            results.append({
+                'score': round(float(rng.uniform(0.5, 1.0)), 4),
+                'label': FAKE_LABELS[i % len(FAKE_LABELS)],
+                'mask': encode_mask(np.asarray(mask)),
+            })
+        return results
@@ -0,0 +1,233 @@
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+DEFAULT_CACHE_PATH = os.path.join(tempfile.gettempdir(), 'instance_seg_app_cache.sqlite3')
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024  # 256MB of stored results
+DEFAULT_TTL = 24 * 60 * 60  # 1 day
+
+
+def cache_key(data, model_id):
+    """
+    Content address for a segmentation request: sha256 over the model id and
+    the exact image bytes, so the same photo sent to the same model hits the
+    same entry no matter what it was called on upload.
+    """
+    h = hashlib.sha256()
+    h.update(model_id.encode('utf-8'))
+    h.update(b'\0')
+    h.update(data)
+    return h.hexdigest()
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.followers = 0
+
+
+class SingleFlight:
+    """
+    In-flight deduplication: while a call for `key` is running, further calls
+    for the same key wait for it and get its result (or its exception)
+    instead of starting their own. Nothing is kept once the call finishes;
+    remembering results is the cache's job.
+    """
+
+    def __init__(self):
+        self.coalesced = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        """Return (fn(), shared): shared is True if another caller's call was reused."""
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                flight.followers += 1
+                self.coalesced += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True
+
+        try:
+            flight.result = fn()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result, False
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._flights)
+
+
+class SegmentationCache:
+    """
+    Persistent LRU cache for standardized segmentation results
+    ([{'score', 'label', 'mask'}, ...]).
+
+    Entries are stored in a small SQLite database so they survive restarts and
+    are shared between worker processes. Eviction is by total payload size
+    (least recently used first) and by age (entries older than `ttl` seconds
+    are treated as misses and dropped). The cache is only an optimisation:
+    database errors (e.g. "database is locked" under contention) count as a
+    miss or a skipped store and are tallied in `errors`.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_bytes=DEFAULT_MAX_BYTES, ttl=DEFAULT_TTL):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " created REAL NOT NULL,"
+            " accessed REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)")
+
+    def get(self, key):
+        """Return the cached result list for `key`, or None on a miss."""
+        now = time.time()
+        with self._lock:
+            try:
+                row = self._conn.execute(
+                    "SELECT value, created FROM results WHERE key = ?", (key,)
+                ).fetchone()
+                if row is None:
+                    self.misses += 1
+                    return None
+                value, created = row
+                if self.ttl is not None and now - created > self.ttl:
+                    self._conn.execute("DELETE FROM results WHERE key = ?", (key,))
+                    self.evictions += 1
+                    self.misses += 1
+                    return None
+                self._conn.execute("UPDATE results SET accessed = ? WHERE key = ?", (now, key))
+            except sqlite3.Error as e:
+                print(f"Segmentation cache read failed: {e}")
+                self.errors += 1
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(value)
+
+    def set(self, key, results):
+        """Store `results` under `key` and evict down to the size budget."""
+        value = json.dumps(results)
+        size = len(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            # Would evict everything else and still not fit
+            return
+        now = time.time()
+        with self._lock:
+            try:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO results (key, value, size, created, accessed)"
+                    " VALUES (?, ?, ?, ?, ?)",
+                    (key, value, size, now, now),
+                )
+                self._evict(now)
+            except sqlite3.Error as e:
+                print(f"Segmentation cache write failed: {e}")
+                self.errors += 1
+
+    def _evict(self, now):
+        if self.ttl is not None:
+            cur = self._conn.execute("DELETE FROM results WHERE created < ?", (now - self.ttl,))
+            self.evictions += max(cur.rowcount, 0)
+        if self.max_bytes is None:
+            return
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self._conn.execute(
+            "SELECT key, size FROM results ORDER BY accessed ASC"
+        ).fetchall():
+            if total <= self.max_bytes:
+                break
+            self._conn.execute("DELETE FROM results WHERE key = ?", (key,))
+            total -= size
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM results")
+
+    def stats(self):
+        with self._lock:
+            try:
+                entries, total = self._conn.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results"
+                ).fetchone()
+            except sqlite3.Error:
+                entries = total = None
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'errors': self.errors,
+            'entries': entries,
+            'bytes': total,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """
+    Process-wide cache configured from the environment:
+    SEG_CACHE_PATH, SEG_CACHE_MAX_BYTES, SEG_CACHE_TTL (seconds).
+    Set SEG_CACHE_DISABLED=1 to turn caching off entirely (returns None).
+    """
+    global _cache
+    if os.getenv('SEG_CACHE_DISABLED', '').lower() in ('1', 'true', 'yes'):
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = SegmentationCache(
+                path=os.getenv('SEG_CACHE_PATH', DEFAULT_CACHE_PATH),
+                max_bytes=int(os.getenv('SEG_CACHE_MAX_BYTES', DEFAULT_MAX_BYTES)),
+                ttl=float(os.getenv('SEG_CACHE_TTL', DEFAULT_TTL)),
+            )
+        return _cache
+
+
+def set_cache(cache):
+    """Replace the process-wide cache (None resets it to the env default)."""
+    global _cache
+    with _cache_lock:
+        _cache = cache
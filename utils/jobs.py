@@ -0,0 +1,136 @@
+import json
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Job:
+    """
+    State of one background pipeline run. Progress is kept as an ordered list
+    of events so pollers can read a snapshot and SSE subscribers can resume
+    from the last event id they saw.
+    """
+
+    def __init__(self):
+        self.id = str(uuid.uuid4())
+        self.status = 'queued'
+        self.stage = None
+        self.files = []
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.finished_at = None
+        self._events = []
+        self._cond = threading.Condition()
+
+    @property
+    def finished(self):
+        return self.status in ('done', 'error')
+
+    def emit(self, event_type, **data):
+        with self._cond:
+            if event_type == 'stage':
+                self.stage = data.get('stage')
+            elif event_type == 'object':
+                self.files.append(data['file'])
+            self._events.append({'id': len(self._events) + 1, 'type': event_type, 'data': data})
+            self._cond.notify_all()
+
+    def _finish(self, status, result=None, error=None):
+        with self._cond:
+            self.status = status
+            self.result = result
+            self.error = error
+            self.finished_at = time.time()
+            if status == 'done':
+                self._events.append({'id': len(self._events) + 1, 'type': 'done', 'data': result})
+            else:
+                self._events.append({'id': len(self._events) + 1, 'type': 'error', 'data': {'error': error}})
+            self._cond.notify_all()
+
+    def wait_events(self, after=0, timeout=None):
+        """Events with id > `after`, blocking up to `timeout` seconds for new ones."""
+        with self._cond:
+            if len(self._events) <= after and not self.finished:
+                self._cond.wait(timeout)
+            return self._events[after:], self.finished
+
+    def snapshot(self):
+        with self._cond:
+            return {
+                'job_id': self.id,
+                'status': self.status,
+                'stage': self.stage,
+                'files': list(self.files),
+                'result': self.result,
+                'error': self.error,
+            }
+
+
+class JobError(Exception):
+    """Pipeline failure carrying the HTTP status the synchronous endpoint would return."""
+
+    def __init__(self, message, status=500):
+        super().__init__(message)
+        self.status = status
+
+
+class JobManager:
+    """
+    In-process worker pool for upload pipelines (no external broker).
+    Finished jobs are kept for `ttl` seconds so clients can still fetch the result.
+    """
+
+    def __init__(self, max_workers=4, ttl=3600):
+        self.ttl = ttl
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='upload-job')
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        """Run fn(job, *args, **kwargs) on the pool; its return value becomes the job result."""
+        job = Job()
+        with self._lock:
+            self._prune()
+            self._jobs[job.id] = job
+        self._pool.submit(self._run, job, fn, args, kwargs)
+        return job
+
+    def _run(self, job, fn, args, kwargs):
+        job.status = 'running'
+        try:
+            result = fn(job, *args, **kwargs)
+        except Exception as e:
+            job._finish('error', error=str(e))
+        else:
+            job._finish('done', result=result)
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _prune(self):
+        now = time.time()
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.finished_at is not None and now - job.finished_at > self.ttl]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait=wait)
+
+
+def sse_stream(job, last_event_id=0, keepalive=15):
+    """Server-Sent Events for a job, ending after the final done/error event."""
+    after = last_event_id
+    while True:
+        events, finished = job.wait_events(after, timeout=keepalive)
+        if not events:
+            if finished:
+                return
+            yield ": keep-alive\n\n"
+            continue
+        for event in events:
+            after = event['id']
+            yield f"id: {event['id']}\nevent: {event['type']}\ndata: {json.dumps(event['data'])}\n\n"
@@ -0,0 +1,148 @@
+import io
+import math
+import mmap
+import struct
+import tempfile
+import zlib
+
+import numpy as np
+from PIL import Image
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# Compressed bytes collected before an IDAT chunk is written
+PNG_CHUNK_SIZE = 256 * 1024
+# PNG row filter "Up": each byte minus the byte above it
+PNG_FILTER_UP = 2
+
+
+def band_rows(width, bytes_per_pixel, budget):
+    """Rows per band so a band of `width` pixels stays within `budget` bytes."""
+    return max(1, int(budget // max(1, width * bytes_per_pixel)))
+
+
+class MappedImage:
+    """
+    An (H, W, 3) uint8 RGB array backed by an anonymous temporary file.
+    `release()` drops the pages from this process's resident set (they stay
+    in the page cache, or go to disk under pressure), so touching the whole
+    image over time does not grow RSS.
+    """
+
+    def __init__(self, width, height, dir=None):
+        self.size = (width, height)
+        nbytes = max(1, width * height * 3)
+        with tempfile.TemporaryFile(dir=dir) as tmp:
+            tmp.truncate(nbytes)
+            # The mapping keeps the (already unlinked) file alive
+            self._mmap = mmap.mmap(tmp.fileno(), nbytes)
+        self.array = np.frombuffer(self._mmap, dtype=np.uint8, count=width * height * 3).reshape(height, width, 3)
+
+    def release(self):
+        if hasattr(self._mmap, 'madvise'):
+            self._mmap.flush()
+            self._mmap.madvise(mmap.MADV_DONTNEED)
+
+    def close(self):
+        self.array = None
+        try:
+            self._mmap.close()
+        except BufferError:
+            # A view is still referenced (e.g. by a traceback); the mapping goes with it
+            pass
+
+
+def decode_to_memmap(image, budget, dir=None):
+    """
+    Decode an image once into a MappedImage. The conversion to RGB is done
+    in row bands of at most `budget` bytes, so the only full-size copy in RAM
+    is the decoder's own, which is released before returning.
+    """
+    if isinstance(image, (bytes, bytearray)):
+        image = io.BytesIO(image)
+    with Image.open(image) as im:
+        width, height = im.size
+        mapped = MappedImage(width, height, dir=dir)
+        # Crop and converted copy in PIL (4 bytes per pixel each), the NumPy view and the mapped pages
+        rows = band_rows(width, 16, budget)
+        for y in range(0, height, rows):
+            y1 = min(height, y + rows)
+            mapped.array[y:y1] = np.asarray(im.crop((0, y, width, y1)).convert("RGB"))
+            mapped.release()
+    return mapped
+
+
+def thumbnail_from_memmap(mapped, max_side, budget):
+    """
+    RGB PIL image of a MappedImage with its longer side at most `max_side`.
+    The image is box-averaged by an integer factor in row bands of at most
+    `budget` bytes (each a multiple of the factor, so bands join without
+    seams), and only that reduced copy is resized the rest of the way.
+    """
+    width, height = mapped.size
+    factor = max(1, max(width, height) // max_side)
+    # A band in PIL (4 bytes per pixel) plus its reduced copy
+    rows = max(factor, band_rows(width, 8, budget) // factor * factor)
+    parts = []
+    for y in range(0, height, rows):
+        parts.append(np.asarray(Image.fromarray(mapped.array[y:min(height, y + rows)]).reduce(factor)))
+        mapped.release()
+    # Final size as Image.thumbnail would pick it from the full image
+    aspect = width / height
+    if aspect >= 1:
+        size = (max_side, _round_aspect(max_side / aspect, lambda n: 0 if n == 0 else abs(aspect - max_side / n)))
+    else:
+        size = (_round_aspect(max_side * aspect, lambda n: abs(aspect - n / max_side)), max_side)
+    return Image.fromarray(np.concatenate(parts)).resize(size, Image.LANCZOS)
+
+
+def _round_aspect(number, key):
+    return max(min(math.floor(number), math.ceil(number), key=key), 1)
+
+
+class PNGStreamWriter:
+    """
+    Writes an 8-bit RGBA PNG band by band, so the image never has to be held
+    in memory at once. Every row uses the Up filter, which can be computed
+    for a whole band in one NumPy operation.
+    """
+
+    def __init__(self, out, width, height, compress_level=6):
+        self.out = out
+        self.width = width
+        self.height = height
+        self.rows_written = 0
+        self._previous = np.zeros(width * 4, dtype=np.uint8)
+        self._compressor = zlib.compressobj(compress_level)
+        self._pending = bytearray()
+        out.write(PNG_SIGNATURE)
+        # Bit depth 8, colour type 6 (RGBA), default compression/filter, no interlace
+        self._chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0))
+
+    def _chunk(self, tag, data):
+        self.out.write(struct.pack('>I', len(data)) + tag + data)
+        self.out.write(struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff))
+
+    def write(self, rgba):
+        """Append a (rows, width, 4) uint8 band."""
+        rows = np.ascontiguousarray(rgba, dtype=np.uint8).reshape(len(rgba), self.width * 4)
+        above = np.empty_like(rows)
+        above[0] = self._previous
+        above[1:] = rows[:-1]
+        data = np.empty((len(rows), 1 + self.width * 4), dtype=np.uint8)
+        data[:, 0] = PNG_FILTER_UP
+        np.subtract(rows, above, out=data[:, 1:])
+        self._previous = rows[-1].copy()
+        self.rows_written += len(rows)
+
+        self._pending += self._compressor.compress(data.tobytes())
+        if len(self._pending) >= PNG_CHUNK_SIZE:
+            self._chunk(b'IDAT', bytes(self._pending))
+            self._pending = bytearray()
+
+    def close(self):
+        if self.rows_written != self.height:
+            raise ValueError(f"Wrote {self.rows_written} of {self.height} rows")
+        self._pending += self._compressor.flush()
+        self._chunk(b'IDAT', bytes(self._pending))
+        self._pending = bytearray()
+        self._chunk(b'IEND', b'')
@@ -0,0 +1,161 @@
+import numpy as np
+
+
+class RLEMask:
+    """
+    A mask cropped to its non-zero bounding box and run-length encoded in
+    row-major order, COCO style, except that every run carries its value so
+    soft (anti-aliased) edges survive. Memory scales with the number of value
+    changes, i.e. with the mask's perimeter, not with its area or the frame.
+
+    `left`/`upper` place the crop in the image. Area, bbox, threshold, union
+    and intersection work on the runs without expanding the mask.
+    """
+
+    __slots__ = ('left', 'upper', 'width', 'height', 'lengths', 'values')
+
+    def __init__(self, left, upper, width, height, lengths, values):
+        self.left = int(left)
+        self.upper = int(upper)
+        self.width = int(width)
+        self.height = int(height)
+        self.lengths = np.asarray(lengths, dtype=np.uint32)
+        self.values = np.asarray(values, dtype=np.uint8)
+
+    @classmethod
+    def empty(cls):
+        return cls(0, 0, 0, 0, [], [])
+
+    @classmethod
+    def encode(cls, mask, left=0, upper=0):
+        """RLEMask of a 2-D uint8 or bool array whose top-left pixel is at (left, upper)."""
+        mask = np.asarray(mask)
+        if mask.dtype != np.uint8:
+            mask = mask.astype(np.uint8)
+        rows = np.flatnonzero(mask.any(axis=1))
+        if not len(rows):
+            return cls.empty()
+        cols = np.flatnonzero(mask.any(axis=0))
+        crop = mask[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+        flat = crop.ravel()
+        starts = np.concatenate(([0], np.flatnonzero(flat[1:] != flat[:-1]) + 1))
+        lengths = np.diff(np.append(starts, flat.size))
+        return cls(left + cols[0], upper + rows[0], crop.shape[1], crop.shape[0], lengths, flat[starts])
+
+    def decode(self):
+        """The (height, width) uint8 crop."""
+        return np.repeat(self.values, self.lengths).reshape(self.height, self.width)
+
+    @property
+    def bbox(self):
+        """(left, upper, right, lower) in PIL crop convention."""
+        return self.left, self.upper, self.left + self.width, self.upper + self.height
+
+    @property
+    def nbytes(self):
+        return self.lengths.nbytes + self.values.nbytes
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def area(self, threshold=1):
+        """Number of pixels with a value of at least `threshold`."""
+        return int(self.lengths[self.values >= threshold].sum(dtype=np.int64))
+
+    def threshold(self, threshold):
+        """Copy with values below `threshold` cut and the bbox trimmed to what is left."""
+        return _from_segments(*self._segments(threshold))
+
+    def union(self, other):
+        """Pixel-wise maximum of two masks."""
+        return _combine(self, other, np.maximum)
+
+    def intersection(self, other):
+        """Pixel-wise minimum of two masks."""
+        return _combine(self, other, np.minimum)
+
+    def iou(self, other):
+        """Intersection over union of the non-zero areas."""
+        inter = self.intersection(other).area()
+        union = self.area() + other.area() - inter
+        return inter / union if union else 0.0
+
+    def _segments(self, threshold=1):
+        """
+        Runs with a value of at least `threshold`, split at row ends, as
+        (rows, x0, x1, values) arrays in image coordinates, in row-major order.
+        """
+        ends = np.cumsum(self.lengths, dtype=np.int64)
+        starts = ends - self.lengths
+        keep = self.values >= max(1, threshold)
+        starts, ends, values = starts[keep], ends[keep], self.values[keep]
+        if not len(starts):
+            return (np.empty(0, dtype=np.int64),) * 3 + (values,)
+        w = self.width
+        first_row, last_row = starts // w, (ends - 1) // w
+        count = last_row - first_row + 1
+        run = np.repeat(np.arange(len(starts)), count)
+        rows = first_row[run] + np.arange(int(count.sum())) - np.repeat(np.cumsum(count) - count, count)
+        x0 = np.where(rows == first_row[run], starts[run] % w, 0)
+        x1 = np.where(rows == last_row[run], (ends[run] - 1) % w + 1, w)
+        return rows + self.upper, x0 + self.left, x1 + self.left, values[run]
+
+
+def _from_segments(rows, x0, x1, values):
+    """RLEMask from non-overlapping, non-zero row segments in row-major order."""
+    if not len(rows):
+        return RLEMask.empty()
+    left, upper = int(x0.min()), int(rows[0])
+    width, height = int(x1.max()) - left, int(rows[-1]) + 1 - upper
+    starts = (rows - upper) * width + (x0 - left)
+    ends = starts + (x1 - x0)
+
+    # Alternating gap / segment runs, then drop empty ones and merge equal neighbours
+    n = len(starts)
+    lengths = np.empty(2 * n + 1, dtype=np.int64)
+    lengths[0:-1:2] = starts - np.concatenate(([0], ends[:-1]))
+    lengths[1::2] = ends - starts
+    lengths[-1] = width * height - ends[-1]
+    merged = np.zeros(2 * n + 1, dtype=np.uint8)
+    merged[1::2] = values
+    keep = lengths > 0
+    lengths, merged = lengths[keep], merged[keep]
+    groups = np.flatnonzero(np.concatenate(([True], merged[1:] != merged[:-1])))
+    return RLEMask(left, upper, width, height, np.add.reduceat(lengths, groups), merged[groups])
+
+
+def _combine(a, b, op):
+    """Apply a pixel-wise `op` to two masks, on the boundaries of their runs only."""
+    segments = [a._segments(), b._segments()]
+    if not any(len(rows) for rows, _, _, _ in segments):
+        return RLEMask.empty()
+    rows = np.concatenate([s[0] for s in segments])
+    x0 = np.concatenate([s[1] for s in segments])
+    x1 = np.concatenate([s[2] for s in segments])
+    # Flat positions in a frame covering both masks
+    left, upper = int(x0.min()), int(rows.min())
+    width = int(x1.max()) - left
+    keys = []
+    for seg_rows, seg_x0, seg_x1, values in segments:
+        start = (seg_rows - upper) * width + (seg_x0 - left)
+        keys.append((start, start + (seg_x1 - seg_x0), values))
+
+    # Both masks are constant between consecutive boundaries
+    bounds = np.unique(np.concatenate([k for start, end, _ in keys for k in (start, end)]))
+    starts, ends = bounds[:-1], bounds[1:]
+    sampled = []
+    for start, end, values in keys:
+        if not len(start):
+            sampled.append(np.zeros(len(starts), dtype=np.uint8))
+            continue
+        i = np.searchsorted(start, starts, side='right') - 1
+        j = np.maximum(i, 0)
+        sampled.append(np.where((i >= 0) & (starts < end[j]), values[j], 0).astype(np.uint8))
+    out = op(sampled[0], sampled[1])
+
+    keep = out > 0
+    starts, ends, out = starts[keep], ends[keep], out[keep]
+    # Every non-zero piece lies inside one row segment of either mask
+    seg_rows = starts // width
+    seg_x0 = starts % width
+    return _from_segments(seg_rows + upper, seg_x0 + left, seg_x0 + (ends - starts) + left, out)
@@ -0,0 +1,279 @@
+import cProfile
+import functools
+import math
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, math.inf)
+
+METRIC_PREFIX = 'seg_'
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+
+def _labels(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class MetricsRegistry:
+    """
+    In-process counters and latency histograms, rendered in the Prometheus
+    text format. Timing spans go into one histogram labelled by stage; the
+    spans of the current thread can also be collected with `trace()`.
+    """
+
+    def __init__(self):
+        self._counters = {}
+        self._histograms = {}
+        self._help = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def describe(self, name, help_text):
+        self._help[name] = help_text
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def counter_value(self, name, **labels):
+        with self._lock:
+            return self._counters.get((name, _labels(labels)), 0)
+
+    def histogram_count(self, name, **labels):
+        with self._lock:
+            histogram = self._histograms.get((name, _labels(labels)))
+            return histogram.count if histogram is not None else 0
+
+    def record_span(self, stage, seconds, error=False):
+        self.observe('stage_duration_seconds', seconds, stage=stage)
+        if error:
+            self.inc('stage_errors_total', stage=stage)
+        spans = getattr(self._local, 'spans', None)
+        if spans is not None:
+            spans.append({'stage': stage, 'seconds': seconds, 'error': error})
+
+    @contextmanager
+    def span(self, stage):
+        """Time the enclosed block as `stage`."""
+        start = time.perf_counter()
+        error = False
+        try:
+            yield
+        except BaseException:
+            error = True
+            raise
+        finally:
+            self.record_span(stage, time.perf_counter() - start, error)
+
+    def timed(self, stage):
+        """Decorator form of span()."""
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.span(stage):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def timed_iter(self, stage, chunks, bytes_metric=None, **labels):
+        """
+        Yield from `chunks`, recording as `stage` only the time spent producing
+        them (not the time the consumer takes, e.g. a slow client). With
+        `bytes_metric`, the chunk sizes are added to that counter (with `labels`).
+        """
+        elapsed = 0.0
+        total = 0
+        error = False
+        iterator = iter(chunks)
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    chunk = next(iterator)
+                except StopIteration:
+                    elapsed += time.perf_counter() - start
+                    break
+                elapsed += time.perf_counter() - start
+                total += len(chunk)
+                yield chunk
+        except Exception:
+            error = True
+            raise
+        finally:
+            self.record_span(stage, elapsed, error)
+            if bytes_metric is not None:
+                self.inc(bytes_metric, total, **labels)
+
+    def begin_trace(self):
+        """Start collecting the spans this thread records; returns the (live) list."""
+        spans = self._local.spans = []
+        return spans
+
+    def end_trace(self):
+        spans = getattr(self._local, 'spans', None)
+        self._local.spans = None
+        return spans or []
+
+    @contextmanager
+    def trace(self):
+        """Collect the spans recorded by this thread inside the block (a list of dicts)."""
+        previous = getattr(self._local, 'spans', None)
+        spans = self._local.spans = []
+        try:
+            yield spans
+        finally:
+            self._local.spans = previous
+
+    def render(self, gauges=None):
+        """
+        Prometheus text exposition of every metric, plus `gauges`:
+        {name: value} or {name: [(labels dict, value), ...]}.
+        """
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(
+                (key, (list(h.counts), h.count, h.sum, h.buckets)) for key, h in self._histograms.items()
+            )
+        lines = []
+        seen = set()
+
+        def header(name, kind):
+            if name in seen:
+                return
+            seen.add(name)
+            if name in self._help:
+                lines.append(f"# HELP {METRIC_PREFIX}{name} {self._help[name]}")
+            lines.append(f"# TYPE {METRIC_PREFIX}{name} {kind}")
+
+        for (name, labels), value in counters:
+            header(name, 'counter')
+            lines.append(f"{METRIC_PREFIX}{name}{_format_labels(labels)} {_format_value(value)}")
+
+        for (name, labels), (counts, count, total, buckets) in histograms:
+            header(name, 'histogram')
+            cumulative = 0
+            for bound, n in zip(buckets, counts):
+                cumulative += n
+                le = (('le', _format_value(bound)),)
+                lines.append(f"{METRIC_PREFIX}{name}_bucket{_format_labels(labels, le)} {cumulative}")
+            lines.append(f"{METRIC_PREFIX}{name}_sum{_format_labels(labels)} {_format_value(total)}")
+            lines.append(f"{METRIC_PREFIX}{name}_count{_format_labels(labels)} {count}")
+
+        for name, value in sorted((gauges or {}).items()):
+            header(name, 'gauge')
+            samples = value if isinstance(value, list) else [({}, value)]
+            for labels, sample in samples:
+                lines.append(f"{METRIC_PREFIX}{name}{_format_labels(_labels(labels))} {_format_value(sample)}")
+
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+
+_metrics = MetricsRegistry()
+_metrics.describe('stage_duration_seconds', 'Time spent per pipeline stage.')
+_metrics.describe('stage_errors_total', 'Pipeline stages that raised.')
+_metrics.describe('request_duration_seconds', 'HTTP request latency by endpoint.')
+_metrics.describe('request_bytes_total', 'Request body bytes received.')
+_metrics.describe('response_bytes_total', 'Response body bytes sent.')
+_metrics.describe('objects_extracted_total', 'Objects produced by extraction.')
+_metrics.describe('objects_materialized_total', 'Lazily extracted objects composited and encoded on first use.')
+_metrics.describe('backend_responses_total', 'Inference API responses by HTTP status.')
+_metrics.describe('inference_coalesced_total', 'Segmentation calls answered by an identical call already in flight.')
+
+
+def get_metrics():
+    """The process-wide metrics registry."""
+    return _metrics
+
+
+def span(stage):
+    return _metrics.span(stage)
+
+
+def timed(stage):
+    return _metrics.timed(stage)
+
+
+class RequestProfiler:
+    """
+    Profiles each request with cProfile and keeps the profile (a .prof file in
+    `directory`, readable with pstats or snakeviz) only when the request took
+    at least `threshold` seconds. Profiling slows every request down, so this
+    is meant to be switched on while investigating.
+    """
+
+    def __init__(self, threshold, directory):
+        self.threshold = threshold
+        self.directory = directory
+        self.saved = 0
+
+    def start(self):
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is already active in this thread
+            return None
+        return profile
+
+    def stop(self, profile, seconds, name):
+        """Stop `profile`; returns the path of the dump, or None if it was fast enough."""
+        if profile is None:
+            return None
+        profile.disable()
+        if seconds < self.threshold:
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        safe_name = ''.join(c if c.isalnum() or c in '-_' else '_' for c in name)
+        path = os.path.join(self.directory, f"{time.strftime('%Y%m%d-%H%M%S')}_{safe_name}_{int(seconds * 1000)}ms_{uuid.uuid4().hex[:8]}.prof")
+        profile.dump_stats(path)
+        self.saved += 1
+        return path
@@ -0,0 +1,497 @@
+import io
+import json
+import struct
+import threading
+import uuid
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+# Same cut-off the full-mask /refine path has always used: L values above it erase
+ERASE_THRESHOLD = 10
+
+
+def clip_rect(rect, size):
+    """Clip an (x, y, w, h) rect to an image of `size`; returns (x0, y0, x1, y1) or None."""
+    x, y, w, h = (int(v) for v in rect)
+    width, height = size
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + w, width), min(y + h, height)
+    if x0 >= x1 or y0 >= y1:
+        return None
+    return x0, y0, x1, y1
+
+
+def rasterize_strokes(strokes, size):
+    """
+    Rasterize erase strokes into a boolean mask over their bounding box.
+
+    `strokes` is [{'points': [[x, y], ...], 'size': brush_diameter}], drawn
+    like the editor canvas (round caps and joins): a pixel is erased when its
+    centre lies within size/2 of any segment. Returns ((x0, y0, x1, y1), mask)
+    clipped to the image, or None if nothing is covered.
+    """
+    segments = []
+    for stroke in strokes:
+        points = np.asarray(stroke.get('points') or [], dtype=np.float64).reshape(-1, 2)
+        radius = float(stroke.get('size', 20)) / 2
+        if len(points) == 0 or radius <= 0:
+            continue
+        if len(points) == 1:
+            points = np.vstack([points, points])
+        for a, b in zip(points[:-1], points[1:]):
+            segments.append((a, b, radius))
+    if not segments:
+        return None
+
+    lo = np.min([np.minimum(a, b) - r for a, b, r in segments], axis=0)
+    hi = np.max([np.maximum(a, b) + r for a, b, r in segments], axis=0)
+    box = clip_rect((np.floor(lo[0]), np.floor(lo[1]),
+                     np.ceil(hi[0]) - np.floor(lo[0]) + 1, np.ceil(hi[1]) - np.floor(lo[1]) + 1), size)
+    if box is None:
+        return None
+    x0, y0, x1, y1 = box
+
+    # Each segment is only evaluated over its own (clipped) bounding box, so
+    # the cost follows the stroked area rather than segments x union box
+    mask = np.zeros((y1 - y0, x1 - x0), dtype=bool)
+    for a, b, radius in segments:
+        seg_lo = np.minimum(a, b) - radius
+        seg_hi = np.maximum(a, b) + radius
+        sx0, sy0 = max(int(np.floor(seg_lo[0])), x0), max(int(np.floor(seg_lo[1])), y0)
+        sx1, sy1 = min(int(np.ceil(seg_hi[0])) + 1, x1), min(int(np.ceil(seg_hi[1])) + 1, y1)
+        if sx0 >= sx1 or sy0 >= sy1:
+            continue
+        # Pixel centres of the segment's box
+        px = np.arange(sx0, sx1, dtype=np.float64)[None, :] + 0.5
+        py = np.arange(sy0, sy1, dtype=np.float64)[:, None] + 0.5
+        d = b - a
+        length2 = float(d @ d)
+        if length2 == 0:
+            t = 0.0
+        else:
+            t = np.clip(((px - a[0]) * d[0] + (py - a[1]) * d[1]) / length2, 0, 1)
+        dx = px - (a[0] + t * d[0])
+        dy = py - (a[1] + t * d[1])
+        mask[sy0 - y0:sy1 - y0, sx0 - x0:sx1 - x0] |= dx * dx + dy * dy <= radius * radius
+    if not mask.any():
+        return None
+    return box, mask
+
+
+# Binary mask body of /refine: magic, encoding, then x, y, w, h of the
+# region as little-endian uint32, followed by the encoded bits
+MASK_HEADER = struct.Struct('<2sBIIII')
+MASK_MAGIC = b'RM'
+# Row-major bits of the region, most significant bit first (np.packbits order)
+ENCODING_BITS = 0
+# Alternating run lengths over the same bits as LEB128 varints, starting with
+# a (possibly empty) run of unset pixels
+ENCODING_RLE = 1
+
+
+def luminance(rgb):
+    """PIL's RGB -> L conversion, on the last axis of an integer array."""
+    rgb = rgb.astype(np.uint32)
+    return (rgb[..., 0] * 19595 + rgb[..., 1] * 38470 + rgb[..., 2] * 7471 + 0x8000) >> 16
+
+
+def _encode_varints(values):
+    out = bytearray()
+    for value in values:
+        value = int(value)
+        while value >= 0x80:
+            out.append((value & 0x7f) | 0x80)
+            value >>= 7
+        out.append(value)
+    return bytes(out)
+
+
+def _decode_varints(payload):
+    data = np.frombuffer(payload, dtype=np.uint8)
+    if len(data) == 0:
+        return np.zeros(0, dtype=np.int64)
+    ends = np.flatnonzero(data < 0x80)
+    if len(ends) == 0 or ends[-1] != len(data) - 1:
+        raise ValueError("Truncated run length")
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    # Position of each byte inside its varint
+    shift = np.arange(len(data)) - np.repeat(starts, ends - starts + 1)
+    if shift.max() > 4:
+        raise ValueError("Run length too large")
+    values = (data & 0x7f).astype(np.int64) << (7 * shift)
+    return np.add.reduceat(values, starts)
+
+
+def encode_binary_mask(erase, x, y, encoding=ENCODING_RLE):
+    """
+    Reference encoder for the binary /refine body (the editor implements the
+    same in JavaScript). `erase` is a boolean array covering the region at x, y.
+    """
+    h, w = erase.shape
+    flat = erase.ravel()
+    if encoding == ENCODING_BITS:
+        payload = np.packbits(flat).tobytes()
+    else:
+        # Indices where the value changes, with the start and end as boundaries
+        changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+        bounds = np.concatenate([[0], changes, [len(flat)]])
+        runs = np.diff(bounds)
+        if len(flat) and flat[0]:
+            runs = np.concatenate([[0], runs])
+        payload = _encode_varints(runs)
+    return MASK_HEADER.pack(MASK_MAGIC, encoding, x, y, w, h) + payload
+
+
+def parse_binary_mask(body):
+    """Split a binary mask body into (encoding, (x, y, w, h), payload)."""
+    if len(body) < MASK_HEADER.size:
+        raise ValueError("Mask body too short")
+    magic, encoding, x, y, w, h = MASK_HEADER.unpack_from(body)
+    if magic != MASK_MAGIC or encoding not in (ENCODING_BITS, ENCODING_RLE):
+        raise ValueError("Unknown mask format")
+    return encoding, (x, y, w, h), body[MASK_HEADER.size:]
+
+
+def decode_binary_mask(encoding, w, h, payload):
+    """Boolean (h, w) erase mask from a binary mask payload."""
+    count = w * h
+    if encoding == ENCODING_BITS:
+        if len(payload) != (count + 7) // 8:
+            raise ValueError("Bit mask size does not match its region")
+        bits = np.unpackbits(np.frombuffer(payload, dtype=np.uint8), count=count)
+        return bits.reshape(h, w).astype(bool)
+    runs = _decode_varints(payload)
+    if runs.sum() != count:
+        raise ValueError("Run lengths do not match the region")
+    values = (np.arange(len(runs)) % 2).astype(bool)
+    return np.repeat(values, runs).reshape(h, w)
+
+
+def erase_region(rgba, box, erase):
+    """Zero the alpha of `rgba` where the boolean `erase` mask (covering `box`) is set."""
+    x0, y0, x1, y1 = box
+    rgba[y0:y1, x0:x1, 3][erase] = 0
+
+
+# Delta record: the edited box (x0, y0, x1, y1) and the CRC32 of its alpha
+# before and after the edit, then the zlib-compressed XOR of the two
+DELTA_HEADER = struct.Struct('<IIIIII')
+
+
+class HistoryConflict(Exception):
+    """Raised when an object's pixels are not the ones its next undo/redo step was recorded on."""
+
+
+class EditHistory:
+    """
+    Undo/redo stack of one object's alpha channel, kept in the session store
+    next to it: a small index (`<file>.history`) plus one delta per edit
+    (`<file>.delta<n>`). A delta only covers the edited box, and since it is
+    an XOR the same record serves both undo and redo. Undo and redo therefore
+    read and apply a single delta. At most `limit` edits are kept; delta
+    files are reused as a ring. Each delta carries checksums of the box
+    before and after the edit, and is only applied to pixels that match
+    them, so a delta that outlived its edit can never erase anything.
+
+    The index also records the position the object's stored PNG was saved
+    at, so the current pixels can be rebuilt from the PNG and the deltas
+    since (`replay`), and a version that changes with every step, so a
+    process holding the pixels in memory can tell they are out of date.
+
+    Use it while holding the object's working-set lock (inside
+    RefineWorkingSet.edit) so the index and the pixels change together.
+    """
+
+    def __init__(self, store, session_id, filename, limit=50):
+        self.store = store
+        self.session_id = session_id
+        self.filename = filename
+        self.limit = limit
+
+    def _load_index(self):
+        data = self.store.get(self.session_id, f"{self.filename}.history")
+        if data is None:
+            return {'base': 0, 'position': 0, 'top': 0, 'saved': 0, 'version': None}
+        return json.loads(data)
+
+    def _save_index(self, index, changed=True):
+        if changed:
+            index['version'] = uuid.uuid4().hex
+        self.store.put(self.session_id, f"{self.filename}.history", json.dumps(index).encode('utf-8'))
+
+    def _delta_name(self, n):
+        return f"{self.filename}.delta{n % self.limit}"
+
+    def state(self):
+        index = self._load_index()
+        return {'can_undo': index['position'] > index['base'], 'can_redo': index['position'] < index['top']}
+
+    def version(self):
+        """Token of the object's current state; None until it is first edited."""
+        return self._load_index()['version']
+
+    def clear(self):
+        """Forget all edits, e.g. when the object is regenerated."""
+        self._save_index({'base': 0, 'position': 0, 'top': 0, 'saved': 0})
+
+    def record(self, box, before, after):
+        """Push the edit of `box` (alpha `before` -> `after`), dropping any redo entries."""
+        x0, y0, x1, y1 = box
+        diff = np.bitwise_xor(before, after)
+        index = self._load_index()
+        position = index['position'] + 1
+        checksums = zlib.crc32(np.ascontiguousarray(before)), zlib.crc32(np.ascontiguousarray(after))
+        self.store.put(self.session_id, self._delta_name(position),
+                       DELTA_HEADER.pack(x0, y0, x1, y1, *checksums) + zlib.compress(diff.tobytes(), 1))
+        if position <= index['saved']:
+            # The deltas leading back from the stored PNG are being replaced
+            index['saved'] = -1
+        index['position'] = index['top'] = position
+        index['base'] = max(index['base'], position - self.limit)
+        self._save_index(index)
+
+    def needs_save(self):
+        """True when the stored PNG can no longer be brought to the current position."""
+        index = self._load_index()
+        return not index['base'] <= index['saved'] <= index['top']
+
+    def mark_saved(self, version):
+        """Note that the stored PNG now holds state `version` (unless the history has moved on)."""
+        index = self._load_index()
+        if index['version'] == version and index['saved'] != index['position']:
+            index['saved'] = index['position']
+            self._save_index(index, changed=False)
+
+    def is_saved(self):
+        """True when the stored PNG holds the current position."""
+        index = self._load_index()
+        return index['saved'] == index['position']
+
+    def replay(self, rgba):
+        """
+        Bring `rgba`, the object as stored, to the current position by
+        applying the deltas recorded since its PNG was saved. Returns
+        (version, changed); raises HistoryConflict if the stored PNG cannot
+        be brought there.
+        """
+        index = self._load_index()
+        saved, position = index['saved'], index['position']
+        if not index['base'] <= saved <= index['top']:
+            self.clear()
+            raise HistoryConflict("Edit history does not reach the stored object and was cleared")
+        for n in range(saved + 1, position + 1):
+            self._apply(rgba, n, undo=False)
+        for n in range(saved, position, -1):
+            self._apply(rgba, n, undo=True)
+        return index['version'], saved != position
+
+    def _apply(self, rgba, n, undo):
+        record = self.store.get(self.session_id, self._delta_name(n))
+        x0, y0, x1, y1, before, after = DELTA_HEADER.unpack_from(record)
+        region = rgba[y0:y1, x0:x1, 3]
+        if region.shape != (y1 - y0, x1 - x0) or zlib.crc32(np.ascontiguousarray(region)) != (after if undo else before):
+            # The object is not in the state this step was recorded on
+            # (e.g. the edit itself was never stored): the stack is useless
+            self.clear()
+            raise HistoryConflict("Edit history does not match the object and was cleared")
+        diff = np.frombuffer(zlib.decompress(record[DELTA_HEADER.size:]), dtype=np.uint8)
+        region ^= diff.reshape(y1 - y0, x1 - x0)
+        return x0, y0, x1, y1
+
+    def undo(self, rgba):
+        """Revert the latest edit in `rgba`; returns its box, or None if there is nothing to undo."""
+        index = self._load_index()
+        if index['position'] <= index['base']:
+            return None
+        box = self._apply(rgba, index['position'], undo=True)
+        index['position'] -= 1
+        self._save_index(index)
+        return box
+
+    def redo(self, rgba):
+        """Re-apply the latest undone edit; returns its box, or None if there is nothing to redo."""
+        index = self._load_index()
+        if index['position'] >= index['top']:
+            return None
+        index['position'] += 1
+        box = self._apply(rgba, index['position'], undo=False)
+        self._save_index(index)
+        return box
+
+
+class _WorkingImage:
+    def __init__(self, store):
+        self.store = store
+        # Decoded on first use, under `lock`
+        self.rgba = None
+        self.nbytes = 0
+        # History version the pixels are at
+        self.version = None
+        self.dirty = False
+        self.lock = threading.Lock()
+
+
+class RefineWorkingSet:
+    """
+    Decoded RGBA arrays of the objects being edited, so successive /refine
+    calls only touch the pixels they change. Edits are kept in memory and the
+    PNG is re-encoded once, when the object is downloaded (`flush`) or
+    evicted. Entries are evicted least recently used first under `max_bytes`.
+    `loader(store, session_id, filename)` returns an object's RGBA array (or
+    None) for objects that have no PNG in the store yet.
+
+    With `history(store, session_id, filename)` returning the object's
+    EditHistory, the store alone describes every object: its PNG plus the
+    deltas recorded since it was saved. A working copy is rebuilt from them
+    when the history has moved on since it was loaded (e.g. in another worker
+    process), and `flush` writes pending edits whichever process made them.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024, loader=None, history=None):
+        self.max_bytes = max_bytes
+        self.loader = loader
+        self.history = history
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def _history(self, store, session_id, filename):
+        return self.history(store, session_id, filename) if self.history is not None else None
+
+    def edit(self, store, session_id, filename, fn):
+        """
+        Run fn(rgba) on the working copy of an object; fn returns None if it
+        changed nothing. Returns fn's result, or raises KeyError if the object
+        does not exist.
+        """
+        entry = self._entry(store, session_id, filename)
+        history = self._history(store, session_id, filename)
+        with entry.lock:
+            self._sync(entry, history, session_id, filename)
+            result = fn(entry.rgba)
+            if result is not None:
+                entry.dirty = True
+                if history is not None:
+                    entry.version = history.version()
+                    if history.needs_save():
+                        # The edit replaced deltas the stored PNG depends on
+                        self._write_locked(entry, history, session_id, filename)
+        self._evict()
+        return result
+
+    def _entry(self, store, session_id, filename):
+        key = (session_id, filename)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.store is not store:
+                if entry is not None:
+                    self._bytes -= entry.nbytes
+                entry = self._entries[key] = _WorkingImage(store)
+            self._entries.move_to_end(key)
+            return entry
+
+    def _sync(self, entry, history, session_id, filename):
+        """Decode the entry, or rebuild it if its history moved on; call with entry.lock held."""
+        if entry.rgba is not None and (history is None or history.version() == entry.version):
+            return
+        try:
+            rgba = self._decode(entry.store, session_id, filename)
+        except KeyError:
+            with self._lock:
+                if self._entries.get((session_id, filename)) is entry and entry.rgba is None:
+                    del self._entries[(session_id, filename)]
+            raise
+        version, dirty = None, False
+        if history is not None:
+            try:
+                version, dirty = history.replay(rgba)
+            except HistoryConflict:
+                # The history was cleared: the object is what is stored
+                rgba = self._decode(entry.store, session_id, filename)
+                version = history.version()
+        with self._lock:
+            self._bytes += rgba.nbytes - entry.nbytes
+        entry.rgba, entry.nbytes, entry.version, entry.dirty = rgba, rgba.nbytes, version, dirty
+
+    def _decode(self, store, session_id, filename):
+        try:
+            data = store.get(session_id, filename)
+            if data is not None:
+                rgba = np.array(Image.open(io.BytesIO(data)).convert("RGBA"))
+            elif self.loader is not None:
+                rgba = self.loader(store, session_id, filename)
+            else:
+                rgba = None
+        except ValueError:
+            # Invalid session or file name
+            rgba = None
+        if rgba is None:
+            raise KeyError(filename)
+        return rgba
+
+    def _evict(self):
+        evicted = []
+        with self._lock:
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                key, entry = self._entries.popitem(last=False)
+                self._bytes -= entry.nbytes
+                evicted.append((key, entry))
+        for (session_id, filename), entry in evicted:
+            with entry.lock:
+                self._write_locked(entry, self._history(entry.store, session_id, filename), session_id, filename)
+
+    def _write_locked(self, entry, history, session_id, filename):
+        if not entry.dirty or not entry.store.exists(session_id):
+            return
+        if history is not None and history.version() != entry.version:
+            # Edited elsewhere since: the pixels are rebuilt on next use
+            return
+        buf = io.BytesIO()
+        Image.fromarray(entry.rgba, "RGBA").save(buf, format="PNG")
+        entry.store.put(session_id, filename, buf.getvalue())
+        entry.dirty = False
+        if history is not None:
+            history.mark_saved(entry.version)
+
+    def flush(self, store, session_id, filename=None):
+        """Encode and store pending edits of a session (or just one of its files)."""
+        with self._lock:
+            names = {key[1] for key, entry in self._entries.items()
+                     if key[0] == session_id and entry.store is store and entry.dirty}
+        if self.history is not None:
+            try:
+                names.update(name[:-len('.history')] for name in store.names(session_id)
+                             if name.endswith('.history'))
+            except ValueError:
+                return
+        if filename is not None:
+            names &= {filename}
+        for name in sorted(names):
+            history = self._history(store, session_id, name)
+            if history is not None and history.is_saved():
+                continue
+            entry = self._entry(store, session_id, name)
+            with entry.lock:
+                try:
+                    self._sync(entry, history, session_id, name)
+                except KeyError:
+                    continue
+                self._write_locked(entry, history, session_id, name)
+        self._evict()
+
+    def discard(self, session_id):
+        """Drop a session's working copies, including unsaved edits (its files are being replaced)."""
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == session_id]:
+                self._bytes -= self._entries.pop(key).nbytes
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'dirty': sum(1 for entry in self._entries.values() if entry.dirty),
+            }
@@ -1,10 +1,23 @@
 import requests
+from requests.adapters import HTTPAdapter
 import io
-from PIL import Image, ImageOps
+from PIL import Image, ImageFilter, ImageOps
 import numpy as np
 import base64
+import json
 import os
+import random
+import struct
+import threading
+import time
 import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from utils.backends import RemoteBackend, ClassicalBackend, LocalModelBackend, FakeBackend
+from utils.cache import SingleFlight, cache_key, get_cache
+from utils.large_image import PNGStreamWriter, band_rows, decode_to_memmap, thumbnail_from_memmap
+from utils.masks import RLEMask
+from utils.metrics import get_metrics, span, timed
 
 # Use a default model that supports instance segmentation
 # Using the new router URL to avoid 410 errors
@@ -13,141 +26,1003 @@ API_URL = f"https://router.huggingface.co/hf-inference/models/{MODEL_ID}"
 
 import mimetypes
 
-def segment_image(image_path, api_token=None):
+# Status codes worth retrying: model still loading / overloaded, rate limited
+RETRY_STATUS_CODES = (429, 503)
+
+
+class CircuitOpenError(Exception):
+    """Raised without touching the network while the backend is considered down."""
+
+
+class InferenceClient:
     """
-    Sends image to Hugging Face API for instance segmentation.
-    Returns a list of masks/labels.
+    Shared HTTP client for the inference backend.
+
+    Keeps a pooled requests.Session so uploads reuse TLS connections, applies
+    separate connect/read timeouts, retries 429/503 and connection failures
+    (not read timeouts) with jittered exponential backoff, and trips a circuit breaker after `failure_threshold` consecutive
+    failures so callers fail fast until `reset_timeout` seconds have passed.
+    """
+
+    def __init__(self, url=API_URL, connect_timeout=5.0, read_timeout=120.0,
+                 max_retries=3, backoff_base=0.5, backoff_max=10.0,
+                 failure_threshold=5, reset_timeout=30.0, pool_size=10,
+                 sleep=time.sleep):
+        self.url = url
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._sleep = sleep
+
+        self.session = requests.Session()
+        # Retries are handled here (status-aware, with jitter), not by urllib3
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._half_open_trial = False
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at >= self.reset_timeout:
+                return "half-open"
+            return "open"
+
+    def _before_call(self):
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if time.monotonic() - self._opened_at < self.reset_timeout or self._half_open_trial:
+                raise CircuitOpenError(
+                    "Inference backend is unavailable (circuit open). Please try again shortly."
+                )
+            # Let exactly one trial request through
+            self._half_open_trial = True
+
+    def _record(self, ok):
+        with self._lock:
+            self._half_open_trial = False
+            if ok:
+                self._failures = 0
+                self._opened_at = None
+                return
+            self._failures += 1
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+
+    def _backoff(self, attempt, response=None):
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+        if response is not None:
+            retry_after = response.headers.get("Retry-After")
+            if retry_after:
+                try:
+                    delay = max(delay, min(float(retry_after), self.backoff_max))
+                except ValueError:
+                    pass
+        return delay
+
+    def post(self, data, headers=None):
+        """POST `data` to the backend and return the final requests.Response."""
+        self._before_call()
+        try:
+            response = self._post_with_retries(data, headers)
+        except BaseException:
+            # Whatever went wrong, a half-open trial must not stay pending
+            self._record(False)
+            raise
+        # Client errors (bad token, bad image) say nothing about backend health
+        self._record(response.status_code < 500 and response.status_code != 429)
+        return response
+
+    def _post_with_retries(self, data, headers):
+        attempt = 0
+        while True:
+            try:
+                response = self.session.post(
+                    self.url, headers=headers, data=data,
+                    timeout=(self.connect_timeout, self.read_timeout),
+                )
+            except requests.ConnectionError:
+                # Includes ConnectTimeout. A ReadTimeout is not retried: the
+                # backend got the request and is slow (e.g. a cold start), and
+                # retrying would hold the worker for several read timeouts
+                get_metrics().inc('backend_responses_total', status='error')
+                if attempt >= self.max_retries:
+                    raise
+                self._sleep(self._backoff(attempt))
+                attempt += 1
+                continue
+
+            get_metrics().inc('backend_responses_total', status=response.status_code)
+            if response.status_code in RETRY_STATUS_CODES and attempt < self.max_retries:
+                self._sleep(self._backoff(attempt, response))
+                attempt += 1
+                continue
+            return response
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_inference_client():
     """
-    headers = {
-        "x-wait-for-model": "true"
-    }
-    if api_token:
-        headers["Authorization"] = f"Bearer {api_token}"
-    
-    # Determine content type
-    mime_type, _ = mimetypes.guess_type(image_path)
-    if not mime_type:
-        mime_type = "application/octet-stream"
-    
-    headers["Content-Type"] = mime_type
-    
-    with open(image_path, "rb") as f:
-        data = f.read()
-    
-    response = requests.post(API_URL, headers=headers, data=data)
-    
-    if response.status_code != 200:
-        error_msg = f"API Error: {response.status_code} - {response.text}"
-        if response.status_code == 401:
-             raise Exception("Authentication failed. Please check your HF_API_TOKEN in .env.")
-        raise Exception(error_msg)
-        
-    results = response.json()
-    
-    # Standardize output for our processing function
-    # API request using requests returns list of dicts: [{'score': float, 'label': str, 'mask': 'base64string'}]
-    # NOTE: mask2former usually returns mask as base64 string when using raw API
-    
-    standardized_results = []
-    if isinstance(results, list):
-        for item in results:
-            standardized_results.append({
-                'score': item.get('score', 0),
-                'label': item.get('label', 'object'),
-                'mask': item.get('mask') # Pass raw base64 to next step
-            })
+    Process-wide InferenceClient configured from the environment:
+    SEG_API_URL (e.g. a local stub for benchmarks), SEG_CONNECT_TIMEOUT, SEG_READ_TIMEOUT, SEG_MAX_RETRIES,
+    SEG_BREAKER_THRESHOLD, SEG_BREAKER_RESET (seconds).
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = InferenceClient(
+                url=os.getenv("SEG_API_URL", API_URL),
+                connect_timeout=float(os.getenv("SEG_CONNECT_TIMEOUT", 5)),
+                read_timeout=float(os.getenv("SEG_READ_TIMEOUT", 120)),
+                max_retries=int(os.getenv("SEG_MAX_RETRIES", 3)),
+                failure_threshold=int(os.getenv("SEG_BREAKER_THRESHOLD", 5)),
+                reset_timeout=float(os.getenv("SEG_BREAKER_RESET", 30)),
+            )
+        return _client
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    """
+    Process-wide segmentation engine, chosen by SEG_BACKEND:
+    'remote' (default, Hugging Face API), 'local' (a transformers model from
+    SEG_LOCAL_MODEL if set, otherwise the classical CPU engine) or 'fake'
+    (deterministic offline engine, SEG_FAKE_OBJECTS / SEG_FAKE_LATENCY).
+    """
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            kind = os.getenv("SEG_BACKEND", "remote").lower()
+            if kind == "remote":
+                _backend = RemoteBackend(get_inference_client(), MODEL_ID)
+            elif kind == "local":
+                model_path = os.getenv("SEG_LOCAL_MODEL")
+                if model_path and os.path.isdir(model_path):
+                    _backend = LocalModelBackend(model_path)
+                else:
+                    _backend = ClassicalBackend()
+            elif kind == "fake":
+                _backend = FakeBackend(
+                    num_objects=int(os.getenv("SEG_FAKE_OBJECTS", 5)),
+                    latency=float(os.getenv("SEG_FAKE_LATENCY", 0)),
+                )
+            else:
+                raise ValueError(f"Unknown SEG_BACKEND: {kind}")
+        return _backend
+
+
+def set_backend(backend):
+    """Replace the process-wide backend (None resets it to the env default)."""
+    global _backend
+    with _backend_lock:
+        _backend = backend
+
+
+# Inference resolution: when > 0, images whose longer side exceeds this are
+# downscaled and re-encoded before being sent to the backend. The original is
+# kept for compositing; extract_objects upsamples the smaller masks per object.
+INFERENCE_MAX_SIDE = int(os.getenv("SEG_INFERENCE_MAX_SIDE", 0))
+INFERENCE_JPEG_QUALITY = int(os.getenv("SEG_INFERENCE_JPEG_QUALITY", 90))
+
+# Large-image mode: images above this many pixels are always segmented from
+# a downscaled copy (at most LARGE_IMAGE_INFERENCE_SIDE) and extract_objects
+# builds their objects in row bands from a memory-mapped copy, keeping its
+# working memory within LARGE_IMAGE_MEMORY_BUDGET.
+LARGE_IMAGE_PIXELS = int(os.getenv("SEG_LARGE_IMAGE_PIXELS", 40_000_000))
+LARGE_IMAGE_INFERENCE_SIDE = int(os.getenv("SEG_LARGE_IMAGE_INFERENCE_SIDE", 2048))
+LARGE_IMAGE_MEMORY_BUDGET = int(os.getenv("SEG_LARGE_IMAGE_MEMORY_BUDGET", 64 * 1024 * 1024))
+
+
+def image_size(image):
+    """(width, height) of an image path or bytes, read from the header only."""
+    if isinstance(image, (bytes, bytearray)):
+        image = io.BytesIO(image)
+    with Image.open(image) as im:
+        return im.size
+
+
+def is_large_image(size):
+    return size[0] * size[1] > LARGE_IMAGE_PIXELS
+
+
+def downscale_for_inference(data, mime_type, max_side, quality=INFERENCE_JPEG_QUALITY):
+    """
+    Return (bytes, mime_type) of a copy of the image whose longer side is at
+    most `max_side`, re-encoded as JPEG. Images that are already small enough
+    are returned untouched. Large images other than JPEG are reduced in row
+    bands from a memory-mapped copy, within LARGE_IMAGE_MEMORY_BUDGET.
+    """
+    image = Image.open(io.BytesIO(data))
+    if max(image.size) <= max_side:
+        return data, mime_type
+    if image.format != "JPEG" and is_large_image(image.size):
+        # draft() only helps JPEG: a full-size RGB conversion would add
+        # another copy of the image on top of the decoder's
+        mapped = decode_to_memmap(data, LARGE_IMAGE_MEMORY_BUDGET)
+        try:
+            image = thumbnail_from_memmap(mapped, max_side, LARGE_IMAGE_MEMORY_BUDGET)
+        finally:
+            mapped.close()
+    else:
+        # JPEG sources can be decoded directly at a reduced scale
+        image.draft("RGB", (max_side, max_side))
+        image = image.convert("RGB")
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+    buf = io.BytesIO()
+    image.save(buf, format="JPEG", quality=quality)
+    return buf.getvalue(), "image/jpeg"
+
+
+def _read_image(image):
+    """(bytes, mime type) for an image given as a file path or as raw bytes."""
+    if isinstance(image, (bytes, bytearray)):
+        data = bytes(image)
+        try:
+            mime_type = Image.MIME.get(Image.open(io.BytesIO(data)).format)
+        except Exception:
+            mime_type = None
     else:
-         # Some errors return a dict
-         if 'error' in results:
-             raise Exception(f"API Error: {results['error']}")
-         raise Exception(f"Unexpected API response type: {type(results)}")
+        # Determine content type
+        mime_type, _ = mimetypes.guess_type(image)
+        with open(image, "rb") as f:
+            data = f.read()
+    return data, mime_type or "application/octet-stream"
 
+
+# Calls in progress, keyed like the cache: concurrent uploads of the same
+# image share one backend request
+_inflight = SingleFlight()
+
+
+@timed('segment_image')
+def segment_image(image_path, api_token=None, use_cache=True, backend=None, max_side=None):
+    """
+    Runs instance segmentation on the image with the configured backend
+    (Hugging Face API by default, see get_backend).
+    `image_path` is a file path or the image's raw bytes.
+    Returns a list of masks/labels.
+
+    Results are cached by content hash of the image bytes plus the backend's
+    model id, so a duplicate upload skips the round trip. Pass use_cache=False
+    to force a fresh call (the fresh result still refreshes the cache).
+
+    `max_side` (default SEG_INFERENCE_MAX_SIDE, 0 = off; large images always
+    use at most SEG_LARGE_IMAGE_INFERENCE_SIDE) sends a downscaled copy
+    instead of the original; the returned masks are then smaller than the image.
+
+    Concurrent calls for the same image and model (e.g. a double submit) are
+    coalesced: one backend request is made and every caller gets its result,
+    or its error.
+    """
+    if backend is None:
+        backend = get_backend()
+
+    data, mime_type = _read_image(image_path)
+
+    if max_side is None:
+        max_side = INFERENCE_MAX_SIDE
+        if is_large_image(image_size(data)):
+            max_side = min(max_side or LARGE_IMAGE_INFERENCE_SIDE, LARGE_IMAGE_INFERENCE_SIDE)
+
+    cache = get_cache()
+    model_id = f"{backend.model_id}@{max_side}" if max_side else backend.model_id
+    key = cache_key(data, model_id)
+    if cache is not None and use_cache:
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+
+    def infer():
+        payload, payload_type = data, mime_type
+        if max_side:
+            payload, payload_type = downscale_for_inference(data, mime_type, max_side)
+        with span('inference'):
+            results = backend.segment(payload, payload_type, api_token)
+        if cache is not None:
+            cache.set(key, results)
+        return results
+
+    standardized_results, shared = _inflight.do(key, infer)
+    if shared:
+        get_metrics().inc('inference_coalesced_total')
+        # Each caller gets its own list (the mask strings themselves are immutable)
+        standardized_results = [dict(item) for item in standardized_results]
     return standardized_results
 
-def extract_objects(image_path, segmentation_results, output_dir):
+# Mask values below this are treated as background noise
+MASK_THRESHOLD = 10
+# Upper bound on the bytes of decoded masks held at once by extract_objects
+MASK_STACK_BUDGET = 8 * 1024 * 1024
+
+# PNG encoding: deflate dominates extraction time, so it runs on a thread pool
+# (Pillow releases the GIL while encoding). Level 1 is the "fast encode" mode.
+ENCODE_WORKERS = int(os.getenv("SEG_ENCODE_WORKERS", min(4, os.cpu_count() or 1)))
+PNG_COMPRESS_LEVEL = int(os.getenv("SEG_PNG_COMPRESS_LEVEL", 6))
+FAST_ENCODE = os.getenv("SEG_FAST_ENCODE", "").lower() in ("1", "true", "yes")
+FAST_COMPRESS_LEVEL = 1
+
+_encode_pools = {}
+_encode_pools_lock = threading.Lock()
+
+
+def _get_encode_pool(workers):
+    with _encode_pools_lock:
+        pool = _encode_pools.get(workers)
+        if pool is None:
+            pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="png-encode")
+            _encode_pools[workers] = pool
+        return pool
+
+
+def _save_png(rgba, filepath, compress_level, on_object=None, save=None):
+    if save is None:
+        Image.fromarray(rgba, "RGBA").save(filepath, format="PNG", compress_level=compress_level)
+    else:
+        buf = io.BytesIO()
+        Image.fromarray(rgba, "RGBA").save(buf, format="PNG", compress_level=compress_level)
+        filepath = os.path.basename(filepath)
+        save(filepath, buf.getvalue())
+    if on_object is not None:
+        on_object(filepath)
+    return filepath
+
+
+def encode_pngs(crops, workers=None, compress_level=None):
+    """PNG bytes of RGBA `crops`, in order, encoded on the encoder pool like extract_objects."""
+    workers = ENCODE_WORKERS if workers is None else workers
+    compress_level = PNG_COMPRESS_LEVEL if compress_level is None else compress_level
+
+    def encode(rgba):
+        buf = io.BytesIO()
+        Image.fromarray(rgba, "RGBA").save(buf, format="PNG", compress_level=compress_level)
+        return buf.getvalue()
+
+    if workers > 1 and len(crops) > 1:
+        return list(_get_encode_pool(workers).map(encode, crops))
+    return [encode(rgba) for rgba in crops]
+
+
+def _decode_mask(obj):
+    """Return the instance mask of one standardized result as a PIL image, or None."""
+    label = obj.get('label', 'object')
+    mask_image = None
+    if 'mask' in obj and isinstance(obj['mask'], str):
+         # Base64 string from raw API
+        try:
+            mask_bytes = base64.b64decode(obj['mask'])
+            mask_image = Image.open(io.BytesIO(mask_bytes))
+        except Exception as e:
+            print(f"Failed to decode mask for {label}: {e}")
+            return None
+    elif 'mask_obj' in obj:
+         # PIL Object from InferenceClient (fallback if we switched back)
+         mask_image = obj['mask_obj']
+    return mask_image
+
+
+def mask_bboxes(stack):
+    """
+    Bounding boxes of the non-zero area of every mask in an (N, H, W) stack,
+    computed in one vectorized pass.
+    Returns an (N, 4) int array of (left, upper, right, lower) in PIL crop
+    convention and a boolean array marking masks that are not empty.
+    """
+    n, height, width = stack.shape
+    rows = stack.max(axis=2) > 0
+    cols = stack.max(axis=1) > 0
+    valid = rows.any(axis=1)
+    bboxes = np.empty((n, 4), dtype=np.int64)
+    bboxes[:, 0] = cols.argmax(axis=1)
+    bboxes[:, 1] = rows.argmax(axis=1)
+    bboxes[:, 2] = width - cols[:, ::-1].argmax(axis=1)
+    bboxes[:, 3] = height - rows[:, ::-1].argmax(axis=1)
+    return bboxes, valid
+
+
+# Radius of PIL's LANCZOS kernel in source pixels (when upsampling)
+LANCZOS_SUPPORT = 3
+
+
+def _roi_box(mask_size, size, bbox):
+    """
+    Region of the target frame a mask with native non-zero `bbox` can reach
+    once resized to `size`: (left, upper, right, lower, sx, sy).
+    """
+    w, h = mask_size
+    width, height = size
+    x0, y0, x1, y1 = bbox
+
+    sx, sy = width / w, height / h
+    # When downsampling, the kernel is stretched by the reduction factor
+    pad_x = int(np.ceil(LANCZOS_SUPPORT * max(1.0, 1 / sx))) + 1
+    pad_y = int(np.ceil(LANCZOS_SUPPORT * max(1.0, 1 / sy))) + 1
+    left = max(0, int(np.floor((x0 - pad_x) * sx)))
+    upper = max(0, int(np.floor((y0 - pad_y) * sy)))
+    right = min(width, int(np.ceil((x1 + pad_x) * sx)))
+    lower = min(height, int(np.ceil((y1 + pad_y) * sy)))
+    return left, upper, right, lower, sx, sy
+
+
+def _resize_rows(mask_image, roi, y0, y1):
+    """Rows y0:y1 (target coordinates) of the mask resized over `roi`, as uint8."""
+    left, upper, right, lower, sx, sy = roi
+    band = mask_image.resize(
+        (right - left, y1 - y0), Image.LANCZOS,
+        box=(left / sx, y0 / sy, right / sx, y1 / sy),
+    )
+    return np.array(band)
+
+
+def upsample_mask_roi(mask_image, size, threshold=MASK_THRESHOLD, bbox=None):
+    """
+    Resize an "L" mask to `size`, but only over the region its content can
+    reach: the mask's bbox at native resolution, padded by the filter support.
+    Uses PIL's resize box so the result matches a full-frame LANCZOS resize
+    cropped to that region.
+    `bbox` is the mask's non-zero bbox at native resolution, if already known.
+    Returns (alpha, left, upper) with alpha thresholded and cropped to its
+    bbox in target coordinates, or None if the mask is empty.
+    """
+    if bbox is None:
+        bboxes, valid = mask_bboxes(np.asarray(mask_image)[None])
+        if not valid[0]:
+            return None
+        bbox = bboxes[0]
+    roi = _roi_box(mask_image.size, size, bbox)
+    alpha = _resize_rows(mask_image, roi, roi[1], roi[3])
+    return trim_mask(alpha, roi[0], roi[1], threshold)
+
+
+def _composite(source_arr, alpha, left, upper):
+    """RGBA crop of the source at (left, upper) with `alpha` as its alpha channel."""
+    rgba = np.empty(alpha.shape + (4,), dtype=np.uint8)
+    rgba[..., :3] = source_arr[upper:upper + alpha.shape[0], left:left + alpha.shape[1]]
+    rgba[..., 3] = alpha
+    return rgba
+
+
+class _ObjectWriter:
+    """
+    Builds object RGBA crops from the source array and PNG-encodes them,
+    on the encoder pool when there is one. Results keep submission order.
+    With `describe` (a list), a descriptor of every object is appended to it
+    (see extract_objects); with `lazy`, that is all that happens.
+    """
+
+    def __init__(self, source_arr, output_dir, workers, compress_level, fast_encode,
+                 on_object=None, prefix="", save=None, describe=None, lazy=False,
+                 threshold=MASK_THRESHOLD, feather=0):
+        workers = ENCODE_WORKERS if workers is None else workers
+        if fast_encode is None:
+            fast_encode = FAST_ENCODE
+        if compress_level is None:
+            compress_level = FAST_COMPRESS_LEVEL if fast_encode else PNG_COMPRESS_LEVEL
+        self.source_arr = source_arr
+        self.output_dir = output_dir
+        self.compress_level = compress_level
+        self.on_object = on_object
+        self.prefix = prefix
+        self.save = save
+        self.describe = describe
+        self.lazy = lazy
+        # How the object's alpha is derived from its stored mask
+        self.shape = {'threshold': threshold, 'feather': feather}
+        self.pool = _get_encode_pool(workers) if workers > 1 else None
+        # Crops waiting for the encoder hold memory; cap how many are queued
+        self.max_pending = 2 * workers
+        self.pending = []
+        self.files = []
+
+    def emit(self, i, label, alpha, left, upper, score=0.0):
+        """`alpha` is the object's alpha crop, or an RLEMask of it (expanded only if the object is built)."""
+        filename = f"{self.prefix}{label}_{i+1}.png"
+        if self.describe is not None:
+            if isinstance(alpha, RLEMask):
+                width, height = alpha.width, alpha.height
+            else:
+                height, width = alpha.shape
+            self.describe.append({'file': filename, 'mask': i, 'label': label, 'score': score,
+                                  'bbox': [int(left), int(upper), int(width), int(height)],
+                                  **self.shape})
+        if self.lazy:
+            self.files.append(filename)
+            if self.on_object is not None:
+                self.on_object(filename)
+            return
+
+        if isinstance(alpha, RLEMask):
+            alpha = alpha.decode()
+        rgba = _composite(self.source_arr, alpha, left, upper)
+        filepath = filename if self.output_dir is None else os.path.join(self.output_dir, filename)
+        args = (rgba, filepath, self.compress_level, self.on_object, self.save)
+        if self.pool is None:
+            self.files.append(_save_png(*args))
+            return
+        self.pending.append(self.pool.submit(_save_png, *args))
+        if len(self.pending) >= self.max_pending:
+            self.files.append(self.pending.pop(0).result())
+
+    def finish(self):
+        # Collected in submission order, so the result list is deterministic
+        for future in self.pending:
+            self.files.append(future.result())
+        self.pending = []
+        get_metrics().inc('objects_extracted_total', len(self.files))
+        return self.files
+
+
+def _load_rgb(image):
+    # The source alpha (if any) is replaced by the mask, so RGB is all we need
+    if isinstance(image, (bytes, bytearray)):
+        image = io.BytesIO(image)
+    return np.asarray(Image.open(image).convert("RGB"))
+
+
+def trim_mask(alpha, left, upper, threshold=MASK_THRESHOLD):
+    """
+    Zero the values of a mask crop below `threshold` (in place) and trim it to
+    the remaining bbox. Returns (alpha, left, upper), or None if nothing is left.
+    """
+    if threshold > 0:
+        alpha[alpha < threshold] = 0
+    bboxes, valid = mask_bboxes(alpha[None])
+    if not valid[0]:
+        return None
+    l, u, r, lo = bboxes[0]
+    return alpha[u:lo, l:r], left + l, upper + u
+
+
+@timed('extract_objects')
+def extract_objects(image_path, segmentation_results, output_dir,
+                    workers=None, compress_level=None, fast_encode=None, on_object=None,
+                    prefix="", save=None, keep_masks=None, large_image=None, memory_budget=None,
+                    describe=None, lazy=False):
     """
     Extracts objects from the image based on segmentation results.
     Saves each object as a transparent PNG.
     Returns a list of generated file paths.
+
+    Masks are decoded at their native resolution into (N, h, w) uint8 stacks
+    (batched to stay within MASK_STACK_BUDGET) so bounding boxes run
+    vectorized. Masks smaller or larger than the image are resized only over
+    their padded bbox (see upsample_mask_roi). Each object is then built from
+    an RGB crop of the source plus its mask crop, never from a full-frame copy.
+
+    PNG encoding is handed to a pool of `workers` threads (default
+    SEG_ENCODE_WORKERS). `compress_level` is the zlib level (default
+    SEG_PNG_COMPRESS_LEVEL); `fast_encode` uses level 1 for lower latency at
+    the cost of larger files. Output order and filenames are unaffected.
+
+    `on_object(filepath)` is called as soon as each object file is written
+    (possibly from an encoder thread, in completion order). `prefix` is
+    prepended to every filename, e.g. to keep several images in one directory.
+
+    `image_path` may also be the image's raw bytes. With `save(filename, data)`
+    the encoded PNGs are handed to that callable instead of being written to
+    `output_dir`, and the returned list holds filenames rather than paths.
+
+    If `keep_masks` is a list, the unthresholded full-resolution mask of every
+    object is appended to it as a dict (index, label, score, mask: an
+    RLEMask), ready for pack_masks. Objects are then cut from those masks,
+    exactly as composite_objects does later.
+
+    `large_image` (default: more than SEG_LARGE_IMAGE_PIXELS pixels) switches
+    to _extract_objects_tiled, which bounds working memory by
+    `memory_budget` instead of image size times object count. Masks are not
+    kept in that mode.
+
+    If `describe` is a list, a descriptor of every object is appended to it:
+    a dict (file, mask: the index of its entry in `keep_masks`, label, score,
+    bbox: [x, y, w, h], threshold, feather) from which composite_objects can
+    rebuild the object later. With `lazy` (which needs `keep_masks`), that is
+    all extraction does: the source image is not even decoded and no object is
+    composited or encoded; the returned list holds the filenames the objects
+    will have. Large images ignore `describe` and `lazy` and are encoded as
+    usual.
     """
-    original_image = Image.open(image_path).convert("RGBA")
-    width, height = original_image.size
-    
-    extracted_files = []
-    
-    # Sort results by score or area if needed, but for now just process all
-    # The API returns a list of objects, each with a 'mask' (base64 encoded) or polygon
-    # Note: mask2former returns a list of dictionaries. 
-    # Let's handle the specific format returned by the API.
-    # Usually it returns [{'score': ..., 'label': ..., 'mask': 'base64str'}, ...] for some models
-    # However, the standard Inference API for image-segmentation often returns:
-    # [{'score': 0.99, 'label': 'person', 'mask': '...'}] where mask is base64 encoded grayscale image
-    
-    # We need to verify the response format. If it's the standard pipeline, it returns masks.
-    
     if not isinstance(segmentation_results, list):
          raise Exception("Unexpected API response format.")
 
-    for i, obj in enumerate(segmentation_results):
-        
+    if large_image is None:
+        large_image = is_large_image(image_size(image_path))
+    if large_image:
+        if fast_encode is None:
+            fast_encode = FAST_ENCODE
+        if compress_level is None:
+            compress_level = FAST_COMPRESS_LEVEL if fast_encode else PNG_COMPRESS_LEVEL
+        return _extract_objects_tiled(
+            image_path, segmentation_results, output_dir,
+            LARGE_IMAGE_MEMORY_BUDGET if memory_budget is None else memory_budget,
+            compress_level, on_object, prefix, save,
+        )
+
+    if lazy and keep_masks is None:
+        raise Exception("Lazy extraction needs keep_masks to refer to.")
+    if lazy:
+        # Only the size is needed to place the masks
+        source_arr = None
+        width, height = image_size(image_path)
+    else:
+        source_arr = _load_rgb(image_path)
+        height, width = source_arr.shape[:2]
+    writer = _ObjectWriter(source_arr, output_dir, workers, compress_level, fast_encode,
+                           on_object, prefix, save, describe, lazy)
+    keep = keep_masks is not None
+
+    def emit(index, alpha, left, upper):
+        obj = segmentation_results[index]
         label = obj.get('label', 'object')
-        score = obj.get('score', 0.0)
-        
-        mask_image = None
-        if 'mask' in obj and isinstance(obj['mask'], str):
-             # Base64 string from raw API
-            try:
-                mask_bytes = base64.b64decode(obj['mask'])
-                mask_image = Image.open(io.BytesIO(mask_bytes))
-            except Exception as e:
-                print(f"Failed to decode mask for {label}: {e}")
+        score = float(obj.get('score') or 0)
+        if keep:
+            mask = RLEMask.encode(alpha, left, upper)
+            keep_masks.append({'index': index, 'label': label, 'score': score, 'mask': mask})
+            alpha = mask.threshold(MASK_THRESHOLD)
+            if not alpha:
+                return
+            left, upper = alpha.left, alpha.upper
+        writer.emit(index, label, alpha, left, upper, score)
+
+    # Masks are kept raw when recording them; thresholding then happens per crop
+    threshold = 0 if keep else MASK_THRESHOLD
+
+    # Masks are stacked at their native resolution in batches that stay within
+    # MASK_STACK_BUDGET. Decoding happens per batch too: a decoded PIL mask
+    # holds a full buffer for as long as it lives.
+    count = len(segmentation_results)
+    i = 0
+    while i < count:
+        # (i, n) for masks in the stack, (i, (alpha, left, upper)) for odd-sized ones
+        batch = []
+        stack = None
+        stacked = 0
+        while i < count and (stack is None or stacked < len(stack)):
+            obj = segmentation_results[i]
+            index = i
+            i += 1
+            mask_image = _decode_mask(obj)
+            if not mask_image:
+                continue
+            mask_image = mask_image.convert("L")
+            if stack is None:
+                stack_size = mask_image.size
+                capacity = max(1, MASK_STACK_BUDGET // (stack_size[0] * stack_size[1]))
+                stack = np.empty((min(capacity, count - index), stack_size[1], stack_size[0]), dtype=np.uint8)
+            if mask_image.size != stack_size:
+                roi = upsample_mask_roi(mask_image, (width, height), threshold=threshold)
+                if roi is not None:
+                    batch.append((index, roi))
+                continue
+            mask_arr = stack[stacked]
+            mask_arr[:] = np.asarray(mask_image)
+            if stack_size == (width, height) and threshold:
+                # Simple thresholding to remove noise (anything < 10/255 becomes 0)
+                # But keep the upper range soft for anti-aliasing
+                mask_arr[mask_arr < threshold] = 0
+            batch.append((index, stacked))
+            stacked += 1
+
+        if stack is None:
+            continue
+        # Bboxes for the whole batch at native resolution
+        bboxes, valid = mask_bboxes(stack[:stacked])
+
+        for index, ref in batch:
+            if isinstance(ref, tuple):
+                emit(index, *ref)
+                continue
+            if not valid[ref]:
                 continue
-        elif 'mask_obj' in obj:
-             # PIL Object from InferenceClient (fallback if we switched back)
-             mask_image = obj['mask_obj']
-        
+            if stack_size == (width, height):
+                left, upper, right, lower = bboxes[ref]
+                emit(index, stack[ref, upper:lower, left:right], left, upper)
+                continue
+            # Resize cost scales with the object's area, not the frame's
+            roi = upsample_mask_roi(Image.fromarray(stack[ref]), (width, height),
+                                    threshold=threshold, bbox=bboxes[ref])
+            if roi is not None:
+                emit(index, *roi)
+
+    return writer.finish()
+
+
+def _extract_objects_tiled(image_path, segmentation_results, output_dir, memory_budget,
+                           compress_level, on_object, prefix, save):
+    """
+    Large-image variant of extract_objects. The original is decoded once into
+    a memory-mapped RGB buffer; then, one object at a time, its mask is
+    resized, thresholded, combined with the source pixels and PNG-encoded in
+    row bands of at most `memory_budget` bytes. Each object takes two passes
+    over its region: one to find the thresholded bbox, one to write it.
+    Masks already at full resolution are used as decoded (one at a time).
+    """
+    mapped = decode_to_memmap(image_path, memory_budget)
+    try:
+        return _extract_tiled_objects(mapped, segmentation_results, output_dir, memory_budget,
+                                      compress_level, on_object, prefix, save)
+    finally:
+        mapped.close()
+
+
+def _extract_tiled_objects(mapped, segmentation_results, output_dir, memory_budget,
+                           compress_level, on_object, prefix, save):
+    source = mapped.array
+    height, width = source.shape[:2]
+    extracted_files = []
+
+    for index, obj in enumerate(segmentation_results):
+        mask_image = _decode_mask(obj)
         if not mask_image:
             continue
-            
         mask_image = mask_image.convert("L")
-        
-        # Resize mask to match original image if needed
-        # Use LANCZOS for high-quality downsampling/upsampling logic to avoid jagged edges
-        if mask_image.size != original_image.size:
-            mask_image = mask_image.resize(original_image.size, Image.LANCZOS)
-        
-        # Clean up the mask: Threshold to remove faint background noise but keep anti-aliasing
-        # This helps "just the object" be masked out by removing low-confidence pixels
-        mask_arr = np.array(mask_image)
-        # Binarize slightly to remove halo? Or just keep it soft?
-        # User said "accuracy is low", implying bad edges.
-        # Let's keep it soft but clamp the bottom range to clear background.
-        
-        # Simple thresholding to remove noise (anything < 10/255 becomes 0)
-        # But keep the upper range soft for anti-aliasing
-        mask_arr = np.where(mask_arr < 10, 0, mask_arr)
-        mask_image = Image.fromarray(mask_arr)
-
-        # Create composite: apply mask to alpha channel
-        object_img = original_image.copy()
-        
-        # Ensure mask is L mode (8-bit pixels, black and white)
-        if mask_image.mode != 'L':
-             mask_image = mask_image.convert('L')
-             
-        object_img.putalpha(mask_image)
-        
-        # Crop to bounding box of the non-transparent area
-        bbox = object_img.getbbox()
-        if bbox:
-            object_img = object_img.crop(bbox)
-            filename = f"{label}_{i+1}.png"
-            filepath = os.path.join(output_dir, filename)
-            object_img.save(filepath, format="PNG")
-            extracted_files.append(filepath)
-            
+        label = obj.get('label', 'object')
+
+        if mask_image.size == (width, height):
+            full = np.asarray(mask_image)
+            roi = (0, 0, width, height, 1.0, 1.0)
+
+            def rows(y0, y1):
+                return full[y0:y1].copy()
+        else:
+            bboxes, valid = mask_bboxes(np.asarray(mask_image)[None])
+            if not valid[0]:
+                continue
+            roi = _roi_box(mask_image.size, (width, height), bboxes[0])
+
+            def rows(y0, y1):
+                return _resize_rows(mask_image, roi, y0, y1)
+
+        left, upper, right, lower = roi[:4]
+        # Resized band, thresholded band and PIL's intermediate: ~3 bytes per pixel
+        step = band_rows(right - left, 3, memory_budget)
+
+        # Pass 1: thresholded bbox
+        x_min, x_max, y_min, y_max = None, None, None, None
+        for y0 in range(upper, lower, step):
+            y1 = min(lower, y0 + step)
+            band = rows(y0, y1)
+            band[band < MASK_THRESHOLD] = 0
+            bboxes, valid = mask_bboxes(band[None])
+            if not valid[0]:
+                continue
+            l, u, r, lo = bboxes[0]
+            x_min = l if x_min is None else min(x_min, l)
+            x_max = r if x_max is None else max(x_max, r)
+            y_min = y0 + u if y_min is None else y_min
+            y_max = y0 + lo
+        if x_min is None:
+            continue
+
+        # Pass 2: RGBA bands of the bbox streamed into the PNG
+        obj_left, obj_right = left + x_min, left + x_max
+        obj_width = obj_right - obj_left
+        step = band_rows(max(right - left, obj_width * 2), 3, memory_budget)
+        filename = f"{prefix}{label}_{index+1}.png"
+        out = io.BytesIO() if save is not None else open(os.path.join(output_dir, filename), "wb")
+        try:
+            writer = PNGStreamWriter(out, obj_width, y_max - y_min, compress_level)
+            for y0 in range(y_min, y_max, step):
+                y1 = min(y_max, y0 + step)
+                alpha = rows(y0, y1)[:, x_min:x_max]
+                alpha[alpha < MASK_THRESHOLD] = 0
+                rgba = np.empty((y1 - y0, obj_width, 4), dtype=np.uint8)
+                rgba[..., :3] = source[y0:y1, obj_left:obj_right]
+                rgba[..., 3] = alpha
+                writer.write(rgba)
+            writer.close()
+        finally:
+            if save is None:
+                out.close()
+        if save is not None:
+            save(filename, out.getvalue())
+            path = filename
+        else:
+            path = os.path.join(output_dir, filename)
+        extracted_files.append(path)
+        if on_object is not None:
+            on_object(path)
+        # Source pages read for this object leave the resident set again
+        mapped.release()
+
+    get_metrics().inc('objects_extracted_total', len(extracted_files))
     return extracted_files
 
+
+# Stored mask sets: a length-prefixed JSON header (image size and one entry
+# per mask), then the zlib-compressed runs of every mask (RLEMask run lengths
+# as little-endian uint32, then their values)
+MASKS_HEADER = struct.Struct('<I')
+
+
+def pack_masks(size, masks):
+    """Serialize masks collected by extract_objects(keep_masks=...) for an image of `size`."""
+    entries = []
+    chunks = []
+    for m in masks:
+        mask = m['mask']
+        entries.append({'index': m['index'], 'label': m['label'], 'score': m['score'],
+                        'bbox': list(mask.bbox), 'runs': len(mask)})
+        chunks += [mask.lengths.astype('<u4').tobytes(), mask.values.tobytes()]
+    header = json.dumps({'size': list(size), 'masks': entries}).encode('utf-8')
+    body = zlib.compress(b''.join(chunks), 1)
+    return MASKS_HEADER.pack(len(header)) + header + body
+
+
+def unpack_masks(data):
+    """Inverse of pack_masks: returns (size, masks)."""
+    (header_size,) = MASKS_HEADER.unpack_from(data)
+    header = json.loads(data[MASKS_HEADER.size:MASKS_HEADER.size + header_size])
+    body = zlib.decompress(data[MASKS_HEADER.size + header_size:])
+    masks = []
+    offset = 0
+    for entry in header['masks']:
+        left, upper, right, lower = entry['bbox']
+        n = entry['runs']
+        lengths = np.frombuffer(body, dtype='<u4', count=n, offset=offset)
+        values = np.frombuffer(body, dtype=np.uint8, count=n, offset=offset + 4 * n)
+        offset += 5 * n
+        mask = RLEMask(left, upper, right - left, lower - upper, lengths, values)
+        masks.append({'index': entry['index'], 'label': entry['label'], 'score': entry['score'], 'mask': mask})
+    return tuple(header['size']), masks
+
+
+def _shape_mask(m, threshold, feather, size):
+    """
+    Alpha of a stored mask (see unpack_masks): values below `threshold` cut,
+    edge blurred by `feather` pixels within an image of `size`.
+    Returns (alpha, left, upper), or None if nothing is left.
+    """
+    width, height = size
+    mask = m['mask'].threshold(threshold)
+    if not mask:
+        return None
+    alpha, left, upper = mask.decode(), mask.left, mask.upper
+    if feather <= 0:
+        return alpha, left, upper
+    # Room for the blur to spread, within the image
+    pad = int(np.ceil(3 * feather))
+    x0, y0 = max(0, left - pad), max(0, upper - pad)
+    x1 = min(width, left + alpha.shape[1] + pad)
+    y1 = min(height, upper + alpha.shape[0] + pad)
+    padded = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+    padded[upper - y0:upper - y0 + alpha.shape[0], left - x0:left - x0 + alpha.shape[1]] = alpha
+    blurred = np.array(Image.fromarray(padded).filter(ImageFilter.GaussianBlur(feather)))
+    return trim_mask(blurred, x0, y0, threshold=0)
+
+
+def reextract_objects(image_path, masks, output_dir, threshold=MASK_THRESHOLD, min_score=0.0,
+                      labels=None, feather=0, workers=None, compress_level=None, fast_encode=None,
+                      prefix="", save=None, describe=None, lazy=False):
+    """
+    Rebuild objects from stored masks (see pack_masks) without segmenting
+    again. Masks scoring below `min_score` or whose label is not in `labels`
+    (when given) are skipped; values below `threshold` are cut; `feather`
+    softens the edge with a Gaussian blur of that radius in pixels.
+    Filenames are the same extract_objects produced, so objects keep their
+    names across re-extractions. Returns the list of files like extract_objects
+    (`describe` and `lazy` work as they do there, descriptors referring to
+    the masks' `index`).
+    """
+    if lazy:
+        source_arr = None
+        width, height = image_size(image_path)
+    else:
+        source_arr = _load_rgb(image_path)
+        height, width = source_arr.shape[:2]
+    writer = _ObjectWriter(source_arr, output_dir, workers, compress_level, fast_encode,
+                           prefix=prefix, save=save, describe=describe, lazy=lazy,
+                           threshold=threshold, feather=feather)
+    labels = set(labels) if labels else None
+
+    for m in masks:
+        if m['score'] < min_score or (labels is not None and m['label'] not in labels):
+            continue
+        shaped = _shape_mask(m, threshold, feather, (width, height))
+        if shaped is None:
+            continue
+        writer.emit(m['index'], m['label'], *shaped, m['score'])
+
+    return writer.finish()
+
+
+@timed('composite_objects')
+def composite_objects(image_path, masks, descriptors):
+    """
+    RGBA crops of objects described by extract_objects or reextract_objects
+    (see `describe`), from the same image and its stored `masks` (see
+    unpack_masks). The image is decoded once for all of them. Returns the
+    crops in descriptor order.
+    """
+    source_arr = _load_rgb(image_path)
+    height, width = source_arr.shape[:2]
+    by_index = {m['index']: m for m in masks}
+    crops = []
+    for d in descriptors:
+        shaped = _shape_mask(by_index[d['mask']], d['threshold'], d['feather'], (width, height))
+        if shaped is None:
+            raise Exception(f"Empty mask for {d['file']}")
+        crops.append(_composite(source_arr, *shaped))
+    return crops
+
+
+# Read size when copying object files into a streamed archive
+ZIP_CHUNK_SIZE = 64 * 1024
+
+
+class _ZipChunkSink:
+    """Write-only, non-seekable file object that buffers zipfile output for a generator."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def stream_zip(entries, chunk_size=ZIP_CHUNK_SIZE):
+    """
+    Generate a ZIP archive chunk by chunk, e.g. as a Flask response body.
+    `entries` are file paths (stored under their basename) or (source, arcname)
+    pairs where source is a path or the file's bytes. Entries use ZIP_STORED
+    since the PNGs are already compressed; the sink is not seekable so zipfile
+    writes sizes in data descriptors.
+    """
+    sink = _ZipChunkSink()
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED) as zipf:
+        for entry in entries:
+            path, arcname = entry if isinstance(entry, tuple) else (entry, os.path.basename(entry))
+            if isinstance(path, (bytes, bytearray)):
+                zinfo = zipfile.ZipInfo(arcname, date_time=time.localtime()[:6])
+                zinfo.file_size = len(path)
+                src = io.BytesIO(path)
+            else:
+                zinfo = zipfile.ZipInfo.from_file(path, arcname)
+                src = open(path, 'rb')
+            zinfo.compress_type = zipfile.ZIP_STORED
+            with src, zipf.open(zinfo, 'w') as dst:
+                while True:
+                    chunk = src.read(chunk_size)
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+                    data = sink.drain()
+                    if data:
+                        yield data
+            data = sink.drain()
+            if data:
+                yield data
+    # Central directory is written when the archive closes
+    data = sink.drain()
+    if data:
+        yield data
+
+
+@timed('create_zip')
 def create_zip(file_paths, zip_path):
     """
     Creates a zip file containing the specified files.
@@ -0,0 +1,411 @@
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+
+class SessionStore:
+    """
+    Named files grouped by session: the upload, its extracted objects and the
+    session manifest. Routes only talk to this interface, so sessions can live
+    on disk or in memory.
+    """
+
+    def create(self, session_id):
+        raise NotImplementedError
+
+    def exists(self, session_id):
+        raise NotImplementedError
+
+    def put(self, session_id, name, data):
+        raise NotImplementedError
+
+    def get(self, session_id, name):
+        """Return the file's bytes, or None if the session or file does not exist."""
+        raise NotImplementedError
+
+    def names(self, session_id):
+        raise NotImplementedError
+
+    def remove(self, session_id, name):
+        """Delete one file of a session (no error if it does not exist)."""
+        raise NotImplementedError
+
+    def delete(self, session_id):
+        raise NotImplementedError
+
+    def expire(self, max_age, limit=None):
+        """
+        Delete up to `limit` sessions untouched for more than `max_age` seconds.
+        Returns how many were deleted.
+        """
+        raise NotImplementedError
+
+    def evict(self, max_bytes, limit=None):
+        """
+        Delete up to `limit` least recently used sessions while the store holds
+        more than `max_bytes`. Returns how many were deleted.
+        """
+        raise NotImplementedError
+
+    def path(self, session_id, name):
+        """Local filesystem path of a file, if the store keeps one (else None)."""
+        return None
+
+    def stats(self):
+        return {}
+
+
+def _check_name(name):
+    if not name or name in ('.', '..') or '/' in name or '\\' in name or '\0' in name:
+        raise ValueError(f"Invalid name: {name!r}")
+    return name
+
+
+class _SessionEntry:
+    def __init__(self, size=0, touched=None):
+        self.size = size
+        self.touched = time.time() if touched is None else touched
+
+
+class _IndexedStore(SessionStore):
+    """
+    Access-ordered index of sessions (least recently used first) with byte
+    accounting. Since every session has the same TTL, access order is also
+    deadline order, so expiry and quota eviction only look at the front of the
+    index instead of scanning every session.
+    """
+
+    def __init__(self):
+        self.evictions = 0
+        self.expired = 0
+        self._sessions = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def _touch(self, session_id):
+        session = self._sessions.get(session_id)
+        if session is not None:
+            session.touched = time.time()
+            self._sessions.move_to_end(session_id)
+        return session
+
+    def _pop(self, session_id):
+        """Drop a session from the index (caller holds the lock)."""
+        session = self._sessions.pop(session_id, None)
+        if session is not None:
+            self._bytes -= session.size
+        return session
+
+    def _discard(self, dropped):
+        """
+        Release the storage of sessions already dropped from the index, given
+        as (session_id, entry) pairs. Returns how many were actually deleted.
+        """
+        return len(dropped)
+
+    def expire(self, max_age, limit=None):
+        cutoff = time.time() - max_age
+        with self._lock:
+            expired = []
+            for session_id, session in self._sessions.items():
+                if session.touched >= cutoff or (limit is not None and len(expired) >= limit):
+                    break
+                expired.append(session_id)
+            expired = [(session_id, self._pop(session_id)) for session_id in expired]
+        deleted = self._discard(expired)
+        with self._lock:
+            self.expired += deleted
+        return deleted
+
+    def evict(self, max_bytes, limit=None, keep=None):
+        with self._lock:
+            evicted = self._evict_locked(max_bytes, limit, keep)
+        deleted = self._discard(evicted)
+        with self._lock:
+            self.evictions -= len(evicted) - deleted
+        return deleted
+
+    def _evict_locked(self, max_bytes, limit=None, keep=None):
+        evicted = []
+        while self._bytes > max_bytes and (limit is None or len(evicted) < limit):
+            victim = next((sid for sid in self._sessions if sid != keep), None)
+            if victim is None:
+                break
+            evicted.append((victim, self._pop(victim)))
+        self.evictions += len(evicted)
+        return evicted
+
+    def stats(self):
+        with self._lock:
+            return {
+                'sessions': len(self._sessions),
+                'bytes': self._bytes,
+                'expired': self.expired,
+                'evictions': self.evictions,
+            }
+
+
+class FilesystemSessionStore(_IndexedStore):
+    """
+    The original layout: one directory per session under `root`. Sessions
+    already on disk are indexed once at startup (by directory mtime); after
+    that the index is maintained on access, so nothing rescans `root`.
+
+    Several worker processes can share `root`. Every access also sets the
+    session directory's mtime, and a session is only deleted if its mtime
+    shows no other process used it since this one last did. Each process
+    indexes the sessions it created, accessed or found at startup, though,
+    so byte accounting (and with it the quota) is per process.
+    """
+
+    def __init__(self, root):
+        super().__init__()
+        self.root = root
+        self._load_index()
+
+    def _load_index(self):
+        if not os.path.isdir(self.root):
+            return
+        found = []
+        for session_id in os.listdir(self.root):
+            session_path = os.path.join(self.root, session_id)
+            if not os.path.isdir(session_path):
+                continue
+            size = 0
+            for entry in os.scandir(session_path):
+                if entry.is_file():
+                    size += entry.stat().st_size
+            found.append((os.path.getmtime(session_path), session_id, size))
+        for touched, session_id, size in sorted(found):
+            self._sessions[session_id] = _SessionEntry(size, touched)
+            self._bytes += size
+
+    def _dir(self, session_id):
+        return os.path.join(self.root, _check_name(session_id))
+
+    def _touch(self, session_id):
+        session = super()._touch(session_id)
+        touched = session.touched if session is not None else time.time()
+        # The mtime tells other processes the session is in use
+        ns = int(touched * 1e9)
+        try:
+            os.utime(self._dir(session_id), ns=(ns, ns))
+        except OSError:
+            pass
+        return session
+
+    def create(self, session_id):
+        os.makedirs(self._dir(session_id), exist_ok=True)
+        with self._lock:
+            if session_id not in self._sessions:
+                self._sessions[session_id] = _SessionEntry()
+            self._touch(session_id)
+
+    def exists(self, session_id):
+        return os.path.isdir(self._dir(session_id))
+
+    def put(self, session_id, name, data):
+        path = os.path.join(self._dir(session_id), _check_name(name))
+        try:
+            old_size = os.path.getsize(path)
+        except OSError:
+            old_size = 0
+        # Write then rename so concurrent readers never see a partial file
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            session = self._touch(session_id)
+            if session is not None:
+                session.size += len(data) - old_size
+                self._bytes += len(data) - old_size
+
+    def get(self, session_id, name):
+        try:
+            with open(os.path.join(self._dir(session_id), _check_name(name)), 'rb') as f:
+                data = f.read()
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        with self._lock:
+            self._touch(session_id)
+        return data
+
+    def names(self, session_id):
+        try:
+            return sorted(f for f in os.listdir(self._dir(session_id)) if not f.endswith('.tmp'))
+        except FileNotFoundError:
+            return []
+
+    def remove(self, session_id, name):
+        path = os.path.join(self._dir(session_id), _check_name(name))
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            return
+        with self._lock:
+            session = self._touch(session_id)
+            if session is not None:
+                session.size -= size
+                self._bytes -= size
+
+    def delete(self, session_id):
+        shutil.rmtree(self._dir(session_id), ignore_errors=True)
+        with self._lock:
+            self._pop(session_id)
+
+    def path(self, session_id, name):
+        path = os.path.join(self._dir(session_id), _check_name(name))
+        with self._lock:
+            self._touch(session_id)
+        return path
+
+    def _discard(self, dropped):
+        deleted = 0
+        for session_id, session in dropped:
+            path = os.path.join(self.root, session_id)
+            try:
+                used = os.stat(path).st_mtime_ns / 1e9
+            except OSError:
+                # Already gone
+                deleted += 1
+                continue
+            if used > session.touched + 1e-3:
+                # Another process used it since: keep it, as of that access
+                with self._lock:
+                    if session_id not in self._sessions:
+                        session.touched = used
+                        self._sessions[session_id] = session
+                        self._bytes += session.size
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            deleted += 1
+        return deleted
+
+
+class _MemorySession(_SessionEntry):
+    def __init__(self):
+        super().__init__()
+        self.files = {}
+
+
+class MemorySessionStore(_IndexedStore):
+    """
+    Sessions held as in-memory byte buffers under a total byte budget.
+    When the budget is exceeded, whole sessions are evicted least recently
+    used first (the session being written is never evicted).
+    """
+
+    def __init__(self, max_bytes=512 * 1024 * 1024):
+        super().__init__()
+        self.max_bytes = max_bytes
+
+    def create(self, session_id):
+        _check_name(session_id)
+        with self._lock:
+            if session_id not in self._sessions:
+                self._sessions[session_id] = _MemorySession()
+            self._touch(session_id)
+
+    def exists(self, session_id):
+        with self._lock:
+            return session_id in self._sessions
+
+    def put(self, session_id, name, data):
+        _check_name(name)
+        data = bytes(data)
+        with self._lock:
+            session = self._touch(session_id)
+            if session is None:
+                raise KeyError(f"Unknown session: {session_id}")
+            old = session.files.get(name)
+            delta = len(data) - (len(old) if old is not None else 0)
+            session.files[name] = data
+            session.size += delta
+            self._bytes += delta
+            self._evict_locked(self.max_bytes, keep=session_id)
+
+    def get(self, session_id, name):
+        _check_name(session_id)
+        _check_name(name)
+        with self._lock:
+            session = self._touch(session_id)
+            if session is None:
+                return None
+            return session.files.get(name)
+
+    def names(self, session_id):
+        with self._lock:
+            session = self._sessions.get(session_id)
+            return sorted(session.files) if session is not None else []
+
+    def remove(self, session_id, name):
+        _check_name(name)
+        with self._lock:
+            session = self._touch(session_id)
+            if session is None:
+                return
+            data = session.files.pop(name, None)
+            if data is not None:
+                session.size -= len(data)
+                self._bytes -= len(data)
+
+    def delete(self, session_id):
+        with self._lock:
+            self._pop(session_id)
+
+    def stats(self):
+        stats = super().stats()
+        stats['max_bytes'] = self.max_bytes
+        return stats
+
+
+class SessionJanitor:
+    """
+    Background thread that expires sessions and enforces a byte quota off the
+    request path. Each pass deletes at most `batch_size` sessions per rule; a
+    full batch schedules the next pass immediately, otherwise the janitor
+    sleeps for `interval` seconds.
+    """
+
+    def __init__(self, store, ttl=900, max_bytes=None, interval=5, batch_size=100):
+        self.store = store
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.batch_size = batch_size
+        self._stop = threading.Event()
+        self._thread = None
+
+    def run_once(self):
+        """One incremental pass; returns the number of sessions deleted."""
+        removed = self.store.expire(self.ttl, limit=self.batch_size)
+        if self.max_bytes is not None:
+            removed += self.store.evict(self.max_bytes, limit=self.batch_size)
+        return removed
+
+    def _run(self):
+        delay = self.interval
+        while not self._stop.wait(delay):
+            try:
+                removed = self.run_once()
+            except Exception as e:
+                print(f"Session janitor error: {e}")
+                removed = 0
+            delay = 0 if removed >= self.batch_size else self.interval
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='session-janitor', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None